@@ -0,0 +1,110 @@
+"""Benchmark of the UCaps3D class heads against the number of classes.
+
+Run from the repository root:
+    python -m benchmarks.class_head --num_classes 3 13 25 --patch_size 32 32 32
+"""
+
+import argparse
+import time
+
+import torch
+from module.ucaps import UCaps3D
+
+
+def activation_bytes(net, x):
+    """
+    Total size of the outputs of the leaf modules in one forward pass, the activations a training step keeps.
+    """
+    total = [0]
+
+    def hook(module, inputs, output):
+        if isinstance(output, torch.Tensor):
+            total[0] += output.numel() * output.element_size()
+
+    handles = [module.register_forward_hook(hook) for module in net.modules() if not list(module.children())]
+    try:
+        with torch.no_grad():
+            net(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total[0]
+
+
+def timed(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_classes", nargs="+", type=int, default=[3, 13, 25], help="Classes including background")
+    parser.add_argument("--class_heads", nargs="+", type=str, default=["capsule", "projection"])
+    parser.add_argument("--class_head_channels", type=int, default=192)
+    parser.add_argument("--patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    print(
+        "| classes | head | decoder input | parameters (M) | activations (MB) | peak memory (MB) "
+        "| inference windows/s | training windows/s |"
+    )
+    print("|---|---|---|---|---|---|---|---|")
+    for num_classes in args.num_classes:
+        for class_head in args.class_heads:
+            net = UCaps3D(
+                in_channels=1,
+                out_channels=num_classes,
+                share_weight=True,
+                class_head=class_head,
+                class_head_channels=args.class_head_channels,
+            ).to(device)
+            images = torch.rand(args.batch_size, 1, *args.patch_size, device=device)
+            labels = torch.randint(0, num_classes, (args.batch_size, 1, *args.patch_size), device=device)
+            batch = {"image": images, "label": labels}
+            num_parameters = sum(p.numel() for p in net.parameters())
+
+            net.eval()
+            activations = activation_bytes(net, images)
+            with torch.no_grad():
+                inference_time = timed(lambda: net(images), args.repeats)
+
+            net.train()
+            net.log = lambda *log_args, **log_kwargs: None
+
+            def train_step():
+                net.zero_grad()
+                net.training_step(batch, 0).backward()
+
+            train_step()
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats()
+            training_time = timed(train_step, args.repeats)
+            peak = "{:.0f}".format(torch.cuda.max_memory_allocated() / 2 ** 20) if device.type == "cuda" else "-"
+
+            print(
+                "| {} | {} | {} | {:.2f} | {:.0f} | {} | {:.2f} | {:.2f} |".format(
+                    num_classes,
+                    class_head,
+                    net.decoder_in_channels[0],
+                    num_parameters / 1e6,
+                    activations / 2 ** 20,
+                    peak,
+                    args.batch_size / inference_time,
+                    args.batch_size / training_time,
+                )
+            )
+            del net
@@ -0,0 +1,61 @@
+"""Benchmark of pipeline-parallel UCaps3D inference against sequential inference.
+
+Run from the repository root:
+    python -m benchmarks.pipeline --volume_size 96 96 96 --stage_threads 4 8 4
+"""
+
+import argparse
+import os
+import time
+
+import torch
+from inference.pipeline import StagePipeline
+from inference.sliding_window import scan_windows
+from module.ucaps import UCaps3D
+from monai.inferers import sliding_window_inference
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint_path", type=str, default="", help='/path/to/trained_model. Set to "" for none.')
+    parser.add_argument("--volume_size", nargs="+", type=int, default=[96, 96, 96])
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--stage_threads", nargs="+", type=int, default=None)
+    parser.add_argument("--queue_size", type=int, default=2)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.checkpoint_path != "":
+        net = UCaps3D.load_from_checkpoint(args.checkpoint_path)
+    else:
+        net = UCaps3D(in_channels=1, out_channels=3)
+    net.eval()
+    image = torch.rand(1, net.in_channels, *args.volume_size)
+    num_windows = len(scan_windows(args.volume_size, args.val_patch_size, args.overlap))
+    torch.set_num_threads(len(os.sched_getaffinity(0)))
+
+    with torch.no_grad():
+        start = time.perf_counter()
+        reference = sliding_window_inference(
+            image, args.val_patch_size, args.sw_batch_size, net.forward, overlap=args.overlap
+        )
+        sequential_time = time.perf_counter() - start
+
+    with StagePipeline(net, stage_threads=args.stage_threads, queue_size=args.queue_size) as pipeline:
+        # Wait for the stage processes to start and load the model
+        list(pipeline.map([torch.zeros(1, net.in_channels, *args.val_patch_size)]))
+        start = time.perf_counter()
+        pipelined = pipeline(image, args.val_patch_size, sw_batch_size=args.sw_batch_size, overlap=args.overlap)
+        pipelined_time = time.perf_counter() - start
+
+    print("| executor | threads | windows/s | max abs diff |")
+    print("|---|---|---|---|")
+    print("| sequential | {} | {:.2f} | - |".format(torch.get_num_threads(), num_windows / sequential_time))
+    print(
+        "| pipeline | {} | {:.2f} | {:.2e} |".format(
+            "/".join(map(str, args.stage_threads)) if args.stage_threads else "auto",
+            num_windows / pipelined_time,
+            torch.max(torch.abs(reference - pipelined)).item(),
+        )
+    )
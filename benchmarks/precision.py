@@ -0,0 +1,87 @@
+"""Parity and accuracy of the bfloat16 precision mode against float32.
+
+Run from the repository root:
+    python -m benchmarks.precision --patch_size 32 32 32 \
+        --root_dir /data/artificial/ --checkpoints ucaps=ucaps.ckpt unet=unet.ckpt
+
+Per model, reports the largest difference of the class probabilities of a batch of windows and the
+fraction of voxels with the same predicted class under `inference.models.autocast` and in float32,
+the time of both passes, and the mean over the classes of the median Dice over the validation
+volumes of the artificial dataset in both precisions. Models without a checkpoint in --checkpoints
+are randomly initialised and have no Dice.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+from benchmarks.class_head import timed
+from datamodule.artificial import ArtificialDataModule
+from inference.models import MODELS, autocast, load_model
+from inference.sweep import sweep_checkpoints
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", type=str, default=["ucaps", "segcaps-3d", "unet"])
+    parser.add_argument("--precision", type=str, default="bf16", help="bf16 / 16")
+    parser.add_argument("--out_channels", type=int, default=3)
+    parser.add_argument("--patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--root_dir", type=str, default="", help='Artificial dataset. Set to "" for no Dice.')
+    parser.add_argument("--checkpoints", nargs="+", type=str, default=[], help="Trained checkpoints as model=path")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    checkpoints = dict(checkpoint.split("=", 1) for checkpoint in args.checkpoints)
+
+    if args.root_dir and checkpoints:
+        data_module = ArtificialDataModule(root_dir=args.root_dir)
+        data_module.setup("validate")
+
+    windows = torch.rand(args.batch_size, 1, *args.patch_size, device=device)
+    print("| model | max probability diff | same class | float32 (s) | {0} (s) | Dice float32 | Dice {0} |".format(
+        args.precision
+    ))
+    print("|---|---|---|---|---|---|---|")
+    for model_name in args.models:
+        if model_name in checkpoints:
+            net = load_model(model_name, checkpoints[model_name])
+        else:
+            net = MODELS[model_name](in_channels=1, out_channels=args.out_channels).eval()
+        net = net.to(device)
+
+        with torch.no_grad():
+            reference = net(windows)
+            reference_time = timed(lambda: net(windows), args.repeats)
+            with autocast(args.precision, device.type):
+                outputs = net(windows).float()
+                reduced_time = timed(lambda: net(windows), args.repeats)
+        difference = torch.max(torch.abs(torch.softmax(reference, dim=1) - torch.softmax(outputs, dim=1))).item()
+        same_class = torch.mean((torch.argmax(reference, dim=1) == torch.argmax(outputs, dim=1)).float()).item()
+
+        dice = ["-", "-"]
+        if args.root_dir and model_name in checkpoints:
+            for i, precision in enumerate((32, args.precision)):
+                (metric,) = sweep_checkpoints(
+                    model_name,
+                    [checkpoints[model_name]],
+                    data_module.val_dataloader(),
+                    dict(val_patch_size=args.val_patch_size, sw_batch_size=args.sw_batch_size, overlap=args.overlap),
+                    precision=precision,
+                )
+                dice[i] = "{:.4f}".format(np.nanmean(np.nanmedian(metric.aggregate("dice").cpu().numpy(), axis=0)))
+
+        print(
+            "| {} | {:.2e} | {:.2%} | {:.3f} | {:.3f} | {} | {} |".format(
+                model_name, difference, same_class, reference_time, reduced_time, *dice
+            )
+        )
+        del net
@@ -0,0 +1,89 @@
+"""Benchmark of the subsampled routing of UCaps3D: speedup and Dice of routing strides.
+
+Run from the repository root:
+    python -m benchmarks.routing_stride --settings 1 2 4 2,2,1,1,1,1 \
+        --root_dir /data/artificial/ --checkpoint ucaps.ckpt
+
+A setting is one routing stride for every encoder capsule layer, or a comma-separated stride per layer.
+Per setting, reports the forward time of a batch of windows and its speedup, the fraction of voxels
+with the same predicted class as with every voxel routed (the first setting), and the mean over the
+classes of the median Dice over the validation volumes of the artificial dataset.
+The model is --checkpoint, or randomly initialised without one.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+from benchmarks.class_head import timed
+from datamodule.artificial import ArtificialDataModule
+from inference.models import load_model
+from inference.sweep import sweep_checkpoints
+from module.ucaps import UCaps3D
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--settings", nargs="+", type=str, default=["1", "2", "4", "2,2,1,1,1,1"])
+    parser.add_argument("--out_channels", type=int, default=3)
+    parser.add_argument("--patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--root_dir", type=str, default="", help='Artificial dataset. Set to "" for no Dice.')
+    parser.add_argument("--checkpoint", type=str, default="", help="Trained UCaps3D checkpoint")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    settings = [[int(stride) for stride in setting.split(",")] for setting in args.settings]
+
+    dice = {}
+    if args.root_dir and args.checkpoint:
+        data_module = ArtificialDataModule(root_dir=args.root_dir)
+        data_module.setup("validate")
+        for setting, routing_stride in zip(args.settings, settings):
+            (metric,) = sweep_checkpoints(
+                "ucaps",
+                [args.checkpoint],
+                data_module.val_dataloader(),
+                dict(
+                    val_patch_size=args.val_patch_size,
+                    sw_batch_size=args.sw_batch_size,
+                    overlap=args.overlap,
+                    routing_stride=routing_stride,
+                ),
+            )
+            dice[setting] = np.nanmean(np.nanmedian(metric.aggregate("dice").cpu().numpy(), axis=0))
+
+    if args.checkpoint:
+        net = load_model("ucaps", args.checkpoint)
+    else:
+        net = UCaps3D(in_channels=1, out_channels=args.out_channels, share_weight=True).eval()
+    net = net.to(device)
+    windows = torch.rand(args.batch_size, 1, *args.patch_size, device=device)
+
+    print("| routing stride | forward (s) | speedup | same class | Dice |")
+    print("|---|---|---|---|---|")
+    reference = reference_time = None
+    for setting, routing_stride in zip(args.settings, settings):
+        net.set_routing_stride(routing_stride)
+        with torch.no_grad():
+            predictions = torch.argmax(net(windows), dim=1)
+            forward_time = timed(lambda: net(windows), args.repeats)
+        if reference is None:
+            reference, reference_time = predictions, forward_time
+
+        print(
+            "| {} | {:.3f} | {:.2f}x | {:.2%} | {} |".format(
+                setting,
+                forward_time,
+                reference_time / forward_time,
+                torch.mean((predictions == reference).float()).item(),
+                "{:.4f}".format(dice[setting]) if setting in dice else "-",
+            )
+        )
@@ -0,0 +1,122 @@
+"""Benchmark of the top-k sparse routing of UCaps3D: compute saved, speedup and Dice.
+
+Run from the repository root:
+    python -m benchmarks.routing_topk --settings 0 8 4 2 --root_dir /data/artificial/ --checkpoint ucaps.ckpt
+
+A setting is one k for every encoder capsule layer, or a comma-separated k per layer, 0 for dense routing.
+Per setting, reports the vote elements the routing of the encoder reads in one forward pass of a batch of
+windows (every weighted sum, cosine similarity and gather reads the votes it routes once), the forward time
+and speedup, the fraction of voxels with the same predicted class as the first setting, and the mean over
+the classes of the median Dice over the validation volumes of the artificial dataset.
+The model is --checkpoint, or randomly initialised without one.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+from benchmarks.class_head import timed
+from datamodule.artificial import ArtificialDataModule
+from inference.models import load_model
+from inference.sweep import sweep_checkpoints
+from module.ucaps import UCaps3D
+
+
+def routed_vote_elements(net, windows):
+    """
+    Vote elements read by the routing of the encoder capsule layers in one forward pass.
+    """
+    total = [0]
+
+    def counter(layer):
+        def hook(module, inputs, votes):
+            num_votes, output_dim = votes.numel(), votes.shape[2]
+            if 0 < layer.routing_topk < output_dim and layer.num_routing > 1:
+                # Dense first iteration, then the gather, two reads per later iteration and the final sum
+                # on k of the output capsules
+                sparse = num_votes * layer.routing_topk / output_dim
+                total[0] += 2 * num_votes + (2 * layer.num_routing - 2) * sparse
+            else:
+                total[0] += (2 * layer.num_routing - 1) * num_votes
+
+        return hook
+
+    handles = [layer.depthwise_conv4d.register_forward_hook(counter(layer)) for layer in net.encoder_conv_caps]
+    try:
+        with torch.no_grad():
+            net(windows)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return total[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--settings", nargs="+", type=str, default=["0", "8", "4", "2"])
+    parser.add_argument("--out_channels", type=int, default=3)
+    parser.add_argument("--patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--root_dir", type=str, default="", help='Artificial dataset. Set to "" for no Dice.')
+    parser.add_argument("--checkpoint", type=str, default="", help="Trained UCaps3D checkpoint")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    settings = [[int(topk) for topk in setting.split(",")] for setting in args.settings]
+
+    dice = {}
+    if args.root_dir and args.checkpoint:
+        data_module = ArtificialDataModule(root_dir=args.root_dir)
+        data_module.setup("validate")
+        for setting, routing_topk in zip(args.settings, settings):
+            (metric,) = sweep_checkpoints(
+                "ucaps",
+                [args.checkpoint],
+                data_module.val_dataloader(),
+                dict(
+                    val_patch_size=args.val_patch_size,
+                    sw_batch_size=args.sw_batch_size,
+                    overlap=args.overlap,
+                    routing_topk=routing_topk,
+                ),
+            )
+            dice[setting] = np.nanmean(np.nanmedian(metric.aggregate("dice").cpu().numpy(), axis=0))
+
+    if args.checkpoint:
+        net = load_model("ucaps", args.checkpoint)
+    else:
+        net = UCaps3D(in_channels=1, out_channels=args.out_channels, share_weight=True).eval()
+    net = net.to(device)
+    windows = torch.rand(args.batch_size, 1, *args.patch_size, device=device)
+
+    print("| routing top-k | routed votes (M) | saved | forward (s) | speedup | same class | Dice |")
+    print("|---|---|---|---|---|---|---|")
+    reference = None
+    for setting, routing_topk in zip(args.settings, settings):
+        net.set_routing_topk(routing_topk)
+        elements = routed_vote_elements(net, windows)
+        with torch.no_grad():
+            predictions = torch.argmax(net(windows), dim=1)
+            forward_time = timed(lambda: net(windows), args.repeats)
+        if reference is None:
+            reference = predictions, elements, forward_time
+
+        print(
+            "| {} | {:.0f} | {:.0%} | {:.3f} | {:.2f}x | {:.2%} | {} |".format(
+                setting,
+                elements / 1e6,
+                1 - elements / reference[1],
+                forward_time,
+                reference[2] / forward_time,
+                torch.mean((predictions == reference[0]).float()).item(),
+                "{:.4f}".format(dice[setting]) if setting in dice else "-",
+            )
+        )
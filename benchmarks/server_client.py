@@ -0,0 +1,74 @@
+"""Throughput and latency of a running inference server (serve.py) under concurrent requests.
+
+Run from the repository root:
+    python -m benchmarks.server_client --url http://127.0.0.1:8600 --requests 32 --concurrency 4
+    python -m benchmarks.server_client --path /data/tomo.nii.gz --output_dir /tmp/output/
+"""
+
+import argparse
+import io
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def post(url, body, content_type):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8600")
+    parser.add_argument("--model", type=str, default=None, help="Model name, needed when the server has several")
+    parser.add_argument("--path", type=str, default="", help='Tomogram sent to /predict. Set to "" for random arrays.')
+    parser.add_argument("--output_dir", type=str, default="")
+    parser.add_argument("--volume_size", nargs="+", type=int, default=[96, 96, 96], help="Size of the random arrays")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.path:
+        request = {"path": args.path, "model": args.model, "output_dir": args.output_dir}
+        url, body, content_type = args.url + "/predict", json.dumps(request).encode(), "application/json"
+    else:
+        buffer = io.BytesIO()
+        np.save(buffer, np.random.RandomState(0).rand(*args.volume_size).astype(np.float32))
+        url = args.url + "/predict_array" + (f"?model={args.model}" if args.model else "")
+        body, content_type = buffer.getvalue(), "application/octet-stream"
+
+    def timed_request(_):
+        start = time.perf_counter()
+        post(url, body, content_type)
+        return time.perf_counter() - start
+
+    # Warm-up, outside of the measurements
+    timed_request(None)
+    with urllib.request.urlopen(args.url + "/health") as response:
+        before = json.loads(response.read())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        latencies = np.array(list(executor.map(timed_request, range(args.requests))))
+    total = time.perf_counter() - start
+
+    with urllib.request.urlopen(args.url + "/health") as response:
+        after = json.loads(response.read())
+    windows = sum(stats["windows"] - before[name]["windows"] for name, stats in after.items())
+    batches = sum(stats["batches"] - before[name]["batches"] for name, stats in after.items())
+
+    print("| concurrency | requests/s | p50 latency (s) | p99 latency (s) | windows/batch |")
+    print("|---|---|---|---|---|")
+    print(
+        "| {} | {:.2f} | {:.3f} | {:.3f} | {:.2f} |".format(
+            args.concurrency,
+            args.requests / total,
+            np.percentile(latencies, 50),
+            np.percentile(latencies, 99),
+            windows / max(batches, 1),
+        )
+    )
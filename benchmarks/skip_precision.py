@@ -0,0 +1,126 @@
+"""Benchmark of the UCaps3D skip and saved-activation storage precisions: peak memory and Dice.
+
+Run from the repository root:
+    python -m benchmarks.skip_precision --patch_sizes 32 64 --root_dir /data/artificial/ --checkpoint ucaps.ckpt
+
+Per patch size, reports the peak memory of a forward pass and of a training step (forward and backward)
+of a batch of windows, above the memory in use before. Every measurement runs in a new process and reads
+the CUDA allocator statistics on GPU, the maximum resident set size of the process on CPU.
+The Dice column is the mean over the classes of the median Dice over the validation volumes of
+--checkpoint evaluated with every storage precision.
+"""
+
+import argparse
+import resource
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from datamodule.artificial import ArtificialDataModule
+from inference.sweep import sweep_checkpoints
+from module.ucaps import SKIP_PRECISIONS, UCaps3D
+
+
+def peak_memory(precision, patch_size, training, args, outputs):
+    """
+    Puts the peak memory in bytes of one forward pass, or training step with `training`, on `outputs`.
+    """
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    net = UCaps3D(in_channels=1, out_channels=args.out_channels, share_weight=True, skip_precision=precision)
+    net = net.to(device).train(training)
+    net.log = lambda *log_args, **log_kwargs: None
+    images = torch.rand(args.batch_size, 1, patch_size, patch_size, patch_size, device=device)
+    labels = torch.randint(0, args.out_channels, images.shape, device=device)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+    else:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if training:
+        net.training_step({"image": images, "label": labels}, 0).backward()
+    else:
+        with torch.no_grad():
+            net(images)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        outputs.put(torch.cuda.max_memory_allocated() - before)
+    else:
+        outputs.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - before)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precisions", nargs="+", type=str, default=list(SKIP_PRECISIONS))
+    parser.add_argument("--patch_sizes", nargs="+", type=int, default=[32, 64], help="Edges of cubic patches")
+    parser.add_argument("--out_channels", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=1, help="Windows per measured pass")
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--root_dir", type=str, default="", help='Artificial dataset. Set to "" for no Dice.')
+    parser.add_argument("--checkpoint", type=str, default="", help="Trained UCaps3D checkpoint")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--overlap", type=float, default=0.5)
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    dice = {}
+    if args.root_dir and args.checkpoint:
+        data_module = ArtificialDataModule(root_dir=args.root_dir)
+        data_module.setup("validate")
+        for precision in args.precisions:
+            (metric,) = sweep_checkpoints(
+                "ucaps",
+                [args.checkpoint],
+                data_module.val_dataloader(),
+                dict(
+                    val_patch_size=args.val_patch_size,
+                    sw_batch_size=args.sw_batch_size,
+                    overlap=args.overlap,
+                    skip_precision=precision,
+                ),
+            )
+            dice[precision] = np.nanmean(np.nanmedian(metric.aggregate("dice").cpu().numpy(), axis=0))
+
+    context = mp.get_context("spawn")
+    outputs = context.Queue()
+
+    def run(*run_args):
+        # None when the worker fails, e.g. killed out of memory
+        worker = context.Process(target=peak_memory, args=run_args + (args, outputs))
+        worker.start()
+        worker.join()
+        return outputs.get() if worker.exitcode == 0 else None
+
+    def column(peak, reference):
+        if peak is None:
+            return "failed | -"
+        if reference is None:
+            return "{:.0f} | -".format(peak / 2 ** 20)
+        return "{:.0f} | {:.0%}".format(peak / 2 ** 20, 1 - peak / reference)
+
+    print("| patch | precision | inference peak (MB) | saving | training peak (MB) | saving | Dice |")
+    print("|---|---|---|---|---|---|---|")
+    for patch_size in args.patch_sizes:
+        reference = None
+        for precision in args.precisions:
+            inference_peak = run(precision, patch_size, False)
+            training_peak = run(precision, patch_size, True)
+            if reference is None:
+                reference = inference_peak, training_peak
+
+            print(
+                "| {} | {} | {} | {} | {} |".format(
+                    patch_size,
+                    precision,
+                    column(inference_peak, reference[0]),
+                    column(training_peak, reference[1]),
+                    "{:.4f}".format(dice[precision]) if precision in dice else "-",
+                )
+            )
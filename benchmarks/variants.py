@@ -0,0 +1,93 @@
+"""Benchmark of the UCaps3D variants: throughput, memory and Dice on the artificial dataset.
+
+Run from the repository root:
+    python -m benchmarks.variants --volume_size 96 96 96 --val_patch_size 32 32 32 \
+        --root_dir /data/artificial/ --checkpoints default.ckpt lite.ckpt lite-small.ckpt
+
+Throughput and memory are measured on randomly initialised models. The Dice column is the mean
+over the classes of the median Dice over the validation volumes, for the checkpoints given with
+--checkpoints, matched to the rows by their saved variant.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+from benchmarks.class_head import activation_bytes
+from datamodule.artificial import ArtificialDataModule
+from inference.sweep import sweep_checkpoints
+from module.ucaps import UCAPS3D_VARIANTS, UCaps3D
+from monai.inferers import sliding_window_inference
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--variants", nargs="+", type=str, default=list(UCAPS3D_VARIANTS))
+    parser.add_argument("--out_channels", type=int, default=3)
+    parser.add_argument("--volume_size", nargs="+", type=int, default=[96, 96, 96])
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[32, 32, 32])
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--root_dir", type=str, default="", help='Artificial dataset. Set to "" for no Dice.')
+    parser.add_argument("--checkpoints", nargs="+", type=str, default=[], help="Trained UCaps3D checkpoints")
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    dice = {}
+    if args.root_dir and args.checkpoints:
+        data_module = ArtificialDataModule(root_dir=args.root_dir)
+        data_module.setup("validate")
+        metrics = sweep_checkpoints(
+            "ucaps",
+            args.checkpoints,
+            data_module.val_dataloader(),
+            dict(val_patch_size=args.val_patch_size, sw_batch_size=args.sw_batch_size, overlap=args.overlap),
+        )
+        for path, metric in zip(args.checkpoints, metrics):
+            variant = UCaps3D.load_from_checkpoint(path).variant
+            dice[variant] = np.nanmean(np.nanmedian(metric.aggregate("dice").cpu().numpy(), axis=0))
+
+    image = torch.rand(1, 1, *args.volume_size, device=device)
+    num_voxels = float(np.prod(args.volume_size))
+    print("| variant | parameters (M) | window activations (MB) | peak memory (MB) | Mvoxels/s | speedup | Dice |")
+    print("|---|---|---|---|---|---|---|")
+    reference_speed = None
+    for variant in args.variants:
+        net = UCaps3D(in_channels=1, out_channels=args.out_channels, share_weight=True, variant=variant).to(device)
+        net.eval()
+        num_parameters = sum(p.numel() for p in net.parameters())
+        activations = activation_bytes(net, torch.rand(1, 1, *args.val_patch_size, device=device))
+
+        if device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+        best = float("inf")
+        with torch.no_grad():
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                sliding_window_inference(image, args.val_patch_size, args.sw_batch_size, net, overlap=args.overlap)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                best = min(best, time.perf_counter() - start)
+        peak = "{:.0f}".format(torch.cuda.max_memory_allocated() / 2 ** 20) if device.type == "cuda" else "-"
+        speed = num_voxels / best
+        if reference_speed is None:
+            reference_speed = speed
+
+        print(
+            "| {} | {:.2f} | {:.0f} | {} | {:.3f} | {:.2f}x | {} |".format(
+                variant,
+                num_parameters / 1e6,
+                activations / 2 ** 20,
+                peak,
+                speed / 1e6,
+                speed / reference_speed,
+                "{:.4f}".format(dice[variant]) if variant in dice else "-",
+            )
+        )
+        del net
@@ -1,20 +1,27 @@
 import argparse
+import os
 
 import numpy as np
 import torch
 
 # from datamodule.shrec import SHRECDataModule
 from datamodule.invitro import InvitroDataModule
+from inference.ensemble import load_ensemble
+from inference.metrics import ConfusionMatrixMetrics
+from inference.pool import evaluate_in_pool
+from inference.saver import AsyncNiftiSaver
+from inference.sweep import list_checkpoints, sweep_checkpoints, sweep_table
+from inference.tile_cache import TileCache
+from inference.writer import EvaluationWriter
+from module.multi_ucaps import MultiUCaps3D
 from module.segcaps import SegCaps2D, SegCaps3D
 from module.ucaps import UCaps3D
 from module.unet import UNetModule
-from monai.data import NiftiSaver, decollate_batch
-from monai.metrics import ConfusionMatrixMetric, DiceMetric
-from monai.transforms import AsDiscrete, Compose, EnsureType, MapLabelValue
+from monai.transforms import MapLabelValue
 from monai.utils import set_determinism
+from postprocess.matching import find_coordinates, print_particle_scores, score_predictions
 import pytorch_lightning as pl
 from pytorch_lightning import Trainer
-from tqdm import tqdm
 
 
 def print_metric(metric_name, scores, reduction="mean"):
@@ -42,16 +49,44 @@ if __name__ == "__main__":
     # Validation config
     val_parser = parser.add_argument_group("Validation config")
     val_parser.add_argument("--output_dir", type=str, default="/mnt/Data/Cryo-ET/3D-UCaps/data/invitro/output/")
-    val_parser.add_argument("--model_name", type=str, default="ucaps", help="ucaps / segcaps-2d / segcaps-3d / unet")
+    val_parser.add_argument("--model_name", type=str, default="ucaps",
+                            help="ucaps / ucaps-multi / segcaps-2d / segcaps-3d / unet")
     val_parser.add_argument("--dataset", type=str, default="invitro",
                             help="shrec/ iseg2017 / task02_heart / task04_hippocampus / luna16 / invitro")
     val_parser.add_argument("--fold", type=int, default=0)
+    val_parser.add_argument("--eval_processes", type=int, default=0,
+                            help="Number of CPU evaluation processes, 0 to predict with the Trainer")
+    val_parser.add_argument("--eval_threads", type=int, default=0,
+                            help="Torch threads per evaluation process, 0 for an equal share of the cpus")
+    val_parser.add_argument("--numa", type=int, default=0, help="Pin evaluation processes to NUMA nodes or not")
+    val_parser.add_argument("--save_workers", type=int, default=2,
+                            help="Number of background threads writing predictions, 0 to write synchronously")
+    val_parser.add_argument("--save_compression", type=int, default=-1,
+                            help="gzip level of the predictions, 0 for uncompressed .nii, -1 for the nibabel default")
+    val_parser.add_argument("--prob_dir", type=str, default="",
+                            help="Directory of chunked zarr stores of the class probabilities. Set to \"\" for none.")
+    val_parser.add_argument("--prob_dtype", type=str, default="float16", help="float16 / uint8")
+    val_parser.add_argument("--tile_cache_dir", type=str, default="",
+                            help="Directory of the on-disk tile cache of the Trainer prediction. Set to \"\" for none.")
+    val_parser.add_argument("--tile_cache_size", type=float, default=10, help="Maximum size of the tile cache in GiB")
+    val_parser.add_argument("--particle_gt_dir", type=str, default="",
+                            help="Directory of ground-truth particle lists named after the labels. Set to \"\" for none.")
+    val_parser.add_argument("--particle_radius", nargs="+", type=float, default=[5.0],
+                            help="Particle radius in voxels, per class")
+    val_parser.add_argument("--particle_min_size", type=int, default=1, help="Minimum number of voxels of a particle")
+    val_parser.add_argument("--particle_class_names", nargs="+", type=str, default=None,
+                            help="Class names of the particle lists, background first")
     val_parser.add_argument("--checkpoint_path", type=str,
                             # default='/mnt/Data/Cryo-ET/3D-UCaps/logs/ucaps_invitro_0/version_12/checkpoints/epoch=128-val_dice=0.7760.ckpt',  # ribosome radi 13
                             # default='/mnt/Data/Cryo-ET/3D-UCaps/logs/ucaps_invitro_0/version_13/checkpoints/epoch=282-val_dice=0.8560.ckpt', # PT-RB New Targets, RB radi 13
                             # default='/mnt/Data/Cryo-ET/3D-UCaps/logs/ucaps_invitro_0/version_14/checkpoints/epoch=65-val_dice=0.8929.ckpt',  # Proteasome
                             default= '/mnt/Data/Cryo-ET/3D-UCaps/logs/ucaps_invitro_0/version_15/checkpoints/epoch=349-val_dice=0.7723.ckpt',  # TL
                             help='/path/to/trained_model. Set to "" for none.')
+    val_parser.add_argument("--ensemble_checkpoints", nargs="+", type=str, default=None,
+                            help="Further checkpoints of the same model, logits averaged with --checkpoint_path")
+    val_parser.add_argument("--sweep_checkpoints", nargs="+", type=str, default=None,
+                            help="Globs of checkpoints to evaluate on every validation volume read once, "
+                            "written to <output_dir>/checkpoint_sweep.csv")
 
     # THIS LINE IS KEY TO PULL THE MODEL NAME
     temp_args, _ = parser.parse_known_args()
@@ -59,6 +94,8 @@ if __name__ == "__main__":
     # let the model add what it wants
     if temp_args.model_name == "ucaps":
         parser, model_parser = UCaps3D.add_model_specific_args(parser)
+    elif temp_args.model_name == "ucaps-multi":
+        parser, model_parser = MultiUCaps3D.add_model_specific_args(parser)
     elif temp_args.model_name == "segcaps-2d":
         parser, model_parser = SegCaps2D.add_model_specific_args(parser)
     elif temp_args.model_name == "segcaps-3d":
@@ -93,15 +130,53 @@ if __name__ == "__main__":
     else:
         pass
 
-    data_module.setup("validate")
-    val_loader = data_module.val_dataloader()
+    if args.sweep_checkpoints:
+        data_module.setup("validate")
+        checkpoint_paths = list_checkpoints(args.sweep_checkpoints)
+        print(f"Sweeping {len(checkpoint_paths)} checkpoints")
+        model_kwargs = dict(val_patch_size=args.val_patch_size, sw_batch_size=args.sw_batch_size, overlap=args.overlap)
+        if dict_args.get("routing_stride"):
+            model_kwargs["routing_stride"] = args.routing_stride
+        if dict_args.get("routing_topk"):
+            model_kwargs["routing_topk"] = args.routing_topk
+        sweep_metrics = sweep_checkpoints(
+            args.model_name,
+            checkpoint_paths,
+            data_module.val_dataloader(),
+            model_kwargs,
+            num_processes=args.eval_processes,
+            num_threads=args.eval_threads,
+            numa=args.numa,
+            precision=args.precision,
+        )
+        table = sweep_table(checkpoint_paths, sweep_metrics, reduction="median")
+        os.makedirs(args.output_dir, exist_ok=True)
+        table.to_csv(os.path.join(args.output_dir, "checkpoint_sweep.csv"), index=False)
+        print(table.to_string(index=False))
+        raise SystemExit
+
+    if args.eval_processes == 0:
+        data_module.setup("validate")
+        val_loader = data_module.val_dataloader()
     # data_module.setup("validate")
     # val_loader = data_module.test_dataloader()
     val_batch_size = 1
 
     # Load trained model
 
-    if args.checkpoint_path != "":
+    # The ensemble loads --checkpoint_path as its first member
+    if args.ensemble_checkpoints:
+        net = load_ensemble(
+            args.model_name,
+            [args.checkpoint_path] + args.ensemble_checkpoints,
+            routing_stride=dict_args.get("routing_stride"),
+            routing_topk=dict_args.get("routing_topk"),
+            val_patch_size=args.val_patch_size,
+            sw_batch_size=args.sw_batch_size,
+            overlap=args.overlap,
+        )
+        print(f"Ensemble of {len(net.members)} checkpoints")
+    elif args.checkpoint_path != "":
         if args.model_name == "ucaps":
             net = UCaps3D.load_from_checkpoint(
                 args.checkpoint_path,
@@ -109,6 +184,17 @@ if __name__ == "__main__":
                 sw_batch_size=args.sw_batch_size,
                 overlap=args.overlap,
             )
+            if args.routing_stride:
+                net.set_routing_stride(args.routing_stride)
+            if args.routing_topk:
+                net.set_routing_topk(args.routing_topk)
+        elif args.model_name == "ucaps-multi":
+            net = MultiUCaps3D.load_from_checkpoint(
+                args.checkpoint_path,
+                val_patch_size=args.val_patch_size,
+                sw_batch_size=args.sw_batch_size,
+                overlap=args.overlap,
+            )
         elif args.model_name == "unet":
             net = UNetModule.load_from_checkpoint(
                 args.checkpoint_path,
@@ -136,66 +222,52 @@ if __name__ == "__main__":
     # trainer2 = Trainer.from_argparse_args(args, gpus=1)
     # print(trainer2.test(model=net, dataloaders=test_loader, verbose=True))
     # trainer2.test(model=net, test_dataloaders=test_loader, verbose=True)
-    trainer = Trainer.from_argparse_args(args, gpus=1)
-
-    outputs = trainer.predict(net, dataloaders=val_loader)
 
     # Calculate metric and visualize
     n_classes = net.out_channels
-    # print(n_classes)
-    post_pred = Compose([EnsureType(), AsDiscrete(argmax=True, to_onehot=True, n_classes=n_classes)])
-    save_pred = Compose([EnsureType(), AsDiscrete(argmax=True, to_onehot=False, n_classes=n_classes)])
-    post_label = Compose([EnsureType(), AsDiscrete(to_onehot=True, n_classes=n_classes)])
 
-    pred_saver = NiftiSaver(
+    saver_kwargs = dict(
         output_dir=args.output_dir,
         output_postfix=f"{args.model_name}_prediction",
         resample=False,
         data_root_dir=args.root_dir,
         output_dtype=np.uint8,
+        compresslevel=args.save_compression if args.save_compression >= 0 else None,
     )
+    pred_saver = AsyncNiftiSaver(num_workers=args.save_workers, **saver_kwargs)
 
-    dice_metric = DiceMetric(include_background=False, reduction="none", get_not_nans=False)
+    metrics = ConfusionMatrixMetrics(n_classes)
 
-    precision_metric = ConfusionMatrixMetric(
-        include_background=False, metric_name="precision", compute_sample=True, reduction="none", get_not_nans=False
-    )
-    sensitivity_metric = ConfusionMatrixMetric(
-        include_background=False, metric_name="sensitivity", compute_sample=True, reduction="none", get_not_nans=False
-    )
-
-    for i, data in enumerate(tqdm(val_loader)):
-        labels = data["label"]
-        # print(np.unique(labels))
-        val_outputs = outputs[i].cpu()
-        # print(np.unique(val_outputs))
-        if args.save_image:
-            if args.dataset == "iseg2017":
-                print("iseg2017")
-                # pred_saver.save_batch(
-                #     map_label(torch.stack([save_pred(i) for i in decollate_batch(val_outputs)]).cpu()),
-                #     meta_data={
-                #         "filename_or_obj": data["label_meta_dict"]["filename_or_obj"],
-                #         "original_affine": data["label_meta_dict"]["original_affine"],
-                #         "affine": data["label_meta_dict"]["affine"],
-                #     },
-                # )
-            else:
-                pred_saver.save_batch(
-                    torch.stack([save_pred(i) for i in decollate_batch(val_outputs)]),
-                    meta_data={
-                        "filename_or_obj": data["label_meta_dict"]["filename_or_obj"],
-                        "original_affine": data["label_meta_dict"]["original_affine"],
-                        "affine": data["label_meta_dict"]["affine"],
-                    },
-                )
-        val_outputs = [post_pred(val_output) for val_output in decollate_batch(val_outputs)]
-        labels = [post_label(label) for label in decollate_batch(labels)]
-
-        dice_metric(y_pred=val_outputs, y=labels)
-
-        precision_metric(y_pred=val_outputs, y=labels)
-        sensitivity_metric(y_pred=val_outputs, y=labels)
+    if args.eval_processes > 0:
+        results = evaluate_in_pool(
+            net,
+            data_module._load_data_dicts(),
+            data_module.val_transforms,
+            args.eval_processes,
+            num_threads=args.eval_threads,
+            numa=args.numa,
+            precision=args.precision,
+            saver_kwargs=saver_kwargs if args.save_image else None,
+            prob_dir=args.prob_dir,
+            prob_dtype=args.prob_dtype,
+        )
+        for matrix in results:
+            metrics.add(matrix)
+    else:
+        if args.tile_cache_dir:
+            net.tile_cache = TileCache(args.tile_cache_dir, max_bytes=int(args.tile_cache_size * 2 ** 30))
+        # Prediction, every volume is scored and saved as soon as it is predicted
+        writer = EvaluationWriter(
+            metrics,
+            pred_saver=pred_saver if args.save_image else None,
+            prob_dir=args.prob_dir,
+            prob_dtype=args.prob_dtype,
+        )
+        trainer = Trainer.from_argparse_args(args, gpus=1 if args.gpus is None else args.gpus, callbacks=[writer])
+        trainer.predict(net, dataloaders=val_loader, return_predictions=False)
+    pred_saver.close()
+    if getattr(net, "tile_cache", None) is not None:
+        print(net.tile_cache.report())
 
     if args.dataset == "iseg2017":
         reduction = "mean"
@@ -204,8 +276,23 @@ if __name__ == "__main__":
 
     # print(np.isnan(dice_metric.aggregate().cpu().numpy()).any())
     # print(reduction)
-    print_metric("dice", dice_metric.aggregate().cpu().numpy(), reduction=reduction)
-    print_metric("precision", precision_metric.aggregate()[0].cpu().numpy(), reduction=reduction)
-    print_metric("sensitivity", sensitivity_metric.aggregate()[0].cpu().numpy(), reduction=reduction)
+    print_metric("dice", metrics.aggregate("dice").cpu().numpy(), reduction=reduction)
+    print_metric("precision", metrics.aggregate("precision").cpu().numpy(), reduction=reduction)
+    print_metric("sensitivity", metrics.aggregate("sensitivity").cpu().numpy(), reduction=reduction)
+
+    if args.particle_gt_dir != "":
+        if not args.save_image:
+            raise ValueError("Particle scores need the saved predictions, set --save_image 1.")
+        data_dicts = data_module._load_data_dicts()
+        scores = score_predictions(
+            [pred_saver.output_path(d["label"]) for d in data_dicts],
+            [find_coordinates(args.particle_gt_dir, os.path.basename(d["label"]).split(".")[0]) for d in data_dicts],
+            classes=list(range(1, n_classes)),
+            radii=args.particle_radius,
+            class_names=args.particle_class_names,
+            min_size=args.particle_min_size,
+            reference_paths=[d["label"] for d in data_dicts],
+        )
+        print_particle_scores(scores)
 
     print("Finished Evaluation")
@@ -0,0 +1,26 @@
+import argparse
+
+from postprocess.matching import load_coordinates, particle_scores, print_particle_scores
+
+# Call example
+# python evaluate_particles.py --pred particles/tomo_particles.csv --gt data/shrec/model_9/particle_locations.txt \
+#     --class_names background 3cf3 1s3x 1u6g 4cr2 1qvr 3h84 2cg9 3qm1 3gl1 3d2f 4d8q 1bxn --radius 6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pred", type=str, required=True, help="Predicted particle list (.csv / .star / .txt)")
+    parser.add_argument("--gt", type=str, required=True, help="Ground-truth particle list (.csv / .star / .txt)")
+    parser.add_argument("--classes", nargs="+", type=int, default=None,
+                        help="Classes to score, defaults to every foreground class of the ground truth")
+    parser.add_argument("--radius", nargs="+", type=float, default=[5.0], help="Matching radius in voxels, per class")
+    parser.add_argument("--class_names", nargs="+", type=str, default=None,
+                        help="Class names of the particle lists, background first")
+    args = parser.parse_args()
+
+    pred = load_coordinates(args.pred, class_names=args.class_names)
+    gt = load_coordinates(args.gt, class_names=args.class_names)
+    radii = args.radius[0] if len(args.radius) == 1 else args.radius
+    scores = particle_scores(pred, gt, radii, classes=args.classes)
+    print(scores.to_string())
+    print_particle_scores(scores)
@@ -0,0 +1,31 @@
+from __future__ import absolute_import, division, print_function
+
+from monai.transforms import AddChanneld, Compose, LoadImaged, Orientationd, ScaleIntensityd, ToTensord
+
+
+def image_transforms():
+    """
+    The validation transforms of the datamodules restricted to the "image" key, for
+    tomograms without a label.
+    """
+    return Compose(
+        [
+            LoadImaged(keys=["image"], reader="NibabelReader"),
+            AddChanneld(keys=["image"]),
+            Orientationd(keys=["image"], axcodes="LPI"),
+            ScaleIntensityd(keys=["image"], minv=0.0, maxv=1.0),
+            ToTensord(keys=["image"]),
+        ]
+    )
+
+
+def image_meta(data):
+    """
+    The meta data NiftiSaver needs to write a prediction of a transformed image.
+    """
+    meta = data["image_meta_dict"]
+    return {
+        "filename_or_obj": meta["filename_or_obj"],
+        "original_affine": meta["original_affine"],
+        "affine": meta["affine"],
+    }
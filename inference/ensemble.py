@@ -0,0 +1,114 @@
+from __future__ import absolute_import, division, print_function
+
+import copy
+
+import pytorch_lightning as pl
+from monai.inferers import sliding_window_inference
+from torch import nn
+
+from inference.models import load_model
+
+try:
+    from torch.func import functional_call, stack_module_state, vmap
+except ImportError:
+    # torch < 2.0
+    functional_call = stack_module_state = vmap = None
+
+# Messages of the RuntimeError raised by vmap for the operations it cannot batch
+VMAP_UNSUPPORTED = ("vmap", "Batching rule not implemented", "batching rule")
+
+
+class EnsembleModule(pl.LightningModule):
+    """
+    Averages the logits of K trained models of the same architecture on every window.
+    The ensemble runs one sliding window inference, so the input is read and windowed once and
+    every batch of windows goes through all K members. On CUDA with `torch.func` (torch >= 2.0)
+    the member parameters are stacked and the K forward passes run as one `vmap` call,
+    otherwise the members run one after the other on the same batch, which is faster on CPU.
+    Members whose forward pass cannot be vectorized fall back to the loop.
+    Args:
+        members: list of LightningModules with `forward`, `out_channels`, `val_patch_size`,
+            `sw_batch_size` and `overlap`. The sliding window parameters of the first member are used.
+        vectorize: stack the member parameters and `vmap` the forward passes on CUDA when available.
+    Usage:
+        net = load_ensemble("ucaps", ["fold_0.ckpt", "fold_1.ckpt", "fold_2.ckpt"], val_patch_size=[64, 64, 64])
+        logits = net.predict_step({"image": images}, 0)
+    """
+
+    def __init__(self, members, vectorize=True):
+        super().__init__()
+        self.members = nn.ModuleList(members)
+        self.in_channels = members[0].in_channels
+        self.out_channels = members[0].out_channels
+        self.val_patch_size = members[0].val_patch_size
+        self.sw_batch_size = members[0].sw_batch_size
+        self.overlap = members[0].overlap
+        self.vectorize = vectorize and vmap is not None and len(members) > 1
+        # Optional inference.tile_cache.TileCache of predict_step
+        self.tile_cache = None
+        self._stacked = None
+        self._vmap_supported = False
+
+    def _stacked_forward(self, x):
+        # Stacked copies of the member weights, made once per device
+        if self._stacked is None or self._stacked[0].device != x.device:
+            params, buffers = stack_module_state(list(self.members))
+            base = copy.deepcopy(self.members[0]).to("meta")
+            self._stacked = (next(iter(params.values())), base, params, buffers)
+        _, base, params, buffers = self._stacked
+
+        def member_forward(member_params, member_buffers):
+            return functional_call(base, (member_params, member_buffers), (x,))
+
+        return vmap(member_forward)(params, buffers).mean(dim=0)
+
+    def forward(self, x):
+        if self.vectorize and x.is_cuda:
+            if self._vmap_supported:
+                return self._stacked_forward(x)
+            # First call, the loop takes over only when vmap cannot batch the member forward
+            try:
+                logits = self._stacked_forward(x)
+            except RuntimeError as error:
+                if not any(message in str(error) for message in VMAP_UNSUPPORTED):
+                    raise
+                self._stacked = None
+                self.vectorize = False
+            else:
+                self._vmap_supported = True
+                return logits
+        logits = self.members[0](x)
+        for member in self.members[1:]:
+            logits = logits + member(x)
+        return logits / len(self.members)
+
+    def predict_step(self, batch, batch_idx, dataloader_idx=None):
+        images = batch["image"]
+        outputs = sliding_window_inference(
+            images,
+            roi_size=self.val_patch_size,
+            sw_batch_size=self.sw_batch_size,
+            predictor=self.forward if self.tile_cache is None else self.tile_cache.predictor(self, self.forward),
+            overlap=self.overlap,
+        )
+        return outputs
+
+
+def load_ensemble(model_name, checkpoint_paths, routing_stride=None, routing_topk=None, **kwargs):
+    """
+    Loads an `EnsembleModule` of the checkpoints of a `--model_name` in evaluation mode.
+    `routing_stride` and `routing_topk` are set on every capsule member, see `UCaps3D.set_routing_stride`
+    and `UCaps3D.set_routing_topk`. Keyword arguments override the saved hyperparameters of every member,
+    as in `load_model`.
+    """
+    members = [load_model(model_name, checkpoint_path, **kwargs) for checkpoint_path in checkpoint_paths]
+    for member in members:
+        if member.out_channels != members[0].out_channels:
+            raise ValueError("The ensemble checkpoints must have the same number of classes.")
+        if routing_stride and hasattr(member, "set_routing_stride"):
+            member.set_routing_stride(routing_stride)
+        if routing_topk and hasattr(member, "set_routing_topk"):
+            member.set_routing_topk(routing_topk)
+    net = EnsembleModule(members)
+    net.eval()
+    return net
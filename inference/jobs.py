@@ -0,0 +1,350 @@
+from __future__ import absolute_import, division, print_function
+
+import glob
+import math
+import os
+import socket
+import sqlite3
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+from monai.data import list_data_collate
+from monai.utils import fall_back_tuple
+
+from inference.data import image_meta, image_transforms
+from inference.saver import AsyncNiftiSaver
+from inference.server import WindowBatcher
+from inference.slabs import _axis_slice, plan_slabs
+from inference.sliding_window import pad_to_roi
+from inference.store import StoreSink, open_stores
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT UNIQUE NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    voxels INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    output TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, id);
+"""
+
+
+def worker_name(rank):
+    return f"{socket.gethostname()}-{os.getpid()}-{rank}"
+
+
+def worker_alive(worker):
+    """
+    Whether the process of a `worker_name` is alive. Workers of other hosts are assumed alive.
+    """
+    fields = (worker or "").rsplit("-", 2)
+    if len(fields) != 3 or not fields[1].isdigit():
+        return False
+    if fields[0] != socket.gethostname():
+        return True
+    try:
+        os.kill(int(fields[1]), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Persistent queue of inference jobs, one per tomogram, in a SQLite database shared by the
+    scheduler and its worker processes.
+    Jobs are "queued", "running", "done" or "failed", and are claimed by decreasing priority,
+    then in submission order. Claims run in an immediate transaction, so concurrent workers
+    never get the same job.
+    Args:
+        db_path: path of the SQLite database, created if missing.
+        timeout: scalar, seconds to wait for the database lock of another process.
+    Usage:
+        queue = JobQueue("jobs.sqlite")
+        queue.scan("/data/tomograms/")
+        jobs = queue.claim("worker-0", pack_voxels=256 ** 3)
+        queue.finish(jobs[0]["id"], output="./output/tomo_ucaps_prediction.nii.gz")
+    """
+
+    def __init__(self, db_path, timeout=60.0):
+        self.connection = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def add(self, paths, priority=0):
+        """
+        Queues tomograms that are not in the queue yet. Returns the number of new jobs.
+        """
+        added = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO jobs (path, priority, voxels, submitted) VALUES (?, ?, ?, ?)",
+                (path, int(priority), int(np.prod(nib.load(path).shape)), time.time()),
+            )
+            added += cursor.rowcount
+        return added
+
+    def scan(self, input_dir, priority=0, settle=10.0):
+        """
+        Queues the NIfTI files of `input_dir` not modified in the last `settle` seconds, so files
+        still being written are picked up by a later scan.
+        """
+        now = time.time()
+        paths = [
+            path
+            for path in sorted(glob.glob(os.path.join(input_dir, "**", "*.nii*"), recursive=True))
+            if now - os.path.getmtime(path) >= settle
+        ]
+        return self.add(paths, priority=priority)
+
+    def add_manifest(self, manifest_path, priority=0):
+        """
+        Queues the tomograms of a manifest, one path per line optionally followed by a priority.
+        """
+        added = 0
+        with open(manifest_path) as f:
+            for line in f:
+                fields = line.split()
+                if fields and not fields[0].startswith("#"):
+                    added += self.add(fields[:1], priority=int(fields[1]) if len(fields) > 1 else priority)
+        return added
+
+    def requeue_running(self, lease=0):
+        """
+        Puts back in the queue the jobs left "running" by the dead workers of this host, and when
+        `lease` is set, the jobs of any host started more than `lease` seconds ago. The jobs of the
+        live workers of other schedulers are left running.
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            stale = [
+                (row["id"],)
+                for row in self.connection.execute("SELECT id, worker, started FROM jobs WHERE status = 'running'")
+                if not worker_alive(row["worker"]) or (lease and now - row["started"] > lease)
+            ]
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE id = ? AND status = 'running'", stale
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return len(stale)
+
+    def claim(self, worker, pack_voxels=0):
+        """
+        Claims the next job, packed with further queued jobs while their total size stays within
+        `pack_voxels`.
+        Returns:
+            List of job rows, empty when the queue is empty.
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.connection.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id"
+            ).fetchall()
+            jobs, total = [], 0
+            for row in rows:
+                if jobs and total + row["voxels"] > pack_voxels:
+                    if total >= pack_voxels:
+                        break
+                    continue
+                jobs.append(row)
+                total += row["voxels"]
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ?, attempts = attempts + 1 WHERE id = ?",
+                [(worker, now, row["id"]) for row in jobs],
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return [dict(row) for row in jobs]
+
+    def finish(self, job_id, output=None):
+        self.connection.execute(
+            "UPDATE jobs SET status = 'done', finished = ?, output = ?, error = NULL WHERE id = ?",
+            (time.time(), output, job_id),
+        )
+
+    def fail(self, job_id, error, max_attempts=1):
+        """
+        Records the error of a job and puts it back in the queue until it failed `max_attempts` times.
+        """
+        self.connection.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+            "finished = ?, error = ?, worker = NULL WHERE id = ?",
+            (max_attempts, time.time(), error, job_id),
+        )
+
+    def stats(self, window=3600.0):
+        """
+        Queue depth and the throughput of the jobs finished in the last `window` seconds.
+        Returns:
+            dict with the number of jobs and voxels per status, jobs/h, voxels/s, the mean
+            job latency (queued to done) and the ETA in seconds of the queued and running jobs.
+        """
+        stats = {}
+        for row in self.connection.execute("SELECT status, COUNT(*), SUM(voxels) FROM jobs GROUP BY status"):
+            stats[row[0]] = row[1]
+            stats[f"{row[0]}_voxels"] = row[2]
+        for status in ("queued", "running", "done", "failed"):
+            stats.setdefault(status, 0)
+            stats.setdefault(f"{status}_voxels", 0)
+
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT COUNT(*), SUM(voxels), MIN(started), AVG(finished - submitted) FROM jobs "
+            "WHERE status = 'done' AND finished >= ?",
+            (now - window,),
+        ).fetchone()
+        count, voxels, first_start, latency = row
+        elapsed = max(now - first_start, 1e-6) if count else 0
+        stats["jobs_per_hour"] = count * 3600 / elapsed if count else 0.0
+        stats["voxels_per_second"] = voxels / elapsed if count else 0.0
+        stats["mean_latency"] = latency
+        remaining = stats["queued_voxels"] + stats["running_voxels"]
+        stats["eta"] = remaining / stats["voxels_per_second"] if stats["voxels_per_second"] else None
+        return stats
+
+
+def format_stats(stats):
+    eta = "-" if stats["eta"] is None else f"{stats['eta'] / 3600:.2f}h"
+    return (
+        f"queued {stats['queued']}, running {stats['running']}, done {stats['done']}, failed {stats['failed']} | "
+        f"{stats['jobs_per_hour']:.1f} jobs/h, {stats['voxels_per_second'] / 1e6:.3g} Mvox/s, ETA {eta}"
+    )
+
+
+def predict_split(batcher, image, num_slabs):
+    """
+    Predicts the labels of an image [1, channels, *spatial] split into `num_slabs` slabs along
+    its longest axis, one slab at a time, so that only the logits of one slab are in memory.
+    The slabs follow `plan_slabs`, so the labels equal those of the whole image.
+    """
+    roi_size = fall_back_tuple(batcher.roi_size, image.shape[2:])
+    image, crop = pad_to_roi(image, roi_size)
+    axis = int(np.argmax(image.shape[2:]))
+    labels = torch.zeros([1, 1] + list(image.shape[2:]), dtype=torch.uint8)
+    for core, extent in plan_slabs(image.shape[2:], roi_size, batcher.overlap, num_slabs, axis):
+        logits = batcher.submit(image[_axis_slice(5, axis + 2, extent[0], extent[1])]).result()
+        logits = logits[_axis_slice(5, axis + 2, core[0] - extent[0], core[1] - extent[0])]
+        labels[_axis_slice(5, axis + 2, core[0], core[1])] = torch.argmax(logits, dim=1, keepdim=True)
+    return labels[(slice(None), slice(None)) + crop]
+
+
+def run_worker(
+    rank,
+    db_path,
+    model_name,
+    checkpoint_path,
+    model_kwargs,
+    num_threads,
+    cpus,
+    output_dir,
+    root_dir="",
+    prob_dir="",
+    pack_voxels=0,
+    split_voxels=0,
+    max_attempts=1,
+    poll=0,
+):
+    """
+    Worker process of the scheduler. Loads the model once, then claims and runs jobs until the
+    queue is empty, or forever polling every `poll` seconds when `poll` is set.
+    The tomograms of a packed claim are submitted together to a `WindowBatcher`, so the windows
+    of small tomograms share forward batches. Tomograms over `split_voxels` are predicted slab by
+    slab with `predict_split`, their probability stores are not written.
+    """
+    from inference.models import load_model
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    worker = worker_name(rank)
+    queue = JobQueue(db_path)
+    net = load_model(model_name, checkpoint_path, **model_kwargs)
+    batcher = WindowBatcher(net, net.val_patch_size, net.sw_batch_size, net.overlap, max_wait=0)
+    transforms = image_transforms()
+    pred_saver = AsyncNiftiSaver(
+        num_workers=1,
+        output_dir=output_dir,
+        output_postfix=f"{model_name}_prediction",
+        resample=False,
+        data_root_dir=root_dir,
+        output_dtype=np.uint8,
+    )
+
+    try:
+        while True:
+            jobs = queue.claim(worker, pack_voxels=pack_voxels)
+            if not jobs:
+                if not poll:
+                    break
+                time.sleep(poll)
+                continue
+
+            pending = []
+            for job in jobs:
+                try:
+                    data = list_data_collate([transforms({"image": job["path"]})])
+                    if split_voxels and job["voxels"] > split_voxels:
+                        num_slabs = math.ceil(job["voxels"] / split_voxels)
+                        pending.append((job, data, predict_split(batcher, data["image"], num_slabs), None))
+                    elif prob_dir:
+                        # The probability store is written as the windows are blended
+                        shape = data["image"].shape[2:]
+                        sink = StoreSink(open_stores(prob_dir, net.out_channels, shape, image_meta(data)), shape)
+                        pending.append((job, data, batcher.submit(data["image"], sink=sink), sink))
+                    else:
+                        pending.append((job, data, batcher.submit(data["image"]), None))
+                except Exception as error:
+                    queue.fail(job["id"], repr(error), max_attempts=max_attempts)
+
+            saved = []
+            for job, data, result, sink in pending:
+                try:
+                    if isinstance(result, torch.Tensor):
+                        labels = result
+                    elif sink is not None:
+                        result.result()
+                        labels = sink.close()
+                    else:
+                        labels = torch.argmax(result.result(), dim=1, keepdim=True)
+                    pred_saver.save_batch(labels, meta_data=image_meta(data))
+                    saved.append(job)
+                except Exception as error:
+                    queue.fail(job["id"], repr(error), max_attempts=max_attempts)
+
+            # A job is done once its labels are on disk
+            try:
+                pred_saver.flush()
+            except Exception as error:
+                for job in saved:
+                    queue.fail(job["id"], repr(error), max_attempts=max_attempts)
+            else:
+                for job in saved:
+                    queue.finish(job["id"], output=pred_saver.output_path(job["path"]))
+    finally:
+        batcher.close()
+        pred_saver.close()
+        queue.close()
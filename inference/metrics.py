@@ -0,0 +1,111 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+from monai.metrics.confusion_matrix import compute_confusion_matrix_metric
+from monai.metrics.utils import do_metric_reduction
+
+
+def confusion_matrix(preds, labels, n_classes, chunk_size=1 << 24):
+    """
+    Computes the confusion matrix of every sample from integer class maps with `torch.bincount`.
+    Args:
+        preds: integer tensor of shape [batch, 1, *spatial] or [batch, *spatial], e.g. the argmax
+            of the logits.
+        labels: tensor of the same number of voxels holding the class indices.
+        n_classes: scalar, number of classes.
+        chunk_size: scalar, number of voxels counted per `bincount` call, which bounds the
+            temporary int64 index buffer for large volumes.
+    Returns:
+        Int64 tensor of shape [batch, n_classes, n_classes], rows are labels and columns are
+        predictions.
+    """
+    batch_size = preds.shape[0]
+    preds = preds.reshape(batch_size, -1)
+    labels = labels.reshape(batch_size, -1)
+    if preds.shape != labels.shape:
+        raise ValueError("preds and labels should have the same number of voxels.")
+
+    matrices = torch.zeros(batch_size, n_classes * n_classes, dtype=torch.int64, device=preds.device)
+    for b in range(batch_size):
+        for start in range(0, preds.shape[1], chunk_size):
+            index = labels[b, start : start + chunk_size].long() * n_classes
+            index += preds[b, start : start + chunk_size].long()
+            matrices[b] += torch.bincount(index, minlength=n_classes * n_classes)
+    return matrices.view(batch_size, n_classes, n_classes)
+
+
+def confusion_counts(matrices):
+    """
+    Converts confusion matrices [batch, n_classes, n_classes] to the one-vs-rest
+    `[tp, fp, tn, fn]` counts [batch, n_classes, 4] of `monai.metrics.ConfusionMatrixMetric`.
+    """
+    matrices = matrices.double()
+    tp = torch.diagonal(matrices, dim1=1, dim2=2)
+    fp = matrices.sum(dim=1) - tp
+    fn = matrices.sum(dim=2) - tp
+    tn = matrices.sum(dim=(1, 2))[:, None] - tp - fp - fn
+    return torch.stack([tp, fp, tn, fn], dim=-1)
+
+
+class ConfusionMatrixMetrics:
+    """
+    Cumulative segmentation metrics computed from class maps through confusion matrices.
+    Replaces `DiceMetric` and `ConfusionMatrixMetric` on one-hot tensors: a single `bincount`
+    pass per volume produces the full matrix, and dice, precision, sensitivity or any other
+    `ConfusionMatrixMetric` name are derived from the cumulated matrices with the same nan
+    semantics and reductions as monai.
+    Args:
+        n_classes: scalar, number of classes.
+        include_background: whether to report the first class or not.
+        chunk_size: scalar, number of voxels counted per `bincount` call.
+    Usage:
+        metrics = ConfusionMatrixMetrics(n_classes)
+        metrics(torch.argmax(logits, dim=1, keepdim=True), labels)
+        dice = metrics.aggregate("dice")  # [volumes, classes]
+    """
+
+    def __init__(self, n_classes, include_background=False, chunk_size=1 << 24):
+        self.n_classes = n_classes
+        self.include_background = include_background
+        self.chunk_size = chunk_size
+        self._buffer = []
+
+    def __call__(self, preds, labels):
+        """
+        Adds the confusion matrices of a batch of class maps and returns them.
+        """
+        matrices = confusion_matrix(preds, labels, self.n_classes, chunk_size=self.chunk_size)
+        self.add(matrices)
+        return matrices
+
+    def add(self, matrices):
+        """
+        Adds precomputed confusion matrices of shape [batch, n_classes, n_classes].
+        """
+        self._buffer.append(matrices)
+
+    def reset(self):
+        self._buffer = []
+
+    def get_buffer(self):
+        return torch.cat(self._buffer, dim=0)
+
+    def aggregate(self, metric_name="dice", reduction="none"):
+        """
+        Computes `metric_name` for every cumulated volume and class, then reduces it with
+        `monai.metrics.utils.do_metric_reduction`.
+        Returns:
+            Tensor of shape [volumes, classes] for `reduction="none"`. Entries are nan where the
+            metric is undefined, e.g. the dice of a class absent from the label.
+        """
+        counts = confusion_counts(self.get_buffer())
+        if not self.include_background:
+            counts = counts[:, 1:]
+        if metric_name == "dice":
+            tp, fp, _, fn = counts.unbind(dim=-1)
+            nan = torch.tensor(float("nan"), dtype=counts.dtype, device=counts.device)
+            f = torch.where(tp + fn > 0, 2.0 * tp / (2.0 * tp + fp + fn), nan)
+        else:
+            f = compute_confusion_matrix_metric(metric_name, counts)
+        f, _ = do_metric_reduction(f.float(), reduction)
+        return f
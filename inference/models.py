@@ -0,0 +1,55 @@
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+
+import torch
+from module.multi_ucaps import MultiUCaps3D
+from module.segcaps import SegCaps2D, SegCaps3D
+from module.ucaps import UCaps3D
+from module.unet import UNetModule
+
+MODELS = {
+    "ucaps": UCaps3D,
+    "ucaps-multi": MultiUCaps3D,
+    "segcaps-2d": SegCaps2D,
+    "segcaps-3d": SegCaps3D,
+    "unet": UNetModule,
+}
+
+
+def load_model(model_name, checkpoint_path, **kwargs):
+    """
+    Loads a trained LightningModule by its `--model_name` in evaluation mode.
+    Keyword arguments override the saved hyperparameters, e.g. `val_patch_size`,
+    `sw_batch_size` and `overlap`.
+    """
+    if model_name not in MODELS:
+        raise ValueError(f"Unknown model {model_name}, expected one of {', '.join(MODELS)}.")
+    net = MODELS[model_name].load_from_checkpoint(checkpoint_path, **kwargs)
+    net.eval()
+    return net
+
+
+def check_precision(precision):
+    """
+    Raises a ValueError for a Trainer `--precision` that `autocast` cannot run on this torch:
+    "bf16" and 16 need `torch.autocast`, i.e. torch >= 1.10.
+    """
+    if str(precision) in ("bf16", "16") and not hasattr(torch, "autocast"):
+        raise ValueError(
+            f"--precision {precision} needs torch >= 1.10 for torch.autocast, found torch {torch.__version__}. "
+            "Use --precision 32."
+        )
+
+
+def autocast(precision, device_type="cpu"):
+    """
+    Autocast context of a Trainer `--precision` for predictions made outside the Trainer:
+    "bf16" runs the convolutions in bfloat16 and 16 in float16, the capsule routing stays in float32.
+    A no-op context for 32 and 64.
+    """
+    check_precision(precision)
+    precision = str(precision)
+    if precision not in ("bf16", "16"):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=torch.bfloat16 if precision == "bf16" else torch.float16)
@@ -0,0 +1,161 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import threading
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+from inference.sliding_window import WindowBlender, pad_to_roi, scan_windows
+from monai.utils import fall_back_tuple
+
+UCAPS_STAGES = ("feature_extractor", "encode_capsules", "decode")
+
+
+def _stage_worker(net, stage, num_threads, cpus, inbox, outbox):
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(num_threads)
+        net.eval()
+        fn = getattr(net, stage)
+        with torch.no_grad():
+            while True:
+                item = inbox.get()
+                if item is None:
+                    break
+                index, x = item
+                if isinstance(index, str):
+                    outbox.put(item)
+                    continue
+                y = fn(*x) if isinstance(x, tuple) else fn(x)
+                outbox.put((index, y))
+    except Exception:
+        outbox.put(("error", f"stage {stage} failed:\n{traceback.format_exc()}"))
+    finally:
+        outbox.put(None)
+
+
+class StagePipeline:
+    """
+    Pipeline-parallel CPU inference executor.
+    Every stage of the model runs in its own process with its own thread budget (and cpus when
+    there are enough of them). Stages are connected by bounded queues of window batches, so
+    while the decoder works on one batch, the capsule encoder and the feature extractor already
+    process the next ones.
+    Args:
+        net: the model, every stage is a method or submodule of it taking the outputs of the
+            previous stage.
+        stages: sequence of attribute names of the stages, in order.
+        stage_threads: sequence of torch thread counts, one per stage.
+        queue_size: scalar, maximum number of window batches waiting in front of every stage.
+    Usage:
+        with StagePipeline(net, stage_threads=(4, 8, 4)) as pipeline:
+            logits = pipeline(images, roi_size=(32, 32, 32), sw_batch_size=8, overlap=0.5)
+    """
+
+    def __init__(self, net, stages=UCAPS_STAGES, stage_threads=None, queue_size=2):
+        cpus = sorted(os.sched_getaffinity(0))
+        if stage_threads is None:
+            stage_threads = [max(len(cpus) // len(stages), 1)] * len(stages)
+        if len(stage_threads) != len(stages):
+            raise ValueError("stage_threads must give a thread count for every stage.")
+
+        ctx = mp.get_context("spawn")
+        self.queues = [ctx.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self.workers = []
+        offset = 0
+        for i, (stage, num_threads) in enumerate(zip(stages, stage_threads)):
+            stage_cpus = cpus[offset : offset + num_threads] if sum(stage_threads) <= len(cpus) else None
+            offset += num_threads
+            worker = ctx.Process(
+                target=_stage_worker,
+                args=(net, stage, num_threads, stage_cpus, self.queues[i], self.queues[i + 1]),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self, terminate=False):
+        if self.workers:
+            if terminate:
+                for worker in self.workers:
+                    worker.terminate()
+            else:
+                self.queues[0].put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+
+    def map(self, batches):
+        """
+        Runs the window batches of the iterable `batches` through the stages.
+        Yields the outputs of the last stage in order.
+        """
+        error = []
+
+        def feed():
+            try:
+                for index, batch in enumerate(batches):
+                    self.queues[0].put((index, batch))
+            except Exception:
+                error.append(traceback.format_exc())
+            self.queues[0].put(("end", None))
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        while True:
+            item = self.queues[-1].get()
+            if item is None:
+                self.close(terminate=True)
+                raise RuntimeError("The inference pipeline stopped unexpectedly.")
+            index, y = item
+            if index == "error":
+                self.close(terminate=True)
+                raise RuntimeError(y)
+            if index == "end":
+                break
+            yield y
+        feeder.join()
+        if error:
+            raise RuntimeError(error[0])
+
+    def __call__(
+        self, inputs, roi_size, sw_batch_size=1, overlap=0.25, mode="constant", sigma_scale=0.125, sink=None
+    ):
+        """
+        Sliding window inference through the pipeline, with the windows and blending of
+        `sliding_window_inference`. With a `sink`, the blended output is passed to it slab by slab
+        and None is returned, see `WindowBlender`.
+        """
+        roi_size = fall_back_tuple(roi_size, inputs.shape[2:])
+        inputs, crop = pad_to_roi(inputs, roi_size)
+        image_size = list(inputs.shape[2:])
+        windows = scan_windows(image_size, roi_size, overlap)
+        slices = [(b, window) for window in windows for b in range(inputs.shape[0])]
+        groups = [slices[g : g + sw_batch_size] for g in range(0, len(slices), sw_batch_size)]
+
+        def batches():
+            for group in groups:
+                yield torch.cat([inputs[(slice(b, b + 1), slice(None)) + window] for b, window in group])
+
+        blender = WindowBlender(
+            inputs.shape[0],
+            image_size,
+            roi_size,
+            mode=mode,
+            sigma_scale=sigma_scale,
+            device=inputs.device,
+            sink=sink,
+            crop=crop,
+        )
+        for i, seg_prob in enumerate(self.map(batches())):
+            for (b, window), prob in zip(groups[i], seg_prob):
+                blender.add(window, prob, batch_index=b)
+        return blender.result(crop)
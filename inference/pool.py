@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function
+
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import torch
+from inference.metrics import ConfusionMatrixMetrics
+from inference.models import autocast, check_precision
+from inference.saver import AsyncNiftiSaver
+from inference.store import predict_probabilities
+from inference.writer import EvaluationWriter
+from monai.data import list_data_collate
+
+
+def parse_cpulist(cpulist):
+    """
+    Parses a linux cpu list such as "0-3,8-11" into a list of cpu ids.
+    """
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            start, stop = part.split("-")
+            cpus.extend(range(int(start), int(stop) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_cpus():
+    """
+    Lists the cpus of every NUMA node of this host, or a single node with all usable cpus
+    when the topology is not exposed.
+    """
+    nodes = []
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.search(r"node(\d+)", p).group(1))):
+        with open(path) as f:
+            cpus = parse_cpulist(f.read())
+        if cpus:
+            nodes.append(cpus)
+    if not nodes:
+        nodes.append(sorted(os.sched_getaffinity(0)))
+    return nodes
+
+
+def worker_cpus(num_processes, numa=False):
+    """
+    Splits the usable cpus between `num_processes` workers.
+    Without `numa` every worker gets an equal share of the cpus of this process. With `numa`
+    workers are assigned round-robin to NUMA nodes and split the cpus of their node.
+    Returns:
+        List of cpu id lists, one per worker.
+    """
+    if numa:
+        nodes = numa_cpus()
+    else:
+        nodes = [sorted(os.sched_getaffinity(0))]
+
+    assignment = []
+    for rank in range(num_processes):
+        node = nodes[rank % len(nodes)]
+        num_sharing = len(range(rank % len(nodes), num_processes, len(nodes)))
+        share = np.array_split(node, num_sharing)[rank // len(nodes)]
+        assignment.append([int(cpu) for cpu in share] if len(share) > 0 else list(node))
+    return assignment
+
+
+def _evaluate_shard(net, items, transforms, num_threads, cpus, saver_kwargs, prob_dir, prob_dtype, precision):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    net.eval()
+
+    pred_saver = AsyncNiftiSaver(num_workers=0, **saver_kwargs) if saver_kwargs is not None else None
+    writer = EvaluationWriter(
+        ConfusionMatrixMetrics(net.out_channels), pred_saver=pred_saver, prob_dir=prob_dir, prob_dtype=prob_dtype
+    )
+
+    results = []
+    for index, item in items:
+        data = list_data_collate([transforms(item)])
+        with torch.no_grad(), autocast(precision):
+            if prob_dir:
+                # The probability stores are written as the windows are blended
+                labels = predict_probabilities(
+                    net, data["image"], prob_dir, data["label_meta_dict"], dtype=prob_dtype
+                )
+                results.append((index, writer.write_labels(labels, data).cpu()))
+                continue
+            val_outputs = net.predict_step(data, index)
+        results.append((index, writer.write(val_outputs, data).cpu()))
+    return results
+
+
+def evaluate_in_pool(
+    net,
+    data_dicts,
+    transforms,
+    num_processes,
+    num_threads=None,
+    numa=False,
+    saver_kwargs=None,
+    prob_dir=None,
+    prob_dtype="float16",
+    precision=32,
+):
+    """
+    Evaluates `net` on `data_dicts` with `num_processes` worker processes.
+    The datalist is sharded round-robin. Every worker receives its own replica of `net`, pins
+    itself to its share of the cpus and runs `torch.set_num_threads` with that share, then
+    loads, predicts, saves and scores its volumes independently.
+    Args:
+        net: LightningModule with `predict_step` and `out_channels`.
+        data_dicts: list of data dicts with "image" and "label" keys.
+        transforms: the validation transforms of the datamodule.
+        num_processes: scalar, number of worker processes.
+        num_threads: scalar, torch threads per worker. Defaults to the number of cpus of the worker.
+        numa: pin the workers to NUMA nodes or not.
+        saver_kwargs: keyword arguments of `AsyncNiftiSaver` to save the predictions, or None to skip saving.
+        prob_dir: directory of the probability stores, or None to skip them.
+        prob_dtype: "float16" or "uint8", dtype of the stored probabilities.
+        precision: Trainer `--precision` of the predictions, see `inference.models.autocast`.
+    Returns:
+        List of confusion matrices of shape [1, n_classes, n_classes] per volume in datalist order,
+        to be added to `ConfusionMatrixMetrics`.
+    """
+    check_precision(precision)
+    cpus = worker_cpus(num_processes, numa=numa)
+    items = list(enumerate(data_dicts))
+    with ProcessPoolExecutor(max_workers=num_processes, mp_context=get_context("spawn")) as executor:
+        futures = [
+            executor.submit(
+                _evaluate_shard,
+                net,
+                items[rank::num_processes],
+                transforms,
+                num_threads if num_threads else len(cpus[rank]),
+                cpus[rank],
+                saver_kwargs,
+                prob_dir,
+                prob_dtype,
+                precision,
+            )
+            for rank in range(num_processes)
+        ]
+        results = [result for future in futures for result in future.result()]
+
+    results.sort(key=lambda result: result[0])
+    return [matrix for _, matrix in results]
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from monai.data import NiftiSaver
+from monai.data.utils import create_file_basename
+from nibabel.openers import Opener
+
+
+class AsyncNiftiSaver:
+    """
+    `NiftiSaver` writing the volumes of `save_batch` in background threads.
+    Every volume is copied to host memory together with its meta data and queued, so the caller
+    continues with the next volume while the previous ones are compressed and written. gzip
+    compression in zlib releases the GIL, so `num_workers` volumes are compressed in parallel.
+    Errors of the writes are raised by the next `save_batch`, `flush` or `close` call.
+    Args:
+        num_workers: scalar, number of writer threads, 0 to write synchronously.
+        compresslevel: gzip level 1-9, 0 to write uncompressed ".nii" files, None for the nibabel
+            default. The level is a process-wide nibabel setting.
+        max_pending: scalar, maximum number of queued volumes before `save_batch` blocks.
+            Defaults to `2 * num_workers`.
+        saver_kwargs: keyword arguments of `NiftiSaver`.
+    Usage:
+        with AsyncNiftiSaver(num_workers=2, output_dir="./output/", output_dtype=np.uint8) as saver:
+            for batch in loader:
+                saver.save_batch(preds, meta_data=batch["label_meta_dict"])
+    """
+
+    def __init__(self, num_workers=2, compresslevel=None, max_pending=None, **saver_kwargs):
+        if compresslevel == 0:
+            saver_kwargs["output_ext"] = ".nii"
+        elif compresslevel is not None:
+            Opener.default_compresslevel = compresslevel
+        self.saver = NiftiSaver(**saver_kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max_pending or 2 * max(num_workers, 1))
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def output_path(self, filename):
+        """
+        Path of the file written for the input `filename`.
+        """
+        saver = self.saver
+        basename = create_file_basename(saver.output_postfix, filename, saver.output_dir, saver.data_root_dir)
+        return f"{basename}{saver.output_ext}"
+
+    def _write(self, data, meta_data):
+        try:
+            self.saver.save(data, meta_data)
+        finally:
+            self.slots.release()
+
+    def _check(self):
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    def save(self, data, meta_data=None):
+        """
+        Queues one volume of shape [channels, *spatial] for writing.
+        """
+        if isinstance(data, torch.Tensor):
+            data = data.detach().cpu().numpy()
+        if self.executor is None:
+            self.saver.save(data, meta_data)
+            return
+        self._check()
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._write, data, meta_data))
+
+    def save_batch(self, batch_data, meta_data=None):
+        """
+        Queues every volume of a batch, same arguments as `NiftiSaver.save_batch`.
+        """
+        for i, data in enumerate(batch_data):
+            self.save(data, {k: meta_data[k][i] for k in meta_data} if meta_data is not None else None)
+
+    def flush(self):
+        """
+        Waits for the queued volumes to be written and raises the first write error.
+        """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
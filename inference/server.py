@@ -0,0 +1,286 @@
+from __future__ import absolute_import, division, print_function
+
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import torch
+from monai.data import list_data_collate
+from monai.utils import fall_back_tuple
+
+from inference.data import image_meta, image_transforms
+from inference.saver import AsyncNiftiSaver
+from inference.sliding_window import WindowBlender, pad_to_roi, scan_windows
+from inference.store import StoreSink, open_stores
+
+
+class WindowJob:
+    """
+    Sliding window inference of one image [1, channels, *spatial], fed window by window to
+    a `WindowBatcher`. With a `sink`, the blended logits are passed to it slab by slab, see
+    `WindowBlender`, and the result is None.
+    """
+
+    def __init__(self, image, roi_size, overlap, sink=None):
+        self.image, self.crop = pad_to_roi(image, roi_size)
+        self.slices = scan_windows(self.image.shape[2:], roi_size, overlap)
+        self.blender = WindowBlender(
+            1, self.image.shape[2:], roi_size, device=torch.device("cpu"), sink=sink, crop=self.crop
+        )
+        self.issued = 0
+        self.remaining = len(self.slices)
+        self.done = threading.Event()
+        self.error = None
+        self.output = None
+
+    def next_window(self):
+        window = self.slices[self.issued]
+        self.issued += 1
+        return window
+
+    def add(self, window, prob):
+        self.blender.add(window, prob.cpu())
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.output = self.blender.result(self.crop)
+            self.blender = None
+            self.done.set()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+
+class WindowBatcher:
+    """
+    Runs the sliding window inference of concurrent requests on one model in a single thread,
+    packing the windows of every pending image into shared batches of up to `sw_batch_size`.
+    Windows are taken round-robin across the images, so a small tomogram submitted behind a
+    large one is not queued after all of its windows. When fewer windows than a full batch are
+    pending, the worker waits up to `max_wait` seconds for other requests to join the batch.
+    Args:
+        net: model in evaluation mode, called on batches of windows.
+        roi_size: sequence of ints, spatial window size.
+        sw_batch_size: scalar, maximum number of windows per forward pass.
+        overlap: scalar, amount of overlap between neighbouring windows.
+        max_wait: scalar, seconds to wait for a fuller batch.
+        device: device of the model.
+    Usage:
+        batcher = WindowBatcher(net, net.val_patch_size, sw_batch_size=8, overlap=0.75)
+        logits = batcher.submit(image).result()
+        batcher.close()
+    """
+
+    def __init__(self, net, roi_size, sw_batch_size=1, overlap=0.25, max_wait=0.005, device=None):
+        self.net = net
+        self.roi_size = roi_size
+        self.sw_batch_size = sw_batch_size
+        self.overlap = overlap
+        self.max_wait = max_wait
+        self.device = device or next(net.parameters()).device
+        self.jobs = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.stats = {"requests": 0, "windows": 0, "batches": 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, sink=None):
+        """
+        Queues an image of shape [1, channels, *spatial] and returns its `WindowJob`, whose
+        `result()` blocks until the logits [1, out_channels, *spatial] are ready, or until they
+        have all been passed to `sink`.
+        """
+        job = WindowJob(image.cpu(), fall_back_tuple(self.roi_size, image.shape[2:]), self.overlap, sink=sink)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The batcher is closed.")
+            self.jobs.append(job)
+            self.stats["requests"] += 1
+            self.condition.notify()
+        return job
+
+    def _pending_windows(self):
+        return sum(len(job.slices) - job.issued for job in self.jobs)
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.jobs and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return None
+            deadline = time.monotonic() + self.max_wait
+            while self._pending_windows() < self.sw_batch_size and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+
+            batch = []
+            while len(batch) < self.sw_batch_size and self.jobs:
+                for job in list(self.jobs):
+                    if len(batch) == self.sw_batch_size:
+                        break
+                    batch.append((job, job.next_window()))
+                    if job.issued == len(job.slices):
+                        self.jobs.remove(job)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                windows = torch.cat(
+                    [job.image[(slice(None), slice(None)) + tuple(window)] for job, window in batch]
+                ).to(self.device)
+                with torch.no_grad():
+                    probs = self.net(windows)
+                for (job, window), prob in zip(batch, probs):
+                    job.add(window, prob)
+            except Exception as error:
+                failed = {id(job): job for job, _ in batch}
+                with self.condition:
+                    for job in failed.values():
+                        if job in self.jobs:
+                            self.jobs.remove(job)
+                for job in failed.values():
+                    job.fail(error)
+            with self.condition:
+                self.stats["windows"] += len(batch)
+                self.stats["batches"] += 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            jobs, self.jobs = self.jobs, []
+            self.condition.notify_all()
+        for job in jobs:
+            job.fail(RuntimeError("The batcher is closed."))
+        self.thread.join()
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    HTTP server keeping warm models, each behind its own `WindowBatcher`.
+    Every request is handled in its own thread: loading and transforming the tomogram and
+    writing the outputs overlap with the inference of the other requests.
+    Endpoints:
+        GET /health: JSON of the models and the batching statistics.
+        POST /predict: JSON {"path", "model", "output_dir", "prob_dir"}. Predicts a tomogram
+            file and writes its labels (and probability store) to disk, replies the JSON
+            {"output", "seconds"}.
+        POST /predict_array?model=<name>&output=labels|logits: body is a .npy array
+            [*spatial] or [channels, *spatial] already scaled to [0, 1], replies the .npy
+            uint8 labels or float16 logits.
+    Args:
+        address: (host, port) tuple.
+        models: dict of model name to `WindowBatcher`.
+        output_dir: default output directory of /predict.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, models, output_dir="./output/"):
+        self.models = models
+        self.output_dir = output_dir
+        self.transforms = image_transforms()
+        super().__init__(address, InferenceHandler)
+
+    def server_close(self):
+        super().server_close()
+        for batcher in self.models.values():
+            batcher.close()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    def _reply(self, code, body, content_type="application/json"):
+        if content_type == "application/json":
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _batcher(self, name):
+        if name is None and len(self.server.models) == 1:
+            return next(iter(self.server.models.items()))
+        if name not in self.server.models:
+            raise KeyError(f"Unknown model {name}, expected one of {', '.join(self.server.models)}.")
+        return name, self.server.models[name]
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            self._reply(404, {"error": f"Unknown endpoint {self.path}"})
+            return
+        self._reply(200, {name: dict(batcher.stats) for name, batcher in self.server.models.items()})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if url.path == "/predict":
+                self._predict(json.loads(body))
+            elif url.path == "/predict_array":
+                self._predict_array(body, {k: v[0] for k, v in parse_qs(url.query).items()})
+            else:
+                self._reply(404, {"error": f"Unknown endpoint {url.path}"})
+        except (KeyError, ValueError) as error:
+            self._reply(400, {"error": str(error)})
+        except Exception as error:
+            self._reply(500, {"error": repr(error)})
+
+    def _predict(self, request):
+        start = time.time()
+        name, batcher = self._batcher(request.get("model"))
+        data = list_data_collate([self.server.transforms({"image": request["path"]})])
+        meta_data = image_meta(data)
+        if request.get("prob_dir"):
+            # The probability store is written as the windows are blended
+            sink = StoreSink(
+                open_stores(request["prob_dir"], batcher.net.out_channels, data["image"].shape[2:], meta_data),
+                data["image"].shape[2:],
+            )
+            batcher.submit(data["image"], sink=sink).result()
+            labels = sink.close()
+        else:
+            labels = torch.argmax(batcher.submit(data["image"]).result(), dim=1, keepdim=True)
+
+        saver = AsyncNiftiSaver(
+            num_workers=0,
+            output_dir=request.get("output_dir") or self.server.output_dir,
+            output_postfix=f"{name}_prediction",
+            resample=False,
+            output_dtype=np.uint8,
+        )
+        saver.save_batch(labels, meta_data=meta_data)
+        self._reply(
+            200, {"output": saver.output_path(request["path"]), "seconds": round(time.time() - start, 3)}
+        )
+
+    def _predict_array(self, body, query):
+        _, batcher = self._batcher(query.get("model"))
+        array = np.load(io.BytesIO(body), allow_pickle=False)
+        image = torch.as_tensor(array, dtype=torch.float32)
+        image = image[None, None] if image.ndim == 3 else image[None]
+        logits = batcher.submit(image).result()
+
+        if query.get("output", "labels") == "logits":
+            output = logits[0].to(torch.float16).numpy()
+        else:
+            output = torch.argmax(logits[0], dim=0).to(torch.uint8).numpy()
+        buffer = io.BytesIO()
+        np.save(buffer, output)
+        self._reply(200, buffer.getvalue(), content_type="application/octet-stream")
+
+    def log_message(self, format, *args):
+        pass
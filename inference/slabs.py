@@ -0,0 +1,140 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+import socket
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from inference.sliding_window import pad_to_roi, scan_windows
+from monai.utils import fall_back_tuple
+
+
+def plan_slabs(image_size, roi_size, overlap, num_slabs, axis):
+    """
+    Splits a volume into slabs along `axis` for independent sliding window inference.
+    Every slab owns a core range of the volume and is extended by a halo to the windows of the
+    full-volume sliding window grid that touch its core. The sliding window grid of the extended
+    slab then coincides with the full-volume grid, so the stitched cores are identical to
+    running `sliding_window_inference` on the whole volume.
+    Args:
+        image_size: sequence of ints, spatial size of the (padded) image.
+        roi_size: sequence of ints, spatial window size.
+        overlap: scalar, amount of overlap between neighbouring windows.
+        num_slabs: scalar, number of slabs.
+        axis: scalar, spatial axis to split.
+    Returns:
+        List of `((core_start, core_stop), (extent_start, extent_stop))` tuples.
+    """
+    roi = roi_size[axis]
+    starts = sorted({window[axis].start for window in scan_windows(image_size, roi_size, overlap)})
+    bounds = np.linspace(0, image_size[axis], num_slabs + 1).round().astype(int)
+
+    slabs = []
+    for core_start, core_stop in zip(bounds[:-1], bounds[1:]):
+        covering = [start for start in starts if start < core_stop and start + roi > core_start]
+        if core_stop > core_start:
+            slabs.append(((int(core_start), int(core_stop)), (int(covering[0]), int(covering[-1]) + roi)))
+    return slabs
+
+
+def _axis_slice(ndim, axis, start, stop):
+    index = [slice(None)] * ndim
+    index[axis] = slice(start, stop)
+    return tuple(index)
+
+
+def predict_slab(net, slab, core, extent, axis):
+    """
+    Runs `net.predict_step` on an extended slab and returns the argmax labels of its core.
+    """
+    with torch.no_grad():
+        logits = net.predict_step({"image": slab}, 0)
+    logits = logits[_axis_slice(logits.dim(), axis + 2, core[0] - extent[0], core[1] - extent[0])]
+    return torch.argmax(logits, dim=1, keepdim=True).to(torch.uint8)
+
+
+def distributed_slab_inference(net, image=None, axis=None):
+    """
+    Sliding window inference of a single volume split into one slab per rank of the default
+    `torch.distributed` process group (gloo).
+    Rank 0 holds the image, sends every rank its slab including the halo, predicts its own slab
+    and receives the label cores of the other ranks. All ranks must call this function.
+    Args:
+        net: LightningModule with `predict_step`, `val_patch_size` and `overlap`.
+        image: tensor of shape [1, channels, *spatial] on rank 0, ignored on other ranks.
+        axis: scalar, spatial axis to split. Defaults to the longest axis.
+    Returns:
+        The uint8 label volume of shape [1, 1, *spatial] on rank 0 and None on other ranks.
+    """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+
+    header = torch.zeros(5, dtype=torch.int64)
+    if rank == 0:
+        roi_size = fall_back_tuple(net.val_patch_size, image.shape[2:])
+        image, crop = pad_to_roi(image.float(), roi_size)
+        if axis is None:
+            axis = int(np.argmax(image.shape[2:]))
+        header[:4] = torch.tensor(image.shape[1:])
+        header[4] = axis
+    dist.broadcast(header, src=0)
+    channels, image_size, axis = int(header[0]), [int(s) for s in header[1:4]], int(header[4])
+    roi_size = fall_back_tuple(net.val_patch_size, image_size)
+    slabs = plan_slabs(image_size, roi_size, net.overlap, world_size, axis)
+
+    def slab_shape(extent):
+        shape = [1, channels] + list(image_size)
+        shape[axis + 2] = extent[1] - extent[0]
+        return shape
+
+    def core_shape(core):
+        shape = [1, 1] + list(image_size)
+        shape[axis + 2] = core[1] - core[0]
+        return shape
+
+    if rank == 0:
+        for dst in range(1, len(slabs)):
+            _, extent = slabs[dst]
+            dist.send(image[_axis_slice(5, axis + 2, extent[0], extent[1])].contiguous(), dst=dst)
+        core, extent = slabs[0]
+        labels = torch.zeros([1, 1] + list(image_size), dtype=torch.uint8)
+        slab = image[_axis_slice(5, axis + 2, extent[0], extent[1])]
+        labels[_axis_slice(5, axis + 2, core[0], core[1])] = predict_slab(net, slab, core, extent, axis)
+        for src in range(1, len(slabs)):
+            core, _ = slabs[src]
+            core_labels = torch.empty(core_shape(core), dtype=torch.uint8)
+            dist.recv(core_labels, src=src)
+            labels[_axis_slice(5, axis + 2, core[0], core[1])] = core_labels
+        return labels[(slice(None), slice(None)) + crop]
+
+    if rank < len(slabs):
+        core, extent = slabs[rank]
+        slab = torch.empty(slab_shape(extent), dtype=torch.float32)
+        dist.recv(slab, src=0)
+        dist.send(predict_slab(net, slab, core, extent, axis), dst=0)
+    return None
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _local_worker(rank, world_size, port, fn, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_local(fn, num_processes, *args):
+    """
+    Runs `fn(*args)` in `num_processes` local processes joined in a gloo process group, so that
+    multi-host code paths can be run and tested on one machine.
+    """
+    mp.spawn(_local_worker, args=(num_processes, _free_port(), fn, args), nprocs=num_processes, join=True)
@@ -0,0 +1,177 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+import torch.nn.functional as F
+from monai.data.utils import compute_importance_map, dense_patch_slices, get_valid_patch_size
+from monai.utils import fall_back_tuple
+
+
+def pad_to_roi(inputs, roi_size, padding_mode="constant", cval=0.0):
+    """
+    Pads `inputs` symmetrically so that every spatial dimension is at least `roi_size`,
+    the same way `monai.inferers.sliding_window_inference` does.
+    Args:
+        inputs: tensor of shape [batch, channels, *spatial].
+        roi_size: sequence of ints, spatial window size.
+        padding_mode: padding mode passed to torch.nn.functional.pad.
+        cval: fill value for constant padding.
+    Returns:
+        The padded tensor and a tuple of slices cropping the padded spatial dims back
+        to the original image.
+    """
+    image_size = inputs.shape[2:]
+    pad_size, crop = [], []
+    for size, roi in zip(image_size, roi_size):
+        diff = max(roi - size, 0)
+        half = diff // 2
+        crop.append(slice(half, half + size))
+        pad_size = [half, diff - half] + pad_size
+    if any(pad_size):
+        inputs = F.pad(inputs, pad=pad_size, mode=padding_mode, value=cval)
+    return inputs, tuple(crop)
+
+
+def scan_windows(image_size, roi_size, overlap):
+    """
+    Lists the window slices visited by `sliding_window_inference` for an image.
+    Args:
+        image_size: sequence of ints, spatial size of the (padded) image.
+        roi_size: sequence of ints, spatial window size.
+        overlap: scalar, amount of overlap between neighbouring windows.
+    Returns:
+        List of tuples of spatial slices, in the same order as monai.
+    """
+    if overlap < 0 or overlap >= 1:
+        raise AssertionError("overlap must be >= 0 and < 1.")
+    scan_interval = []
+    for size, roi in zip(image_size, roi_size):
+        if roi == size:
+            scan_interval.append(int(roi))
+        else:
+            interval = int(roi * (1 - overlap))
+            scan_interval.append(interval if interval > 0 else 1)
+    return dense_patch_slices(image_size, roi_size, scan_interval)
+
+
+class WindowBlender:
+    """
+    Blends window predictions into a full-size output with the importance map of
+    `sliding_window_inference`.
+    With a `sink`, the output is not kept whole: only the planes along the first spatial axis that
+    windows still to come overlap are held, one window thick, and the finished planes are passed
+    to `sink(output, start)` as the blended slab [batch, channels, planes, *rest] and its first
+    plane in the cropped image. The windows must then be added in the order of `scan_windows`,
+    every image of a window before the next window.
+    Args:
+        batch_size: scalar, number of images.
+        image_size: sequence of ints, spatial size of the (padded) image.
+        roi_size: sequence of ints, spatial window size.
+        mode: blending mode of overlapping windows, "constant" or "gaussian".
+        sigma_scale: standard deviation coefficient of the gaussian blending window.
+        device: device of the output.
+        sink: callable receiving the finished slabs, or None to keep the whole output.
+        crop: spatial slices of the image in the padded image, cropping the slabs passed to `sink`.
+    """
+
+    def __init__(
+        self, batch_size, image_size, roi_size, mode="constant", sigma_scale=0.125, device=None, sink=None, crop=None
+    ):
+        self.batch_size = batch_size
+        self.image_size = list(image_size)
+        self.device = device
+        self.sink = sink
+        self.crop = crop
+        self.importance_map = compute_importance_map(
+            get_valid_patch_size(image_size, roi_size), mode=mode, sigma_scale=sigma_scale, device=device
+        )
+        # Spatial size of the kept output and its first plane along the first spatial axis
+        self.size = [min(roi_size[0], self.image_size[0])] + self.image_size[1:] if sink else self.image_size
+        self.offset = 0
+        self.output_image = None
+        self.count_map = torch.zeros([1, 1] + self.size, dtype=torch.float32, device=device)
+
+    def add(self, window, prob, batch_index=0):
+        """
+        Adds the prediction `prob` of shape [channels, *roi_size] at the spatial slices `window`.
+        The windows of every image must be added in the same order.
+        """
+        if self.output_image is None:
+            self.output_image = torch.zeros(
+                [self.batch_size, prob.shape[0]] + self.size, dtype=torch.float32, device=self.device
+            )
+        if self.sink is not None:
+            # Planes before the first window of a new row are covered by no later window
+            if window[0].start > self.offset:
+                self._flush(window[0].start)
+            window = (slice(window[0].start - self.offset, window[0].stop - self.offset),) + tuple(window[1:])
+        self.output_image[(batch_index, slice(None)) + tuple(window)] += self.importance_map * prob.to(self.device)
+        if batch_index == 0:
+            self.count_map[(0, 0) + tuple(window)] += self.importance_map
+
+    def _flush(self, stop):
+        # Passes the planes up to `stop` to the sink and shifts the kept output to start at `stop`
+        planes = stop - self.offset
+        crop = self.crop or [slice(0, size) for size in self.image_size]
+        start, end = max(self.offset, crop[0].start), min(stop, crop[0].stop)
+        if start < end:
+            output = self.output_image[:, :, start - self.offset : end - self.offset]
+            output = output / self.count_map[:, :, start - self.offset : end - self.offset]
+            self.sink(output[(slice(None), slice(None), slice(None)) + tuple(crop[1:])], int(start - crop[0].start))
+        for buffer in (self.output_image, self.count_map):
+            buffer[:, :, : buffer.shape[2] - planes] = buffer[:, :, planes:].clone()
+            buffer[:, :, buffer.shape[2] - planes :] = 0
+        self.offset = stop
+
+    def result(self, crop=None):
+        """
+        Returns the blended output, cropped to the spatial slices `crop` if given.
+        With a sink, passes the remaining planes to it and returns None.
+        """
+        if self.sink is not None:
+            self._flush(self.image_size[0])
+            return None
+        output_image = self.output_image / self.count_map
+        if crop is not None:
+            output_image = output_image[(slice(None), slice(None)) + tuple(crop)]
+        return output_image
+
+
+def streamed_inference(
+    inputs, predictor, roi_size, sink, sw_batch_size=1, overlap=0.25, mode="constant", sigma_scale=0.125
+):
+    """
+    Sliding window inference passing the blended output to `sink` slab by slab along the first
+    spatial axis, see `WindowBlender`, instead of returning it. The windows and blending are those
+    of `sliding_window_inference`, but only one window-thick slab of the output is ever allocated.
+    Args:
+        inputs: tensor of shape [batch, channels, *spatial].
+        predictor: callable running the model on a batch of windows.
+        roi_size: sequence of ints, spatial window size.
+        sink: callable receiving the blended slabs [batch, out_channels, planes, *rest] and their
+            first plane.
+        sw_batch_size: scalar, number of windows per `predictor` call.
+        overlap: scalar, amount of overlap between neighbouring windows.
+        mode: blending mode of overlapping windows, "constant" or "gaussian".
+        sigma_scale: standard deviation coefficient of the gaussian blending window.
+    """
+    roi_size = fall_back_tuple(roi_size, inputs.shape[2:])
+    inputs, crop = pad_to_roi(inputs, roi_size)
+    image_size = list(inputs.shape[2:])
+    slices = [(b, window) for window in scan_windows(image_size, roi_size, overlap) for b in range(inputs.shape[0])]
+
+    blender = WindowBlender(
+        inputs.shape[0],
+        image_size,
+        roi_size,
+        mode=mode,
+        sigma_scale=sigma_scale,
+        device=inputs.device,
+        sink=sink,
+        crop=crop,
+    )
+    for g in range(0, len(slices), sw_batch_size):
+        group = slices[g : g + sw_batch_size]
+        seg_prob = predictor(torch.cat([inputs[(slice(b, b + 1), slice(None)) + tuple(window)] for b, window in group]))
+        for (b, window), prob in zip(group, seg_prob):
+            blender.add(window, prob, batch_index=b)
+    blender.result()
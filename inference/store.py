@@ -0,0 +1,276 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from inference.sliding_window import streamed_inference
+from monai.utils import optional_import
+
+zarr, _ = optional_import("zarr")
+Blosc, _ = optional_import("numcodecs", name="Blosc")
+
+
+def store_name(filename):
+    """
+    Name of the prediction store of an input file, e.g. "tomo.nii.gz" -> "tomo.zarr".
+    """
+    name = os.path.basename(str(filename))
+    for ext in (".nii.gz", ".nii", ".mrc", ".rec"):
+        if name.endswith(ext):
+            return name[: -len(ext)] + ".zarr"
+    return os.path.splitext(name)[0] + ".zarr"
+
+
+def open_stores(prob_dir, n_classes, image_size, meta_data, dtype="float16"):
+    """
+    Creates the `PredictionStore` of every volume of a batch in `prob_dir`, named after the
+    "filename_or_obj" of the batched `meta_data`.
+    """
+    return [
+        PredictionStore(
+            os.path.join(prob_dir, store_name(filename)),
+            n_classes=n_classes,
+            image_size=image_size,
+            dtype=dtype,
+            meta_data={key: meta_data[key][i] for key in ("filename_or_obj", "affine", "original_affine")},
+        )
+        for i, filename in enumerate(meta_data["filename_or_obj"])
+    ]
+
+
+def save_probabilities(prob_dir, logits, meta_data, dtype="float16"):
+    """
+    Writes the `PredictionStore` of every volume of a batch of logits [batch, n_classes, *spatial]
+    to `prob_dir`, named after the "filename_or_obj" of the batched `meta_data`.
+    `predict_probabilities` writes the stores while predicting instead, without the whole logit volume.
+    """
+    logits = logits.detach()
+    sink = StoreSink(open_stores(prob_dir, logits.shape[1], logits.shape[2:], meta_data, dtype), logits.shape[2:])
+    step = sink.stores[0].chunks[0]
+    for start in range(0, logits.shape[2], step):
+        sink(logits[:, :, start : start + step], start)
+    sink.close()
+
+
+def predict_probabilities(net, images, prob_dir, meta_data, dtype="float16"):
+    """
+    Sliding window inference of `net` on `images` [batch, channels, *spatial] writing the
+    `PredictionStore` of every volume as the blended logits are produced, see `streamed_inference`,
+    so the logit volume is never held whole. SegCaps2D in slice inference mode is predicted whole
+    with `predict_step` first.
+    Returns:
+        The uint8 argmax labels of shape [batch, 1, *spatial].
+    """
+    if hasattr(net, "slice_inference") and net._uses_slice_inference():
+        logits = net.predict_step({"image": images}, 0)
+        save_probabilities(prob_dir, logits, meta_data, dtype=dtype)
+        return torch.argmax(logits, dim=1, keepdim=True).to(torch.uint8).cpu()
+    stores = open_stores(prob_dir, net.out_channels, images.shape[2:], meta_data, dtype)
+    sink = StoreSink(stores, images.shape[2:])
+    tile_cache = getattr(net, "tile_cache", None)
+    predictor = net if tile_cache is None else tile_cache.predictor(net)
+    streamed_inference(images, predictor, net.val_patch_size, sink, net.sw_batch_size, net.overlap)
+    return sink.close()
+
+
+class StoreSink:
+    """
+    `WindowBlender` sink writing blended logit slabs [batch, n_classes, planes, *rest] to the
+    `PredictionStore` of every volume of the batch, and keeping their uint8 argmax labels.
+    The softmax of the slabs is gathered up to the next chunk boundary along the first spatial
+    axis before it is written, so every chunk is compressed once.
+    Args:
+        stores: list of `PredictionStore`, one per volume of the batch.
+        image_size: sequence of ints, spatial size of the volumes.
+    Usage:
+        sink = StoreSink(open_stores(prob_dir, n_classes, images.shape[2:], meta_data), images.shape[2:])
+        streamed_inference(images, net, net.val_patch_size, sink)
+        labels = sink.close()
+    """
+
+    def __init__(self, stores, image_size):
+        self.stores = stores
+        self.labels = torch.zeros([len(stores), 1] + [int(s) for s in image_size], dtype=torch.uint8)
+        self.pending = []
+        self.start = 0
+
+    def __call__(self, logits, start):
+        probs = torch.softmax(logits.float(), dim=1).cpu()
+        stop = start + probs.shape[2]
+        self.labels[:, :, start:stop] = torch.argmax(probs, dim=1, keepdim=True)
+        self.pending.append(probs)
+        step = self.stores[0].chunks[0]
+        self._write(stop // step * step)
+
+    def _write(self, stop):
+        # Writes the pending probabilities up to the plane `stop`
+        if stop <= self.start:
+            return
+        probs = torch.cat(self.pending, dim=2) if len(self.pending) > 1 else self.pending[0]
+        for store, volume in zip(self.stores, probs[:, :, : stop - self.start]):
+            store.write_region(volume, (self.start, 0, 0))
+        self.pending = [probs[:, :, stop - self.start :]] if stop - self.start < probs.shape[2] else []
+        self.start = stop
+
+    def close(self):
+        """
+        Writes the remaining planes and the pyramids. Returns the labels [batch, 1, *spatial].
+        """
+        self._write(self.labels.shape[2])
+        for store in self.stores:
+            store.build_pyramid()
+        return self.labels
+
+
+class PredictionStore:
+    """
+    Chunked, compressed zarr store of the class probabilities and labels of one volume.
+    Layout of the zarr group:
+        probabilities/<level>: [n_classes, *spatial] float16, or uint8 quantized to 1/255 steps.
+        labels/<level>: [*spatial] uint8 argmax labels.
+    Level 0 is full resolution and every further level is downsampled by 2 along every axis,
+    probabilities by averaging and labels by the argmax of the averaged probabilities.
+    The arrays are in the space of the transformed input (after `Orientationd`), the group
+    attributes keep its `affine` and `original_affine`.
+    Args:
+        path: path of the zarr directory.
+        n_classes: scalar, number of classes.
+        image_size: sequence of ints, spatial size of the volume.
+        dtype: "float16" or "uint8" for the probabilities.
+        chunks: sequence of ints, spatial chunk size.
+        levels: scalar, number of pyramid levels including the full resolution.
+        meta_data: dict with optional "filename_or_obj", "affine" and "original_affine".
+        clevel: scalar, zstd compression level.
+    Usage:
+        store = PredictionStore("tomo.zarr", n_classes=3, image_size=logits.shape[1:])
+        store.write_logits(logits)
+        store.build_pyramid()
+        labels = PredictionStore.open("tomo.zarr").relabel([0.5, 0.7], level=1)
+    """
+
+    def __init__(
+        self,
+        path,
+        n_classes,
+        image_size,
+        dtype="float16",
+        chunks=(64, 64, 64),
+        levels=3,
+        meta_data=None,
+        clevel=3,
+    ):
+        if dtype not in ("float16", "uint8"):
+            raise ValueError("dtype must be float16 or uint8.")
+        self.group = zarr.open_group(path, mode="w")
+        self.dtype = dtype
+        self.chunks = tuple(int(c) for c in chunks)
+        compressor = Blosc(cname="zstd", clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+
+        size = [int(s) for s in image_size]
+        for level in range(levels):
+            self.group.create_dataset(
+                f"probabilities/{level}",
+                shape=[n_classes] + size,
+                chunks=(1,) + self.chunks,
+                dtype=dtype,
+                compressor=compressor,
+            )
+            self.group.create_dataset(
+                f"labels/{level}", shape=size, chunks=self.chunks, dtype="uint8", compressor=compressor
+            )
+            size = [(s + 1) // 2 for s in size]
+
+        meta_data = meta_data or {}
+        self.group.attrs.update(
+            {
+                "n_classes": int(n_classes),
+                "levels": int(levels),
+                "dtype": dtype,
+                "scale": 1.0 / 255 if dtype == "uint8" else 1.0,
+                "filename": str(meta_data.get("filename_or_obj", "")),
+                "affine": np.asarray(meta_data.get("affine", np.eye(4))).tolist(),
+                "original_affine": np.asarray(meta_data.get("original_affine", np.eye(4))).tolist(),
+            }
+        )
+
+    @staticmethod
+    def open(path):
+        """
+        Opens an existing store read-only.
+        """
+        return PredictionReader(zarr.open_group(path, mode="r"))
+
+    def _encode(self, probs):
+        if self.dtype == "uint8":
+            return (probs * 255).round().to(torch.uint8).cpu().numpy()
+        return probs.to(torch.float16).cpu().numpy()
+
+    def write_region(self, probs, start, level=0):
+        """
+        Writes probabilities of shape [n_classes, *size] at the spatial offset `start`, and
+        their argmax labels.
+        """
+        region = tuple(slice(s, s + n) for s, n in zip(start, probs.shape[1:]))
+        self.group[f"probabilities/{level}"][(slice(None),) + region] = self._encode(probs)
+        self.group[f"labels/{level}"][region] = torch.argmax(probs, dim=0).to(torch.uint8).cpu().numpy()
+
+    def write_logits(self, logits):
+        """
+        Writes the softmax of a logit volume [n_classes, *spatial] slab by slab along the first
+        spatial axis, so only one chunk-thick slab of float32 probabilities exists at a time.
+        """
+        step = self.chunks[0]
+        for start in range(0, logits.shape[1], step):
+            probs = torch.softmax(logits[:, start : start + step].float(), dim=0)
+            self.write_region(probs, (start, 0, 0))
+
+    def build_pyramid(self):
+        """
+        Fills the downsampled levels from level 0, one slab of chunks at a time.
+        """
+        scale = self.group.attrs["scale"]
+        for level in range(1, self.group.attrs["levels"]):
+            source = self.group[f"probabilities/{level - 1}"]
+            step = 2 * self.chunks[0]
+            for start in range(0, source.shape[1], step):
+                probs = torch.from_numpy(source[:, start : start + step].astype(np.float32) * scale)
+                probs = F.avg_pool3d(probs[None], kernel_size=2, ceil_mode=True)[0]
+                self.write_region(probs, (start // 2, 0, 0), level=level)
+
+
+class PredictionReader:
+    """
+    Read access to a `PredictionStore`, returning float32 probabilities whatever the stored dtype.
+    Regions are tuples of spatial slices.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.attrs = group.attrs
+
+    def probabilities(self, region=(), level=0):
+        array = self.group[f"probabilities/{level}"]
+        return array[(slice(None),) + tuple(region)].astype(np.float32) * self.attrs["scale"]
+
+    def probability(self, class_index, region=(), level=0):
+        array = self.group[f"probabilities/{level}"]
+        return array[(class_index,) + tuple(region)].astype(np.float32) * self.attrs["scale"]
+
+    def labels(self, region=(), level=0):
+        return self.group[f"labels/{level}"][tuple(region)]
+
+    def relabel(self, thresholds, region=(), level=0):
+        """
+        Re-derives labels with per-class probability thresholds, without rerunning the model.
+        Every voxel gets the most probable foreground class whose probability reaches its
+        threshold, or background.
+        Args:
+            thresholds: sequence of floats, one per foreground class.
+        """
+        probs = self.probabilities(region, level)[1:]
+        probs = np.where(probs >= np.asarray(thresholds, dtype=np.float32).reshape(-1, 1, 1, 1), probs, 0)
+        labels = np.argmax(probs, axis=0).astype(np.uint8) + 1
+        labels[probs.max(axis=0) == 0] = 0
+        return labels
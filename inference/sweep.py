@@ -0,0 +1,181 @@
+from __future__ import absolute_import, division, print_function
+
+import glob
+import os
+import queue
+import traceback
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.multiprocessing as mp
+
+from inference.metrics import ConfusionMatrixMetrics, confusion_matrix
+from inference.models import autocast, check_precision, load_model
+from inference.pool import worker_cpus
+
+SWEEP_METRICS = ("dice", "precision", "sensitivity")
+
+
+def list_checkpoints(patterns):
+    """
+    Expands checkpoint globs, sorted and without duplicates.
+    """
+    paths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+
+def _score_volume(nets, batch, index, precision):
+    matrices = []
+    with torch.no_grad(), autocast(precision):
+        for net in nets:
+            logits = net.predict_step(batch, index)
+            preds = torch.argmax(logits, dim=1, keepdim=True)
+            matrices.append(confusion_matrix(preds, batch["label"], net.out_channels).cpu())
+            del logits, preds
+    return matrices
+
+
+def _sweep_worker(rank, model_name, checkpoint_paths, model_kwargs, precision, num_threads, cpus, inputs, outputs):
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(num_threads)
+        nets = [load_model(model_name, path, **model_kwargs) for path in checkpoint_paths]
+        while True:
+            item = inputs.get()
+            if item is None:
+                return
+            index, image, label = item
+            outputs.put((rank, index, _score_volume(nets, {"image": image, "label": label}, index, precision)))
+    except Exception:
+        outputs.put((rank, "error", f"sweep worker {rank} failed:\n{traceback.format_exc()}"))
+
+
+def _receive(outputs, workers, results, poll=1.0):
+    """
+    Stores the next result of the sweep workers in `results`, and raises the error of a failed
+    worker, or a RuntimeError when a worker died without reporting one, e.g. killed out of memory.
+    """
+    while True:
+        try:
+            rank, volume, matrices = outputs.get(timeout=poll)
+        except queue.Empty:
+            if all(worker.is_alive() for worker in workers):
+                continue
+            # A worker that failed exits right after its error, which may still be in flight
+            try:
+                rank, volume, matrices = outputs.get(timeout=poll)
+            except queue.Empty:
+                raise RuntimeError("A checkpoint sweep worker stopped unexpectedly.") from None
+        if volume == "error":
+            raise RuntimeError(matrices)
+        results[(rank, volume)] = matrices
+        return
+
+
+def sweep_checkpoints(
+    model_name, checkpoint_paths, loader, model_kwargs, num_processes=0, num_threads=0, numa=False, precision=32
+):
+    """
+    Evaluates several checkpoints of a model while reading every validation volume once.
+    Sequentially, all checkpoints are loaded in this process and predict every batch of `loader`
+    in turn. With `num_processes`, the checkpoints are split between worker processes pinned to
+    their share of the cpus. Every volume is then moved to shared memory once and handed to all
+    workers, which only receive its handle.
+    Args:
+        model_name: `--model_name` of the checkpoints.
+        checkpoint_paths: list of checkpoint paths.
+        loader: validation dataloader yielding "image" and "label" batches.
+        model_kwargs: keyword arguments of `load_model`, e.g. `val_patch_size`.
+        num_processes: scalar, number of worker processes, 0 to evaluate in this process.
+        num_threads: scalar, torch threads per worker. Defaults to the number of cpus of the worker.
+        numa: pin the workers to NUMA nodes or not.
+        precision: Trainer `--precision` of the predictions, see `inference.models.autocast`.
+    Returns:
+        List of `ConfusionMatrixMetrics`, one per checkpoint.
+    """
+    check_precision(precision)
+    if num_processes == 0:
+        nets = [load_model(model_name, path, **model_kwargs) for path in checkpoint_paths]
+        metrics = [ConfusionMatrixMetrics(net.out_channels) for net in nets]
+        for index, batch in enumerate(loader):
+            for metric, matrix in zip(metrics, _score_volume(nets, batch, index, precision)):
+                metric.add(matrix)
+        return metrics
+
+    num_processes = min(num_processes, len(checkpoint_paths))
+    shards = [list(range(len(checkpoint_paths)))[rank::num_processes] for rank in range(num_processes)]
+    cpus = worker_cpus(num_processes, numa=numa)
+    context = mp.get_context("spawn")
+    outputs = context.Queue()
+    inputs = [context.Queue() for _ in range(num_processes)]
+    workers = [
+        context.Process(
+            target=_sweep_worker,
+            args=(
+                rank,
+                model_name,
+                [checkpoint_paths[i] for i in shards[rank]],
+                model_kwargs,
+                precision,
+                num_threads if num_threads else len(cpus[rank]),
+                cpus[rank],
+                inputs[rank],
+                outputs,
+            ),
+        )
+        for rank in range(num_processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    results, index = {}, -1
+    try:
+        for index, batch in enumerate(loader):
+            image, label = batch["image"].share_memory_(), batch["label"].share_memory_()
+            for worker_inputs in inputs:
+                worker_inputs.put((index, image, label))
+            # Keep at most one further volume in flight, so memory stays at two volumes
+            while len(results) < (index - 1) * num_processes:
+                _receive(outputs, workers, results)
+        while len(results) < (index + 1) * num_processes:
+            _receive(outputs, workers, results)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker_inputs in inputs:
+            worker_inputs.put(None)
+        for worker in workers:
+            worker.join()
+
+    metrics = [None] * len(checkpoint_paths)
+    for (rank, volume), matrices in sorted(results.items(), key=lambda item: item[0][1]):
+        for i, matrix in zip(shards[rank], matrices):
+            if metrics[i] is None:
+                metrics[i] = ConfusionMatrixMetrics(matrix.shape[-1])
+            metrics[i].add(matrix)
+    return metrics
+
+
+def sweep_table(checkpoint_paths, metrics, reduction="mean", metric_names=SWEEP_METRICS):
+    """
+    One row per checkpoint and metric, with the per-class scores reduced over the volumes by
+    `reduction` ("mean" or "median") and their mean over the classes.
+    """
+    reduce = np.nanmedian if reduction == "median" else np.nanmean
+    rows = []
+    for path, metric in zip(checkpoint_paths, metrics):
+        for name in metric_names:
+            scores = reduce(metric.aggregate(name).cpu().numpy(), axis=0)
+            row = {"checkpoint": path, "metric": name}
+            row.update({f"class {c + 1}": score for c, score in enumerate(scores)})
+            row["mean"] = np.nanmean(scores)
+            rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,203 @@
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import os
+import pickle
+import tempfile
+import weakref
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_digest(tensor, digest=None):
+    """
+    Updates a hashlib digest with the shape, dtype and bytes of a tensor.
+    """
+    digest = digest or hashlib.sha256()
+    tensor = tensor.detach().cpu().contiguous()
+    digest.update(f"{tuple(tensor.shape)}{tensor.dtype}".encode())
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.float()
+    digest.update(tensor.numpy().tobytes())
+    return digest
+
+
+# model -> (version of its weights, hash of its weights)
+_weights_digests = weakref.WeakKeyDictionary()
+
+
+def _weights_digest(net):
+    """
+    Hash of the class and weights of a model. It is computed again only when the storage or the version
+    counter of a weight changed, i.e. after a `load_state_dict` or an in-place update.
+    """
+    state_dict = net.state_dict(keep_vars=True)
+    version = tuple((name, tensor.data_ptr(), tensor._version) for name, tensor in state_dict.items())
+    if net in _weights_digests and _weights_digests[net][0] == version:
+        return _weights_digests[net][1]
+
+    digest = hashlib.sha256(type(net).__name__.encode())
+    for name, tensor in sorted(state_dict.items()):
+        digest.update(name.encode())
+        tensor_digest(tensor, digest)
+    _weights_digests[net] = (version, digest.hexdigest())
+    return _weights_digests[net][1]
+
+
+# Hyperparameters of the sliding window, which change the tiles but not the logits of a tile
+SLIDING_WINDOW_HPARAMS = ("val_patch_size", "sw_batch_size", "overlap")
+# Module attributes set after construction that change the logits, e.g. by `set_routing_stride`
+OUTPUT_ATTRIBUTES = ("routing_stride", "routing_topk", "skip_precision")
+
+
+def model_digest(net):
+    """
+    Hash of the class and weights of a model and of every setting that changes its logits: the
+    hyperparameters of the model and its submodules other than the sliding window ones, e.g.
+    `num_routing` or `skip_precision`, and the `OUTPUT_ATTRIBUTES` of its modules, e.g. the
+    routing approximations of the capsule layers.
+    """
+    digest = hashlib.sha256(_weights_digest(net).encode())
+    for name, module in net.named_modules():
+        hparams = getattr(module, "hparams", None) or {}
+        for key in sorted(hparams):
+            if key not in SLIDING_WINDOW_HPARAMS:
+                digest.update(f"{name}.hparams.{key}={hparams[key]!r}".encode())
+        for attribute in OUTPUT_ATTRIBUTES:
+            if hasattr(module, attribute):
+                digest.update(f"{name}.{attribute}={getattr(module, attribute)!r}".encode())
+    return digest.hexdigest()
+
+
+class TileCache:
+    """
+    On-disk cache of the logits of sliding window tiles.
+    A tile is keyed by the hash of the model weights, the hash of the tile content and shape
+    (which includes `val_patch_size`) and the inference precision (parameter dtype and autocast
+    state), so resumed or repeated runs of the same tomograms skip the tiles already computed,
+    and any change of the model or of the inputs misses. Entries are evicted in least recently
+    used order when the cache grows over `max_bytes`.
+    Args:
+        cache_dir: directory of the cache, shared by successive runs.
+        max_bytes: scalar, maximum size of the cache on disk.
+    Usage:
+        cache = TileCache("./tile_cache/", max_bytes=50 * 2 ** 30)
+        outputs = sliding_window_inference(images, roi_size, sw_batch_size, cache.predictor(net), overlap)
+        print(cache.report())
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # path -> size, least recently used first
+        entries = []
+        for root, _, files in os.walk(cache_dir):
+            for name in files:
+                if name.endswith(".pt"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, os.path.join(root, name), stat.st_size))
+        self.entries = OrderedDict((path, size) for _, path, size in sorted(entries))
+        self.size = sum(self.entries.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".pt")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            value = torch.load(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (EOFError, RuntimeError, ValueError, pickle.UnpicklingError):
+            # truncated or corrupt entry, e.g. written by a killed run without os.replace
+            self.misses += 1
+            self._evict(path)
+            return None
+        os.utime(path)
+        if path in self.entries:
+            self.entries.move_to_end(path)
+        else:
+            self.entries[path] = os.path.getsize(path)
+            self.size += self.entries[path]
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            torch.save(value.detach().cpu().clone(), f)
+        os.replace(tmp_path, path)
+        self.size -= self.entries.pop(path, 0)
+        self.entries[path] = os.path.getsize(path)
+        self.size += self.entries[path]
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, path):
+        self.size -= self.entries.pop(path, 0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def hit_rate(self):
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else float("nan")
+
+    def report(self):
+        return (
+            f"tile cache: {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate():.1%}, "
+            f"{self.size / 2 ** 30:.2f}/{self.max_bytes / 2 ** 30:.2f} GiB"
+        )
+
+    def predictor(self, net, forward=None):
+        """
+        Returns a `sliding_window_inference` predictor running `forward` (defaults to `net`)
+        only on the tiles missing from the cache.
+        """
+        return CachedPredictor(self, model_digest(net), net, forward or net)
+
+
+class CachedPredictor:
+    def __init__(self, cache, model_key, net, forward):
+        self.cache = cache
+        self.model_key = model_key
+        self.net = net
+        self.forward = forward
+
+    def _precision(self, device):
+        dtype = next(self.net.parameters()).dtype
+        if device.type == "cuda":
+            autocast = torch.is_autocast_enabled()
+            autocast_dtype = getattr(torch, "get_autocast_gpu_dtype", None)
+        else:
+            autocast = getattr(torch, "is_autocast_cpu_enabled", lambda: False)()
+            autocast_dtype = getattr(torch, "get_autocast_cpu_dtype", None)
+        if not autocast:
+            return f"{dtype}-autocast0"
+        # float16 and bfloat16 autocast give different logits
+        return f"{dtype}-autocast1-{autocast_dtype() if autocast_dtype is not None else 'float16'}"
+
+    def __call__(self, windows):
+        precision = self._precision(windows.device)
+        keys = []
+        for window in windows:
+            digest = hashlib.sha256(f"{self.model_key}-{precision}".encode())
+            keys.append(tensor_digest(window, digest).hexdigest())
+
+        outputs = [self.cache.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            computed = self.forward(windows[missing])
+            for i, output in zip(missing, computed):
+                self.cache.put(keys[i], output)
+                outputs[i] = output
+        return torch.stack([output.to(windows.device) for output in outputs])
@@ -0,0 +1,56 @@
+from __future__ import absolute_import, division, print_function
+
+import torch
+from inference.store import save_probabilities
+from pytorch_lightning.callbacks import BasePredictionWriter
+
+
+class EvaluationWriter(BasePredictionWriter):
+    """
+    Prediction callback that scores and saves every batch as soon as it is predicted.
+    The argmax of the logits is computed once, written with `pred_saver` and compared with the
+    label of the batch by `metrics`, then the logits are released. Use it with
+    `trainer.predict(..., return_predictions=False)` so that only one volume is held in memory
+    and the dataloader is iterated a single time.
+    Args:
+        metrics: `ConfusionMatrixMetrics` cumulating the confusion matrices of the volumes.
+        pred_saver: `AsyncNiftiSaver` or `NiftiSaver` for the argmax predictions, or None to skip saving.
+        prob_dir: directory of the `PredictionStore` of the class probabilities of every volume,
+            or None to skip them.
+        prob_dtype: "float16" or "uint8", dtype of the stored probabilities.
+    """
+
+    def __init__(self, metrics, pred_saver=None, prob_dir=None, prob_dtype="float16"):
+        super().__init__(write_interval="batch")
+        self.metrics = metrics
+        self.pred_saver = pred_saver
+        self.prob_dir = prob_dir
+        self.prob_dtype = prob_dtype
+
+    def write(self, logits, batch):
+        """
+        Saves and scores the logits of `batch`. Returns the confusion matrices of the batch.
+        """
+        preds = torch.argmax(logits.detach(), dim=1, keepdim=True)
+        if self.prob_dir:
+            save_probabilities(self.prob_dir, logits, batch["label_meta_dict"], dtype=self.prob_dtype)
+        return self.write_labels(preds, batch)
+
+    def write_labels(self, preds, batch):
+        """
+        Saves and scores the argmax labels [batch, 1, *spatial] of `batch`, e.g. those returned by
+        `inference.store.predict_probabilities`. Returns the confusion matrices of the batch.
+        """
+        if self.pred_saver is not None:
+            self.pred_saver.save_batch(
+                preds.cpu(),
+                meta_data={
+                    "filename_or_obj": batch["label_meta_dict"]["filename_or_obj"],
+                    "original_affine": batch["label_meta_dict"]["original_affine"],
+                    "affine": batch["label_meta_dict"]["affine"],
+                },
+            )
+        return self.metrics(preds, batch["label"].to(preds.device))
+
+    def write_on_batch_end(self, trainer, pl_module, prediction, batch_indices, batch, batch_idx, dataloader_idx):
+        self.write(prediction, batch)
@@ -6,11 +6,25 @@ Tensorflow source: https://github.com/Sarasra/models/tree/master/research/capsul
 
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+
 import torch
 import torch.nn.functional as F
 from torch import nn
 
 
+def _float32(tensor):
+    """
+    Context in which autocast is disabled on the device of `tensor`, so the routing, squash and norms run in
+    float32 under a bfloat16 / float16 precision mode: their epsilon of 1e-12 underflows and their softmax and
+    cosine similarity lose the small logit differences in half precision. Votes from the convolutions are cast
+    to float32 inside. A no-op context before torch 1.10, which has no `torch.autocast`.
+    """
+    if not hasattr(torch, "autocast"):
+        return contextlib.nullcontext()
+    return torch.autocast(tensor.device.type, enabled=False)
+
+
 def _squash(input_tensor, dim=2):
     """
     Applies norm nonlinearity (squash) to a capsule layer.
@@ -24,12 +38,14 @@ def _squash(input_tensor, dim=2):
     A tensor with same shape as input for output of this layer.
     """
     epsilon = 1e-12
-    norm = torch.linalg.norm(input_tensor, dim=dim, keepdim=True)
-    norm_squared = norm * norm
-    return (input_tensor / (norm + epsilon)) * (norm_squared / (1 + norm_squared))
+    with _float32(input_tensor):
+        input_tensor = input_tensor.float()
+        norm = torch.linalg.norm(input_tensor, dim=dim, keepdim=True)
+        norm_squared = norm * norm
+        return (input_tensor / (norm + epsilon)) * (norm_squared / (1 + norm_squared))
 
 
-def _update_routing(votes, biases, num_routing):
+def _update_routing(votes, biases, num_routing, routing_stride=1, routing_topk=0):
     """
     Sums over scaled votes and applies squash to compute the activations.
     Iteratively updates routing logits (scales) based on the similarity between
@@ -40,25 +56,89 @@ def _update_routing(votes, biases, num_routing):
         num_dims: scalar, number of dimmensions in votes. For fully connected
         capsule it is 4, for convolutional 2D it is 6, for convolutional 3D it is 7.
         num_routing: scalar, Number of routing iterations.
+        routing_stride: scalar, the agreement iterations run on every `routing_stride`-th output voxel
+            along each spatial axis and the routing coefficients are repeated over the voxels in between
+            for the final weighted sum. 1 routes every voxel.
+        routing_topk: scalar, after the first iteration every input capsule routes only to the
+            `routing_topk` output capsules of highest routing logit, and the later iterations and the
+            final weighted sum gather and scatter these votes only. 0 routes to every output capsule.
     Returns:
         The activation tensor of the output layer after num_routing iterations.
     """
-    votes_shape = votes.size()
+    with _float32(votes):
+        votes = votes.float()
+        output_dim = votes.shape[2]
+        spatial_shape = votes.shape[4:]
+        # Votes of the agreement iterations, strided by routing_stride and gathered by routing_topk
+        routed_votes = votes
+        subsampled = routing_stride > 1 and num_routing > 1
+        if subsampled:
+            routed_votes = votes[(Ellipsis,) + (slice(None, None, routing_stride),) * len(spatial_shape)]
+        index = None
+
+        logits_shape = list(routed_votes.size())
+        logits_shape[3] = 1
+        logits = torch.zeros(logits_shape, requires_grad=False, device=votes.device)
+
+        for i in range(num_routing):
+            if i == 1 and 0 < routing_topk < output_dim:
+                logits, index = torch.topk(logits, routing_topk, dim=2)
+                routed_votes = _select_outputs(routed_votes, index)
+            route = F.softmax(logits, dim=2)
+
+            if i + 1 < num_routing:
+                preactivate = _sum_votes(routed_votes, route, index, output_dim) + biases[None, ...]
+                preactivate = preactivate[:, None, ...]
+                if index is not None:
+                    preactivate = _select_outputs(preactivate, index)
+                distances = F.cosine_similarity(preactivate, routed_votes, dim=3)
+                logits = logits + distances[:, :, :, None, ...]
+            else:
+                if subsampled:
+                    route = _upsample_route(route, spatial_shape, routing_stride)
+                    routed_votes = votes
+                    if index is not None:
+                        index = _upsample_route(index, spatial_shape, routing_stride)
+                        routed_votes = _select_outputs(votes, index)
+                preactivate = _sum_votes(routed_votes, route, index, output_dim) + biases[None, ...]
+                activation = _squash(preactivate)
+    return activation
 
-    logits_shape = list(votes_shape)
-    logits_shape[3] = 1
-    logits = torch.zeros(logits_shape, requires_grad=False, device=votes.device)
 
-    for i in range(num_routing):
-        route = F.softmax(logits, dim=2)
-        preactivate = torch.sum(votes * route, dim=1) + biases[None, ...]
+def _select_outputs(tensor, index):
+    """
+    Gathers the output capsules `index`, [batch, input_dim, k, 1, *spatial], of `tensor`,
+    [batch, input_dim or 1, output_dim, atoms, *spatial], into [batch, input_dim, k, atoms, *spatial].
+    """
+    shape = list(index.size())
+    shape[3] = tensor.shape[3]
+    return torch.gather(tensor.expand(shape[0], shape[1], *tensor.shape[2:]), 2, index.expand(shape))
 
-        if i + 1 < num_routing:
-            distances = F.cosine_similarity(preactivate[:, None, ...], votes, dim=3)
-            logits = logits + distances[:, :, :, None, ...]
-        else:
-            activation = _squash(preactivate)
-    return activation
+
+def _sum_votes(votes, route, index, output_dim):
+    """
+    Sums the votes weighted by the routing coefficients over the input capsules, [batch, output_dim, atoms, *spatial].
+    With `index`, `votes` and `route` hold the k output capsules `index` of every input capsule, which are
+    scattered into their output capsules.
+    """
+    if index is None:
+        return torch.sum(votes * route, dim=1)
+    weighted = (votes * route).flatten(1, 2)
+    shape = list(weighted.size())
+    shape[1] = output_dim
+    return weighted.new_zeros(shape).scatter_add(1, index.expand(votes.shape).flatten(1, 2), weighted)
+
+
+def _upsample_route(route, spatial_shape, routing_stride):
+    """
+    Repeats routing coefficients, or top-k indices, computed on every `routing_stride`-th voxel over the
+    full `spatial_shape`.
+    """
+    route_shape = route.size()
+    upsampled = route.reshape(route_shape[0], -1, *route_shape[4:]).float()
+    upsampled = F.interpolate(upsampled, scale_factor=routing_stride, mode="nearest")
+    upsampled = upsampled[(Ellipsis,) + tuple(slice(0, size) for size in spatial_shape)]
+    return upsampled.to(route.dtype).reshape(*route_shape[:4], *spatial_shape)
 
 
 class DepthwiseConv3d(nn.Module):
@@ -165,6 +245,10 @@ class ConvSlimCapsule2D(nn.Module):
         dilation: scalar or tuple, spacing between kernel elements
         num_routing: scalar, number of routing iterations.
         share_weight: share transformation weight matrices between capsules in lower layer or not
+        routing_stride: scalar, spacing of the output voxels routed, see `_update_routing`. Can be changed
+            after training through the `routing_stride` attribute.
+        routing_topk: scalar, number of output capsules every input capsule routes to after the first
+            iteration, 0 for all, see `_update_routing`. Can be changed through the `routing_topk` attribute.
     Returns:
         Tensor of activations for this layer of shape
         `[batch, output_dim, output_atoms, out_height, out_width]`
@@ -182,12 +266,16 @@ class ConvSlimCapsule2D(nn.Module):
         padding=0,
         num_routing=3,
         share_weight=True,
+        routing_stride=1,
+        routing_topk=0,
     ):
         super().__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.output_atoms = output_atoms
         self.num_routing = num_routing
+        self.routing_stride = routing_stride
+        self.routing_topk = routing_topk
         self.biases = nn.Parameter(torch.nn.init.constant_(torch.empty(output_dim, output_atoms, 1, 1), 0.1))
         self.depthwise_conv3d = DepthwiseConv3d(
             kernel_size=kernel_size,
@@ -203,7 +291,13 @@ class ConvSlimCapsule2D(nn.Module):
 
     def forward(self, input_tensor):
         votes = self.depthwise_conv3d(input_tensor)
-        return _update_routing(votes, self.biases, self.num_routing)
+        return _update_routing(
+            votes,
+            self.biases,
+            self.num_routing,
+            routing_stride=self.routing_stride,
+            routing_topk=self.routing_topk,
+        )
 
 
 class DepthwiseDeconv3d(nn.Module):
@@ -292,6 +386,10 @@ class DeconvSlimCapsule2D(nn.Module):
         padding: scalar or tuple, controls the amount of implicit zero-paddings on both sides for dilation * (kernel_size - 1) - padding number of points
         num_routing: scalar, number of routing iterations.
         share_weight: share transformation weight matrices between capsules in lower layer or not
+        routing_stride: scalar, spacing of the output voxels routed, see `_update_routing`. Can be changed
+            after training through the `routing_stride` attribute.
+        routing_topk: scalar, number of output capsules every input capsule routes to after the first
+            iteration, 0 for all, see `_update_routing`. Can be changed through the `routing_topk` attribute.
     Returns:
         Tensor of activations for this layer of shape
         `[batch, output_dim, output_atoms, out_height, out_width]`
@@ -308,11 +406,15 @@ class DeconvSlimCapsule2D(nn.Module):
         padding=0,
         num_routing=3,
         share_weight=True,
+        routing_stride=1,
+        routing_topk=0,
     ):
         super().__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.num_routing = num_routing
+        self.routing_stride = routing_stride
+        self.routing_topk = routing_topk
         self.biases = nn.Parameter(torch.nn.init.constant_(torch.empty(output_dim, output_atoms, 1, 1), 0.1))
         self.depthwise_deconv3d = DepthwiseDeconv3d(
             kernel_size, input_dim, output_dim, input_atoms, output_atoms, stride, padding, share_weight=share_weight
@@ -320,7 +422,13 @@ class DeconvSlimCapsule2D(nn.Module):
 
     def forward(self, input_tensor):
         votes = self.depthwise_deconv3d(input_tensor)
-        return _update_routing(votes, self.biases, self.num_routing)
+        return _update_routing(
+            votes,
+            self.biases,
+            self.num_routing,
+            routing_stride=self.routing_stride,
+            routing_topk=self.routing_topk,
+        )
 
 
 class DepthwiseConv4d(nn.Module):
@@ -341,6 +449,8 @@ class DepthwiseConv4d(nn.Module):
         padding: scalar or tuple, zero-padding added to both sides of the input
         dilation: scalar or tuple, spacing between kernel elements
         share_weight: share transformation weight matrices between capsules in lower layer or not
+        vote_rank: scalar, factorizes the transformation into a convolution to `vote_rank` channels
+            followed by a 1x1x1 convolution to `output_dim * output_atoms`. 0 for a full-rank transformation.
     Returns:
         7D Tensor output of a 3D convolution with shape
         `[batch, input_dim, output_dim, output_atoms, out_height, out_width, out_depth]`.
@@ -357,6 +467,7 @@ class DepthwiseConv4d(nn.Module):
         dilation=1,
         padding=0,
         share_weight=True,
+        vote_rank=0,
     ):
         super().__init__()
         self.input_dim = input_dim
@@ -364,27 +475,26 @@ class DepthwiseConv4d(nn.Module):
         self.input_atoms = input_atoms
         self.output_atoms = output_atoms
         self.share_weight = share_weight
+        self.vote_rank = vote_rank if 0 < vote_rank < output_dim * output_atoms else 0
 
-        if self.share_weight:
-            self.conv3d = nn.Conv3d(
-                input_atoms,
-                output_dim * output_atoms,
-                kernel_size=kernel_size,
-                stride=stride,
-                dilation=dilation,
-                padding=padding,
-            )
-        else:
-            self.conv3d = nn.Conv3d(
-                input_dim * input_atoms,
-                input_dim * output_dim * output_atoms,
-                kernel_size=kernel_size,
-                stride=stride,
-                dilation=dilation,
-                padding=padding,
-                groups=input_dim,
-            )
+        groups = 1 if self.share_weight else input_dim
+        conv_channels = self.vote_rank if self.vote_rank else output_dim * output_atoms
+        self.conv3d = nn.Conv3d(
+            groups * input_atoms,
+            groups * conv_channels,
+            kernel_size=kernel_size,
+            stride=stride,
+            dilation=dilation,
+            padding=padding,
+            groups=groups,
+        )
         torch.nn.init.normal_(self.conv3d.weight, std=0.1)
+        if self.vote_rank:
+            self.vote_projection = nn.Conv3d(
+                groups * self.vote_rank, groups * output_dim * output_atoms, kernel_size=1, bias=False, groups=groups
+            )
+            # Keeps the scale of the votes of the full-rank transformation
+            torch.nn.init.normal_(self.vote_projection.weight, std=self.vote_rank ** -0.5)
 
     def forward(self, input_tensor):
         input_shape = input_tensor.size()
@@ -399,6 +509,8 @@ class DepthwiseConv4d(nn.Module):
             )
 
         conv = self.conv3d(input_tensor_reshaped)
+        if self.vote_rank:
+            conv = self.vote_projection(conv)
         conv_shape = conv.size()
 
         conv_reshaped = conv.view(
@@ -438,6 +550,11 @@ class ConvSlimCapsule3D(nn.Module):
         dilation: scalar or tuple, spacing between kernel elements
         num_routing: scalar, number of routing iterations.
         share_weight: share transformation weight matrices between capsules in lower layer or not
+        vote_rank: scalar, rank of the low-rank vote transformation, 0 for full rank.
+        routing_stride: scalar, spacing of the output voxels routed, see `_update_routing`. Can be changed
+            after training through the `routing_stride` attribute.
+        routing_topk: scalar, number of output capsules every input capsule routes to after the first
+            iteration, 0 for all, see `_update_routing`. Can be changed through the `routing_topk` attribute.
     Returns:
         Tensor of activations for this layer of shape
         `[batch, output_dim, output_atoms, out_height, out_width, out_depth]`
@@ -455,12 +572,17 @@ class ConvSlimCapsule3D(nn.Module):
         dilation=1,
         num_routing=3,
         share_weight=True,
+        vote_rank=0,
+        routing_stride=1,
+        routing_topk=0,
     ):
         super().__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.output_atoms = output_atoms
         self.num_routing = num_routing
+        self.routing_stride = routing_stride
+        self.routing_topk = routing_topk
         self.biases = nn.Parameter(torch.nn.init.constant_(torch.empty(output_dim, output_atoms, 1, 1, 1), 0.1))
         self.depthwise_conv4d = DepthwiseConv4d(
             kernel_size=kernel_size,
@@ -472,11 +594,18 @@ class ConvSlimCapsule3D(nn.Module):
             padding=padding,
             dilation=dilation,
             share_weight=share_weight,
+            vote_rank=vote_rank,
         )
 
     def forward(self, input_tensor):
         votes = self.depthwise_conv4d(input_tensor)
-        return _update_routing(votes, self.biases, self.num_routing)
+        return _update_routing(
+            votes,
+            self.biases,
+            self.num_routing,
+            routing_stride=self.routing_stride,
+            routing_topk=self.routing_topk,
+        )
 
 
 class DepthwiseDeconv4d(nn.Module):
@@ -571,6 +700,10 @@ class DeconvSlimCapsule3D(nn.Module):
         padding: scalar or tuple, controls the amount of implicit zero-paddings on both sides for dilation * (kernel_size - 1) - padding number of points
         num_routing: scalar, number of routing iterations.
         share_weight: share transformation weight matrices between capsules in lower layer or not
+        routing_stride: scalar, spacing of the output voxels routed, see `_update_routing`. Can be changed
+            after training through the `routing_stride` attribute.
+        routing_topk: scalar, number of output capsules every input capsule routes to after the first
+            iteration, 0 for all, see `_update_routing`. Can be changed through the `routing_topk` attribute.
     Returns:
         Tensor of activations for this layer of shape
         `[batch, output_dim, output_atoms, out_height, out_width, out_depth]`
@@ -587,11 +720,15 @@ class DeconvSlimCapsule3D(nn.Module):
         padding=0,
         num_routing=3,
         share_weight=True,
+        routing_stride=1,
+        routing_topk=0,
     ):
         super().__init__()
         self.input_dim = input_dim
         self.output_dim = output_dim
         self.num_routing = num_routing
+        self.routing_stride = routing_stride
+        self.routing_topk = routing_topk
         self.biases = nn.Parameter(torch.nn.init.constant_(torch.empty(output_dim, output_atoms, 1, 1, 1), 0.1))
         self.depthwise_deconv4d = DepthwiseDeconv4d(
             kernel_size, input_dim, output_dim, input_atoms, output_atoms, stride, padding, share_weight=share_weight
@@ -599,7 +736,13 @@ class DeconvSlimCapsule3D(nn.Module):
 
     def forward(self, input_tensor):
         votes = self.depthwise_deconv4d(input_tensor)
-        return _update_routing(votes, self.biases, self.num_routing)
+        return _update_routing(
+            votes,
+            self.biases,
+            self.num_routing,
+            routing_stride=self.routing_stride,
+            routing_topk=self.routing_topk,
+        )
 
 
 class MarginLoss(nn.Module):
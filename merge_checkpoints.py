@@ -0,0 +1,40 @@
+import argparse
+
+import pytorch_lightning as pl
+import torch
+
+from module.multi_ucaps import MultiUCaps3D
+
+# Call example
+# python merge_checkpoints.py --checkpoints ribosome=ribosome.ckpt proteasome=proteasome.ckpt --output multi.ckpt
+# then fine-tune the heads on the shared layers of the first target, which stay frozen:
+# python train_invitro.py --model_name ucaps-multi --init_checkpoint multi.ckpt --gpus 1
+# and predict every target in one pass with the best fine-tuned checkpoint:
+# python predict.py --input /data/tomograms/ --model_name ucaps-multi --checkpoint_path /path/to/fine_tuned_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", nargs="+", type=str, required=True,
+                        help="Single-target UCaps3D checkpoints as target_name=/path/to/trained_model, in label order")
+    parser.add_argument("--output", type=str, required=True, help="Path of the merged MultiUCaps3D checkpoint")
+    parser.add_argument("--shared_from", type=str, default=None,
+                        help="Target whose checkpoint provides the shared layers, defaults to the first one")
+    parser.add_argument("--shared_layers", type=int, default=4, help="Number of shared encoder capsule layers, 0 to 5")
+    args = parser.parse_args()
+
+    checkpoints = dict(spec.partition("=")[::2] for spec in args.checkpoints)
+    net = MultiUCaps3D.from_single_target(
+        checkpoints, shared_from=args.shared_from, shared_layers=args.shared_layers, freeze_shared=True
+    )
+    torch.save(
+        {
+            "state_dict": net.state_dict(),
+            "hyper_parameters": dict(net.hparams),
+            "pytorch-lightning_version": pl.__version__,
+        },
+        args.output,
+    )
+    for target, labels in zip(net.targets, net.target_labels):
+        print(f"{target}: labels {labels}")
+    print(f"Saved {args.output}")
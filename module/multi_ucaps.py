@@ -0,0 +1,285 @@
+from __future__ import absolute_import, division, print_function
+
+import pytorch_lightning as pl
+import torch
+from module.ucaps import UCaps3D, decode_capsules
+from monai.inferers import sliding_window_inference
+from monai.losses import DiceCELoss
+from torch import nn
+
+
+# Pytorch Lightning module
+class MultiUCaps3D(pl.LightningModule):
+    """
+    UCaps3D with one head per target sharing the feature extractor, the primary capsules and
+    the first `shared_layers` encoder capsule layers. Every head has the remaining encoder
+    capsule layers and a decoder of its own, so a single pass over a tomogram predicts every target.
+    The heads are combined into one label map: a voxel gets the class with the highest
+    probability in its head, or background when the background probability of every head is
+    higher. `forward` returns the log of these scores, [batch, 1 + classes, *spatial], so
+    the argmax and softmax of its output are used like the logits of `UCaps3D`.
+    Args:
+        targets: list of target names, e.g. ["ribosome", "proteasome"].
+        target_labels: list per target of the label values of its foreground classes in the
+            combined label map. Defaults to consecutive values, one class per target.
+        shared_layers: scalar, number of encoder capsule layers shared by the heads, 0 to 5.
+        freeze_shared: train the heads only, e.g. after merging single-target checkpoints.
+    Usage:
+        net = MultiUCaps3D(targets=["ribosome", "proteasome"], in_channels=1)
+        logits = net.forward_heads(images)  # {"ribosome": [batch, 2, *spatial], ...}
+    """
+
+    def __init__(
+        self,
+        targets=("target",),
+        target_labels=None,
+        in_channels=1,
+        shared_layers=4,
+        freeze_shared=False,
+        share_weight=True,
+        connection="skip",
+        class_head="capsule",
+        class_head_channels=192,
+        variant="default",
+        routing_stride=None,
+        routing_topk=None,
+        lr_rate=1e-4,
+        weight_decay=1e-6,
+        sw_batch_size=1,
+        val_patch_size=(64, 64, 64),
+        overlap=0.75,
+        val_frequency=100,
+        **kwargs,
+    ):
+        super().__init__()
+        self.save_hyperparameters()
+        self.targets = list(self.hparams.targets)
+        if self.hparams.target_labels is None:
+            self.target_labels = [[i + 1] for i in range(len(self.targets))]
+        else:
+            self.target_labels = [list(labels) for labels in self.hparams.target_labels]
+        if sorted(label for labels in self.target_labels for label in labels) != list(
+            range(1, 1 + sum(len(labels) for labels in self.target_labels))
+        ):
+            raise ValueError("target_labels must split the labels 1..N between the targets.")
+        if not 0 <= self.hparams.shared_layers <= 5:
+            raise ValueError("shared_layers must be between 0 and 5.")
+
+        self.in_channels = self.hparams.in_channels
+        self.out_channels = 1 + sum(len(labels) for labels in self.target_labels)
+        self.shared_layers = self.hparams.shared_layers
+        self.connection = self.hparams.connection
+        self.lr_rate = self.hparams.lr_rate
+        self.weight_decay = self.hparams.weight_decay
+        self.val_frequency = self.hparams.val_frequency
+        self.val_patch_size = self.hparams.val_patch_size
+        self.sw_batch_size = self.hparams.sw_batch_size
+        self.overlap = self.hparams.overlap
+
+        # Building model from one UCaps3D per target
+        self.heads = nn.ModuleDict()
+        for i, (target, labels) in enumerate(zip(self.targets, self.target_labels)):
+            template = UCaps3D(
+                in_channels=self.in_channels,
+                out_channels=1 + len(labels),
+                share_weight=self.hparams.share_weight,
+                connection=self.connection,
+                class_head=self.hparams.class_head,
+                class_head_channels=self.hparams.class_head_channels,
+                variant=self.hparams.variant,
+                routing_stride=self.hparams.routing_stride,
+                routing_topk=self.hparams.routing_topk,
+            )
+            if i == 0:
+                self.feature_extractor = template.feature_extractor
+                self.primary_caps = template.primary_caps
+                self.shared_caps = template.encoder_conv_caps[: self.shared_layers]
+            self.heads[target] = nn.ModuleDict(
+                {
+                    "encoder_conv_caps": template.encoder_conv_caps[self.shared_layers :],
+                    "decoder_conv": template.decoder_conv,
+                }
+            )
+        if self.hparams.freeze_shared:
+            for module in (self.feature_extractor, self.primary_caps, self.shared_caps):
+                module.requires_grad_(False)
+
+        self.classification_loss = DiceCELoss(softmax=True, to_onehot_y=True)
+
+        # For validation
+        # ConfusionMatrixMetrics created by the first validation_step, prediction does not import the metrics
+        self.val_metrics = None
+        # Optional inference.tile_cache.TileCache of predict_step
+        self.tile_cache = None
+
+        self.example_input_array = torch.rand(1, self.in_channels, 32, 32, 32)
+
+    @staticmethod
+    def add_model_specific_args(parent_parser):
+        parser = parent_parser.add_argument_group("MultiUCaps3D")
+        # Architecture params
+        parser.add_argument("--targets", nargs="+", type=str, default=["target"])
+        parser.add_argument("--in_channels", type=int, default=1)
+        parser.add_argument("--shared_layers", type=int, default=4)
+        parser.add_argument("--freeze_shared", type=int, default=0)
+        parser.add_argument("--share_weight", type=int, default=1)
+        parser.add_argument("--connection", type=str, default="skip")
+        parser.add_argument("--class_head", type=str, default="capsule")
+        parser.add_argument("--class_head_channels", type=int, default=192)
+        parser.add_argument("--variant", type=str, default="default")
+        parser.add_argument("--routing_stride", nargs="+", type=int, default=None)
+        parser.add_argument("--routing_topk", nargs="+", type=int, default=None)
+
+        # Validation params
+        parser.add_argument("--val_patch_size", nargs="+", type=int, default=[64, 64, 64])
+        parser.add_argument("--val_frequency", type=int, default=100)
+        parser.add_argument("--sw_batch_size", type=int, default=1)
+        parser.add_argument("--overlap", type=float, default=0.75)
+
+        # Optimizer params
+        parser.add_argument("--lr_rate", type=float, default=1e-4)
+        parser.add_argument("--weight_decay", type=float, default=1e-6)
+        return parent_parser, parser
+
+    def forward_heads(self, x):
+        """
+        Returns the logits of every head, a dict of target name to [batch, 1 + classes, *spatial].
+        """
+        x = self.feature_extractor(x)
+        x = self.primary_caps(x.unsqueeze(dim=1))
+
+        # Capsule maps feeding the decoder skips: outputs of the primary capsules and encoder layers 1, 3, 5
+        skips = [x]
+        for i, layer in enumerate(self.shared_caps):
+            x = layer(x)
+            if i % 2 == 1:
+                skips.append(x)
+
+        logits = {}
+        for target, head in self.heads.items():
+            head_x, head_skips = x, list(skips)
+            for i, layer in enumerate(head["encoder_conv_caps"], start=self.shared_layers):
+                head_x = layer(head_x)
+                if i % 2 == 1:
+                    head_skips.append(head_x)
+            logits[target] = decode_capsules(head["decoder_conv"], self.connection, *head_skips)
+        return logits
+
+    def combine(self, logits):
+        """
+        Log scores of the combined label map from the logits of every head.
+        """
+        probs = {target: torch.softmax(head_logits, dim=1) for target, head_logits in logits.items()}
+        background = torch.stack([head_probs[:, 0] for head_probs in probs.values()]).min(dim=0)[0]
+        scores = [background.unsqueeze(dim=1)] + [None] * (self.out_channels - 1)
+        for target, labels in zip(self.targets, self.target_labels):
+            for c, label in enumerate(labels):
+                scores[label] = probs[target][:, c + 1 : c + 2]
+        return torch.log(torch.cat(scores, dim=1).clamp_min(1e-12))
+
+    def forward(self, x):
+        return self.combine(self.forward_heads(x))
+
+    def training_step(self, batch, batch_idx):
+        images, labels = batch["image"], batch["label"]
+
+        logits = self.forward_heads(images)
+        loss = 0
+        for target, head_labels in zip(self.targets, self.target_labels):
+            # Labels of the head: 0 for background and the classes of the other targets
+            target_label = torch.zeros_like(labels)
+            for c, label in enumerate(head_labels):
+                target_label[labels == label] = c + 1
+            head_loss = self.classification_loss(logits[target], target_label)
+            self.log(f"{target}_loss", head_loss, on_step=False, on_epoch=True, sync_dist=True)
+            loss = loss + head_loss
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        images, labels = batch["image"], batch["label"]
+        if self.val_metrics is None:
+            from inference.metrics import ConfusionMatrixMetrics
+
+            self.val_metrics = ConfusionMatrixMetrics(self.out_channels)
+        val_outputs = sliding_window_inference(
+            images,
+            roi_size=self.val_patch_size,
+            sw_batch_size=self.sw_batch_size,
+            predictor=self.forward,
+            overlap=self.overlap,
+        )
+        self.val_metrics(torch.argmax(val_outputs, dim=1, keepdim=True), labels)
+
+    def validation_epoch_end(self, outputs):
+        dice_scores = self.val_metrics.aggregate("dice", reduction="mean_batch")
+        mean_val_dice = torch.mean(dice_scores)
+        self.log("val_dice", mean_val_dice, sync_dist=True)
+        for i, dice_score in enumerate(dice_scores):
+            self.log(f"val_dice_class {i + 1}", dice_score, sync_dist=True)
+        self.val_metrics.reset()
+
+    def predict_step(self, batch, batch_idx, dataloader_idx=None):
+        images = batch["image"]
+        outputs = sliding_window_inference(
+            images,
+            roi_size=self.val_patch_size,
+            sw_batch_size=self.sw_batch_size,
+            predictor=self.forward if self.tile_cache is None else self.tile_cache.predictor(self, self.forward),
+            overlap=self.overlap,
+        )
+        return outputs
+
+    def configure_optimizers(self):
+        parameters = [p for p in self.parameters() if p.requires_grad]
+        optimizer = torch.optim.Adam(parameters, lr=self.lr_rate, weight_decay=self.weight_decay)
+        scheduler = {
+            "scheduler": torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, "max", factor=0.1, patience=5),
+            "monitor": "val_dice",
+            "frequency": self.val_frequency,
+        }
+        return [optimizer], [scheduler]
+
+    @classmethod
+    def from_single_target(cls, checkpoints, shared_from=None, shared_layers=4, **kwargs):
+        """
+        Merges single-target UCaps3D checkpoints into a MultiUCaps3D.
+        Every head takes its upper encoder capsule layers and decoder from the checkpoint of its
+        target, the shared layers come from the checkpoint of `shared_from` (the first target by
+        default). The other heads then see features they were not trained on, fine-tune them
+        with `freeze_shared=True` before use, e.g. with `train_invitro.py --init_checkpoint`.
+        Args:
+            checkpoints: dict of target name to UCaps3D checkpoint path, in label order.
+            shared_from: target name whose checkpoint provides the shared layers.
+            shared_layers: scalar, number of shared encoder capsule layers.
+            kwargs: further hyperparameters of the merged model, e.g. `val_patch_size`.
+        """
+        sources = {target: UCaps3D.load_from_checkpoint(path) for target, path in checkpoints.items()}
+        first = sources[shared_from or next(iter(sources))]
+        target_labels, next_label = [], 1
+        for source in sources.values():
+            target_labels.append(list(range(next_label, next_label + source.out_channels - 1)))
+            next_label += source.out_channels - 1
+
+        hparams = dict(
+            in_channels=first.in_channels,
+            share_weight=first.share_weight,
+            connection=first.connection,
+            class_head=first.class_head,
+            class_head_channels=first.class_head_channels,
+            variant=first.variant,
+            val_patch_size=first.val_patch_size,
+            sw_batch_size=first.sw_batch_size,
+            overlap=first.overlap,
+        )
+        hparams.update(kwargs)
+        net = cls(targets=list(sources), target_labels=target_labels, shared_layers=shared_layers, **hparams)
+
+        net.feature_extractor.load_state_dict(first.feature_extractor.state_dict())
+        net.primary_caps.load_state_dict(first.primary_caps.state_dict())
+        net.shared_caps.load_state_dict(first.encoder_conv_caps[:shared_layers].state_dict())
+        for target, source in sources.items():
+            net.heads[target]["encoder_conv_caps"].load_state_dict(
+                source.encoder_conv_caps[shared_layers:].state_dict()
+            )
+            net.heads[target]["decoder_conv"].load_state_dict(source.decoder_conv.state_dict())
+        return net
@@ -5,13 +5,10 @@ from collections import OrderedDict
 import pytorch_lightning as pl
 import torch
 from layers import ConvSlimCapsule2D, ConvSlimCapsule3D, DeconvSlimCapsule2D, DeconvSlimCapsule3D, MarginLoss
-from monai.data import decollate_batch
 from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
-from monai.metrics import DiceMetric
 from monai.networks import one_hot
 from monai.networks.blocks import Convolution
-from monai.transforms import AsDiscrete, Compose, EnsureType
 from monai.visualize.img2tensorboard import plot_2d_or_3d_image
 from torch import nn
 
@@ -90,10 +87,10 @@ class SegCaps3D(pl.LightningModule):
         self._build_reconstruct_branch()
 
         # For validation
-        self.post_pred = Compose([EnsureType(), AsDiscrete(argmax=True, to_onehot=True, n_classes=self.out_channels)])
-        self.post_label = Compose([EnsureType(), AsDiscrete(to_onehot=True, n_classes=self.out_channels)])
-
-        self.dice_metric = DiceMetric(include_background=False, reduction="mean_batch", get_not_nans=False)
+        # ConfusionMatrixMetrics created by the first validation_step, prediction does not import the metrics
+        self.val_metrics = None
+        # Optional inference.tile_cache.TileCache of predict_step
+        self.tile_cache = None
 
         self.example_input_array = torch.rand(1, self.in_channels, 32, 32, 32)
 
@@ -194,6 +191,10 @@ class SegCaps3D(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         images, labels = batch["image"], batch["label"]
+        if self.val_metrics is None:
+            from inference.metrics import ConfusionMatrixMetrics
+
+            self.val_metrics = ConfusionMatrixMetrics(self.out_channels)
 
         val_outputs = sliding_window_inference(
             images,
@@ -220,17 +221,26 @@ class SegCaps3D(pl.LightningModule):
                 tag="Prediction",
             )
 
-        val_outputs = [self.post_pred(val_output) for val_output in decollate_batch(val_outputs)]
-        labels = [self.post_label(label) for label in decollate_batch(labels)]
-        self.dice_metric(y_pred=val_outputs, y=labels)
+        self.val_metrics(torch.argmax(val_outputs, dim=1, keepdim=True), labels)
 
     def validation_epoch_end(self, outputs):
-        dice_scores = self.dice_metric.aggregate()
+        dice_scores = self.val_metrics.aggregate("dice", reduction="mean_batch")
         mean_val_dice = torch.mean(dice_scores)
         self.log("val_dice", mean_val_dice, sync_dist=True)
         for i, dice_score in enumerate(dice_scores):
             self.log(f"val_dice_class {i + 1}", dice_score, sync_dist=True)
-        self.dice_metric.reset()
+        self.val_metrics.reset()
+
+    def predict_step(self, batch, batch_idx, dataloader_idx=None):
+        images = batch["image"]
+        outputs = sliding_window_inference(
+            images,
+            roi_size=self.val_patch_size,
+            sw_batch_size=self.sw_batch_size,
+            predictor=self.forward if self.tile_cache is None else self.tile_cache.predictor(self, self.forward),
+            overlap=self.overlap,
+        )
+        return outputs
 
     def configure_optimizers(self):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.lr_rate, weight_decay=self.weight_decay)
@@ -242,6 +252,8 @@ class SegCaps3D(pl.LightningModule):
         return [optimizer], [scheduler]
 
     def losses(self, volumes, labels, pred, reconstructions):
+        # Losses in float32 under a reduced precision mode
+        pred, reconstructions = pred.float(), reconstructions.float()
         mask = torch.gt(labels, 0)
         rec_loss = torch.sum(self.reconstruction_loss(volumes * mask, reconstructions * mask), dim=(1, 2, 3, 4)) / (
             torch.sum(mask, dim=(1, 2, 3, 4)) + 1e-8
@@ -354,6 +366,8 @@ class SegCaps2D(pl.LightningModule):
         overlap=0.75,
         val_frequency=100,
         weight_decay=2e-6,
+        slice_context=0,
+        slice_memory=1.0,
         **kwargs,
     ):
         super().__init__()
@@ -386,6 +400,11 @@ class SegCaps2D(pl.LightningModule):
         self.val_patch_size = self.hparams.val_patch_size
         self.sw_batch_size = self.hparams.sw_batch_size
         self.overlap = self.hparams.overlap
+        # 2.5D input: `slice_context` neighbouring slices on each side are stacked as channels,
+        # `in_channels` counts the stacked channels
+        self.slice_context = self.hparams.slice_context
+        self.slice_memory = self.hparams.slice_memory
+        self._bytes_per_pixel = None
 
         # Building model
         self.feature_extractor = nn.Sequential(
@@ -414,10 +433,10 @@ class SegCaps2D(pl.LightningModule):
         self._build_reconstruct_branch()
 
         # For validation
-        self.post_pred = Compose([EnsureType(), AsDiscrete(argmax=True, to_onehot=True, n_classes=self.out_channels)])
-        self.post_label = Compose([EnsureType(), AsDiscrete(to_onehot=True, n_classes=self.out_channels)])
-
-        self.dice_metric = DiceMetric(include_background=False, reduction="mean_batch", get_not_nans=False)
+        # ConfusionMatrixMetrics created by the first validation_step, prediction does not import the metrics
+        self.val_metrics = None
+        # Optional inference.tile_cache.TileCache of predict_step
+        self.tile_cache = None
 
         if self.input_dim == 3:
             self.example_input_array = torch.rand(1, self.in_channels, 32, 32, 1)
@@ -437,6 +456,9 @@ class SegCaps2D(pl.LightningModule):
         parser.add_argument("--val_frequency", type=int, default=100)
         parser.add_argument("--sw_batch_size", type=int, default=1)
         parser.add_argument("--overlap", type=float, default=0.75)
+        parser.add_argument("--slice_context", type=int, default=0)
+        parser.add_argument("--slice_memory", type=float, default=1.0,
+                            help="GiB of activations per batch of slices, at most one slice per thread on CPU")
 
         # Loss params
         parser.add_argument("--rec_loss_weight", type=float, default=1e-1)
@@ -451,6 +473,14 @@ class SegCaps2D(pl.LightningModule):
         if self.input_dim == 3:
             x = x.squeeze(dim=-1)
 
+        logits = self.forward_slices(x)
+
+        if self.input_dim == 3:
+            logits = logits.unsqueeze(dim=-1)
+
+        return logits
+
+    def forward_slices(self, x):
         # Contracting
         x = self.feature_extractor(x)
         conv_cap_1_1 = x.unsqueeze(dim=1)
@@ -476,17 +506,71 @@ class SegCaps2D(pl.LightningModule):
 
         x = self.decoder_conv_caps[5](x)
 
-        logits = torch.linalg.norm(x, dim=2)
-
-        if self.input_dim == 3:
-            logits = logits.unsqueeze(dim=-1)
-
-        return logits
+        return torch.linalg.norm(x, dim=2)
+
+    def _uses_slice_inference(self):
+        full_slices = self.val_patch_size[-1] == 1 and all(s <= 0 for s in self.val_patch_size[:2])
+        return self.input_dim == 3 and (self.slice_context > 0 or (full_slices and self.tile_cache is None))
+
+    def _slice_batch_size(self, height, width):
+        # Activation bytes per pixel, summed over all layers of a probe slice, an upper bound of the peak
+        if self._bytes_per_pixel is None:
+            sizes = []
+            hooks = [
+                m.register_forward_hook(lambda m, i, o: sizes.append(o.numel() if torch.is_tensor(o) else 0))
+                for m in self.modules()
+            ]
+            try:
+                with torch.no_grad():
+                    self.forward_slices(self.example_input_array.squeeze(dim=-1).to(self.device))
+            finally:
+                for hook in hooks:
+                    hook.remove()
+            self._bytes_per_pixel = 4 * sum(sizes) / (32 * 32)
+        slices = max(1, int(self.slice_memory * 2 ** 30 / (self._bytes_per_pixel * height * width)))
+        if self.device.type == "cpu":
+            # A CPU batch only needs one slice per thread to use every core, a larger one runs slower as the
+            # activations of the whole batch leave the caches between layers
+            slices = min(slices, torch.get_num_threads())
+        return slices
+
+    def slice_inference(self, images):
+        """
+        Predicts a volume [batch, channels, height, width, depth] slice by slice along the last
+        axis, with as many slices per `forward_slices` call as fit in `slice_memory` GiB, and
+        at most one per thread on CPU.
+        With `slice_context` k, every slice is stacked with its k neighbours on each side as
+        channels, replicating the first and last slices at the borders.
+        Returns:
+            Logits of shape [batch, out_channels, height, width, depth].
+        """
+        k = self.slice_context
+        batch, _, height, width, depth = images.shape
+        if k > 0:
+            images = torch.cat([images[..., :1]] * k + [images] + [images[..., -1:]] * k, dim=-1)
+        step = self._slice_batch_size(height, width)
+
+        outputs = None
+        for b in range(batch):
+            for start in range(0, depth, step):
+                stop = min(start + step, depth)
+                # [channels, height, width, slices, 2k + 1] -> [slices, channels * (2k + 1), height, width]
+                x = images[b, :, :, :, start : stop + 2 * k].unfold(-1, 2 * k + 1, 1)
+                x = x.permute(3, 0, 4, 1, 2).reshape(stop - start, -1, height, width)
+                logits = self.forward_slices(x)
+                if outputs is None:
+                    outputs = logits.new_empty(batch, logits.shape[1], height, width, depth)
+                outputs[b, :, :, :, start:stop] = logits.permute(1, 2, 3, 0)
+        return outputs
 
     def training_step(self, batch, batch_idx):
         images, labels = batch["image"], batch["label"]
 
-        if self.input_dim == 3:
+        if self.slice_context > 0:
+            # Patches of 2k + 1 slices, labelled by their center slice
+            images = images.permute(0, 1, 4, 2, 3).reshape(images.shape[0], -1, *images.shape[2:4])
+            labels = labels[..., self.slice_context]
+        elif self.input_dim == 3:
             images = images.squeeze(dim=-1)
             labels = labels.squeeze(dim=-1)
 
@@ -532,14 +616,21 @@ class SegCaps2D(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         images, labels = batch["image"], batch["label"]
+        if self.val_metrics is None:
+            from inference.metrics import ConfusionMatrixMetrics
 
-        val_outputs = sliding_window_inference(
-            images,
-            roi_size=self.val_patch_size,
-            sw_batch_size=self.sw_batch_size,
-            predictor=self.forward,
-            overlap=self.overlap,
-        )
+            self.val_metrics = ConfusionMatrixMetrics(self.out_channels)
+
+        if self._uses_slice_inference():
+            val_outputs = self.slice_inference(images)
+        else:
+            val_outputs = sliding_window_inference(
+                images,
+                roi_size=self.val_patch_size,
+                sw_batch_size=self.sw_batch_size,
+                predictor=self.forward,
+                overlap=self.overlap,
+            )
 
         # Visualize to tensorboard
         if self.global_rank == 0 and batch_idx == 0:
@@ -558,25 +649,25 @@ class SegCaps2D(pl.LightningModule):
                 tag="Prediction",
             )
 
-        val_outputs = [self.post_pred(val_output) for val_output in decollate_batch(val_outputs)]
-        labels = [self.post_label(label) for label in decollate_batch(labels)]
-        self.dice_metric(y_pred=val_outputs, y=labels)
+        self.val_metrics(torch.argmax(val_outputs, dim=1, keepdim=True), labels)
 
     def validation_epoch_end(self, outputs):
-        dice_scores = self.dice_metric.aggregate()
+        dice_scores = self.val_metrics.aggregate("dice", reduction="mean_batch")
         mean_val_dice = torch.mean(dice_scores)
         self.log("val_dice", mean_val_dice, sync_dist=True)
         for i, dice_score in enumerate(dice_scores):
             self.log(f"val_dice_class {i + 1}", dice_score, sync_dist=True)
-        self.dice_metric.reset()
+        self.val_metrics.reset()
 
     def predict_step(self, batch, batch_idx, dataloader_idx=None):
         images = batch["image"]
+        if self._uses_slice_inference():
+            return self.slice_inference(images)
         outputs = sliding_window_inference(
             images,
             roi_size=self.val_patch_size,
             sw_batch_size=self.sw_batch_size,
-            predictor=self.forward,
+            predictor=self.forward if self.tile_cache is None else self.tile_cache.predictor(self, self.forward),
             overlap=self.overlap,
         )
         return outputs
@@ -591,6 +682,8 @@ class SegCaps2D(pl.LightningModule):
         return [optimizer], [scheduler]
 
     def losses(self, volumes, labels, pred, reconstructions):
+        # Losses in float32 under a reduced precision mode
+        pred, reconstructions = pred.float(), reconstructions.float()
         mask = torch.gt(labels, 0)
         rec_loss = torch.sum(self.reconstruction_loss(volumes * mask, reconstructions * mask), dim=(1, 2, 3)) / (
             torch.sum(mask, dim=(1, 2, 3)) + 1e-8
@@ -1,22 +1,111 @@
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+import weakref
 from collections import OrderedDict
 
 import pytorch_lightning as pl
 import torch
 import torch.nn.functional as F
 from layers import ConvSlimCapsule3D, MarginLoss
-from monai.data import decollate_batch
 from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
-from monai.metrics import DiceMetric
 from monai.networks import one_hot
 from monai.networks.blocks import Convolution, UpSample
 from monai.networks.layers.factories import Conv
-from monai.transforms import AsDiscrete, Compose, EnsureType
 from monai.visualize.img2tensorboard import plot_2d_or_3d_image
 from torch import nn
 
+# Named configurations of UCaps3D, selected with --variant
+#   separable_features: depthwise-separable 5x5x5 convolutions in the feature extractor
+#   upsample: "deconv" transposed convolutions or "nontrainable" 1x1x1 convolutions and trilinear upsampling
+#   vote_rank: rank of the capsule vote transformations, 0 for full rank
+#   num_routing: routing iterations of the encoder capsule layers
+#   width: multiplier of the feature channels, number of capsules, capsule atoms and decoder channels
+UCAPS3D_VARIANTS = {
+    "default": dict(separable_features=False, upsample="deconv", vote_rank=0, num_routing=3, width=1.0),
+    "lite": dict(separable_features=True, upsample="nontrainable", vote_rank=16, num_routing=2, width=1.0),
+    "lite-small": dict(separable_features=True, upsample="nontrainable", vote_rank=16, num_routing=2, width=0.5),
+}
+
+# Storage dtype of the skip capsule maps and of the tensors the encoder saves for backward, selected
+# with --skip_precision. They are cast back to float32 where used, so only their storage is reduced.
+SKIP_PRECISIONS = {"float32": None, "bfloat16": torch.bfloat16, "float16": torch.float16}
+
+
+def saved_tensors_dtype(dtype):
+    """
+    Context in which the float32 activations autograd saves for backward are stored as `dtype` and
+    restored to float32 when the backward pass unpacks them. Parameters are kept as they are.
+    Views save their base tensor, converted once however many views and operations save it, e.g. the
+    votes and routing logits every routing iteration saves slices of.
+    A no-op context for `dtype` None or before torch 1.10, which has no saved tensor hooks.
+    """
+    saved_tensors_hooks = getattr(getattr(torch.autograd, "graph", None), "saved_tensors_hooks", None)
+    if dtype is None or saved_tensors_hooks is None:
+        return contextlib.nullcontext()
+    # Copies by id of their source tensor, held through weak references so that every copy is freed with the
+    # last backward node using it, and so that an id reused by a new tensor is not mistaken for the freed one
+    converted, restored = {}, {}
+
+    def cached(cache, source, convert):
+        source_ref, copy_ref = cache.get(id(source), (None, None))
+        copy = copy_ref() if source_ref is not None and source_ref() is source else None
+        if copy is None:
+            copy = convert(source)
+            cache[id(source)] = weakref.ref(source), weakref.ref(copy)
+        return copy
+
+    def pack(tensor):
+        if tensor.dtype != torch.float32 or tensor.is_leaf:
+            return None, tensor
+        base = tensor if tensor._base is None else tensor._base
+        stored = cached(converted, base, lambda source: source.to(dtype))
+        if stored.stride() != base.stride():
+            return tensor.dtype, tensor.to(dtype)
+        return tensor.dtype, (stored, tensor.size(), tensor.stride(), tensor.storage_offset() - base.storage_offset())
+
+    def unpack(packed):
+        original_dtype, stored = packed
+        if original_dtype is None:
+            return stored
+        if isinstance(stored, torch.Tensor):
+            return stored.to(original_dtype)
+        stored, size, stride, offset = stored
+        base = cached(restored, stored, lambda source: source.to(original_dtype))
+        return base.as_strided(size, stride, offset)
+
+    return saved_tensors_hooks(pack, unpack)
+
+
+def decode_capsules(decoder_conv, connection, conv_cap_1_1, conv_cap_2_1, conv_cap_3_1, conv_cap_4_1):
+    """
+    Runs the UCaps3D decoder `decoder_conv` on the capsule maps of the four encoder levels.
+    """
+    shape = conv_cap_4_1.size()
+    conv_cap_4_1 = conv_cap_4_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
+    shape = conv_cap_3_1.size()
+    conv_cap_3_1 = conv_cap_3_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
+    shape = conv_cap_2_1.size()
+    conv_cap_2_1 = conv_cap_2_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
+    shape = conv_cap_1_1.size()
+    conv_cap_1_1 = conv_cap_1_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
+
+    # Expanding
+    if connection == "skip":
+        x = decoder_conv[0](conv_cap_4_1)
+        x = torch.cat((x, conv_cap_3_1.to(x.dtype)), dim=1)
+        x = decoder_conv[1](x)
+        x = decoder_conv[2](x)
+        x = torch.cat((x, conv_cap_2_1.to(x.dtype)), dim=1)
+        x = decoder_conv[3](x)
+        x = decoder_conv[4](x)
+        x = torch.cat((x, conv_cap_1_1.to(x.dtype)), dim=1)
+
+    logits = decoder_conv[5](x)
+
+    return logits
+
 
 # Pytorch Lightning module
 class UCaps3D(pl.LightningModule):
@@ -34,6 +123,12 @@ class UCaps3D(pl.LightningModule):
         val_patch_size=(32, 32, 32),
         overlap=0.75,
         connection="skip",
+        class_head="capsule",
+        class_head_channels=192,
+        variant="default",
+        skip_precision="float32",
+        routing_stride=None,
+        routing_topk=None,
         val_frequency=100,
         weight_decay=2e-6,
         **kwargs,
@@ -44,6 +139,20 @@ class UCaps3D(pl.LightningModule):
         self.out_channels = self.hparams.out_channels
         self.share_weight = self.hparams.share_weight
         self.connection = self.hparams.connection
+        self.class_head = self.hparams.class_head
+        self.class_head_channels = self.hparams.class_head_channels
+        if self.class_head not in ("capsule", "projection"):
+            raise ValueError(f"Unsupported class_head {self.class_head}, use capsule or projection.")
+        self.variant = self.hparams.variant
+        if self.variant not in UCAPS3D_VARIANTS:
+            raise ValueError(f"Unsupported variant {self.variant}, use one of {', '.join(UCAPS3D_VARIANTS)}.")
+        self.variant_config = UCAPS3D_VARIANTS[self.variant]
+        self.skip_precision = self.hparams.skip_precision
+        if self.skip_precision not in SKIP_PRECISIONS:
+            raise ValueError(
+                f"Unsupported skip_precision {self.skip_precision}, use one of {', '.join(SKIP_PRECISIONS)}."
+            )
+        self.skip_dtype = SKIP_PRECISIONS[self.skip_precision]
 
         self.lr_rate = self.hparams.lr_rate
         self.weight_decay = self.hparams.weight_decay
@@ -75,73 +184,30 @@ class UCaps3D(pl.LightningModule):
         self.overlap = self.hparams.overlap
 
         # Building model
-        # to remove dilations you just deactivate them then change the padding to 2
-        self.feature_extractor = nn.Sequential(
-            OrderedDict(
-                [
-                    (
-                        "conv1",
-                        Convolution(
-                            dimensions=3,
-                            in_channels=self.in_channels,
-                            out_channels=16,
-                            kernel_size=5,
-                            strides=1,
-                            padding=2,
-                            bias=False,
-                        ),
-                    ),
-                    (
-                        "conv2",
-                        Convolution(
-                            dimensions=3,
-                            in_channels=16,
-                            out_channels=32,
-                            kernel_size=5,
-                            strides=1,
-                            # dilation=2,
-                            padding=2,  # 4
-                            bias=False,
-                        ),
-                    ),
-                    (
-                        "conv3",
-                        Convolution(
-                            dimensions=3,
-                            in_channels=32,
-                            out_channels=64,
-                            kernel_size=5,
-                            strides=1,
-                            padding=2,  # 2
-                            # dilation=2,
-                            bias=False,
-                            act="tanh",
-                        ),
-                    ),
-                ]
-            )
-        )
-
+        self._build_feature_extractor()
         self.primary_caps = ConvSlimCapsule3D(
             kernel_size=3,
             input_dim=1,
-            output_dim=16,
-            input_atoms=64,
+            output_dim=self._scaled(16),
+            input_atoms=self.feature_channels,
             output_atoms=4,
             stride=1,
             padding=1,
             num_routing=1,
             share_weight=self.share_weight,
+            vote_rank=self.variant_config["vote_rank"],
         )
         self._build_encoder()
+        self.set_routing_stride(self.hparams.routing_stride)
+        self.set_routing_topk(self.hparams.routing_topk)
         self._build_decoder()
         self._build_reconstruct_branch()
 
         # For validation
-        self.post_pred = Compose([EnsureType(), AsDiscrete(argmax=True, to_onehot=True, n_classes=self.out_channels)])
-        self.post_label = Compose([EnsureType(), AsDiscrete(to_onehot=True, n_classes=self.out_channels)])
-
-        self.dice_metric = DiceMetric(include_background=False, reduction="mean_batch", get_not_nans=False)
+        # ConfusionMatrixMetrics created by the first validation_step, prediction does not import the metrics
+        self.val_metrics = None
+        # Optional inference.tile_cache.TileCache of predict_step
+        self.tile_cache = None
 
         self.example_input_array = torch.rand(1, self.in_channels, 64, 64, 64)
         # self.example_input_array = torch.rand(1, self.in_channels, 32, 32, 32)
@@ -155,6 +221,18 @@ class UCaps3D(pl.LightningModule):
         parser.add_argument("--out_channels", type=int, default=3)
         parser.add_argument("--share_weight", type=int, default=1)
         parser.add_argument("--connection", type=str, default="skip")
+        # Decoder input of the class capsules: "capsule" feeds all out_channels x 64 atoms, "projection" a
+        # learned 1x1x1 projection of them to class_head_channels, independent of the number of classes
+        parser.add_argument("--class_head", type=str, default="capsule")
+        parser.add_argument("--class_head_channels", type=int, default=192)
+        # Named configuration of the layers, see UCAPS3D_VARIANTS
+        parser.add_argument("--variant", type=str, default="default", help=" / ".join(UCAPS3D_VARIANTS))
+        # Storage dtype of the skip capsule maps and of the encoder activations kept for backward
+        parser.add_argument("--skip_precision", type=str, default="float32", help=" / ".join(SKIP_PRECISIONS))
+        # Route every k-th voxel of the encoder capsule layers, one k for all layers or one per layer
+        parser.add_argument("--routing_stride", nargs="+", type=int, default=None)
+        # Route every input capsule to its k output capsules of highest logit after the first iteration, 0 for all
+        parser.add_argument("--routing_topk", nargs="+", type=int, default=None)
 
         # Validation params
         parser.add_argument("--val_patch_size", nargs="+", type=int, default=[64, 64, 64])
@@ -175,60 +253,96 @@ class UCaps3D(pl.LightningModule):
         return parent_parser, parser
 
     def forward(self, x):
-        # Contracting
         x = self.feature_extractor(x)
+        return self.decode(*self.encode_capsules(x))
+
+    def encode_capsules(self, x):
+        # Contracting
         x = x.unsqueeze(dim=1)
         conv_cap_1_1 = self.primary_caps(x)
 
         x = self.encoder_conv_caps[0](conv_cap_1_1)
+        conv_cap_1_1 = self.store_skip(conv_cap_1_1)
         conv_cap_2_1 = self.encoder_conv_caps[1](x)
 
         x = self.encoder_conv_caps[2](conv_cap_2_1)
+        conv_cap_2_1 = self.store_skip(conv_cap_2_1)
         conv_cap_3_1 = self.encoder_conv_caps[3](x)
 
         x = self.encoder_conv_caps[4](conv_cap_3_1)
+        conv_cap_3_1 = self.store_skip(conv_cap_3_1)
         conv_cap_4_1 = self.encoder_conv_caps[5](x)
 
-        shape = conv_cap_4_1.size()
-        conv_cap_4_1 = conv_cap_4_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
-        shape = conv_cap_3_1.size()
-        conv_cap_3_1 = conv_cap_3_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
-        shape = conv_cap_2_1.size()
-        conv_cap_2_1 = conv_cap_2_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
-        shape = conv_cap_1_1.size()
-        conv_cap_1_1 = conv_cap_1_1.view(shape[0], -1, shape[-3], shape[-2], shape[-1])
-
-        # Expanding
-        if self.connection == "skip":
-            x = self.decoder_conv[0](conv_cap_4_1)
-            x = torch.cat((x, conv_cap_3_1), dim=1)
-            x = self.decoder_conv[1](x)
-            x = self.decoder_conv[2](x)
-            x = torch.cat((x, conv_cap_2_1), dim=1)
-            x = self.decoder_conv[3](x)
-            x = self.decoder_conv[4](x)
-            x = torch.cat((x, conv_cap_1_1), dim=1)
+        return conv_cap_1_1, conv_cap_2_1, conv_cap_3_1, conv_cap_4_1
+
+    def set_routing_stride(self, routing_stride):
+        """
+        Sets the spacing of the voxels the encoder capsule layers route, see `layers._update_routing`.
+        Args:
+            routing_stride: None or 1 to route every voxel, a scalar for every layer or a list of one
+                scalar per encoder capsule layer.
+        """
+        self.routing_stride = self._per_layer("routing_stride", routing_stride, default=1, minimum=1)
+        for layer, stride in zip(self.encoder_conv_caps, self.routing_stride):
+            layer.routing_stride = stride
+
+    def set_routing_topk(self, routing_topk):
+        """
+        Sets the number of output capsules every input capsule of the encoder capsule layers routes to
+        after the first routing iteration, see `layers._update_routing`.
+        Args:
+            routing_topk: None or 0 to route to every output capsule, a scalar for every layer or a list of
+                one scalar per encoder capsule layer.
+        """
+        self.routing_topk = self._per_layer("routing_topk", routing_topk, default=0, minimum=0)
+        for layer, topk in zip(self.encoder_conv_caps, self.routing_topk):
+            layer.routing_topk = topk
+
+    def _per_layer(self, name, value, default, minimum):
+        # One setting per encoder capsule layer from None, a scalar or a list of one or of one per layer
+        if value is None:
+            value = default
+        if isinstance(value, int):
+            value = [value]
+        if len(value) == 1:
+            value = list(value) * len(self.encoder_conv_caps)
+        if len(value) != len(self.encoder_conv_caps) or min(value) < minimum:
+            raise ValueError(
+                f"{name} needs 1 or {len(self.encoder_conv_caps)} values of at least {minimum}, got {value}."
+            )
+        return list(value)
 
-        logits = self.decoder_conv[5](x)
+    def store_skip(self, skip):
+        """
+        Skip capsule map as kept until the decoder, cast to `skip_precision` once the next encoder layer used it.
+        """
+        return skip if self.skip_dtype is None else skip.to(self.skip_dtype)
 
-        return logits
+    def decode(self, conv_cap_1_1, conv_cap_2_1, conv_cap_3_1, conv_cap_4_1):
+        return decode_capsules(
+            self.decoder_conv, self.connection, conv_cap_1_1, conv_cap_2_1, conv_cap_3_1, conv_cap_4_1
+        )
 
     def training_step(self, batch, batch_idx):
         images, labels = batch["image"], batch["label"]
 
         # Contracting
-        x = self.feature_extractor(images)
-        x = x.unsqueeze(dim=1)
-        conv_cap_1_1 = self.primary_caps(x)
+        with saved_tensors_dtype(self.skip_dtype):
+            x = self.feature_extractor(images)
+            x = x.unsqueeze(dim=1)
+            conv_cap_1_1 = self.primary_caps(x)
 
-        x = self.encoder_conv_caps[0](conv_cap_1_1)
-        conv_cap_2_1 = self.encoder_conv_caps[1](x)
+            x = self.encoder_conv_caps[0](conv_cap_1_1)
+            conv_cap_1_1 = self.store_skip(conv_cap_1_1)
+            conv_cap_2_1 = self.encoder_conv_caps[1](x)
 
-        x = self.encoder_conv_caps[2](conv_cap_2_1)
-        conv_cap_3_1 = self.encoder_conv_caps[3](x)
+            x = self.encoder_conv_caps[2](conv_cap_2_1)
+            conv_cap_2_1 = self.store_skip(conv_cap_2_1)
+            conv_cap_3_1 = self.encoder_conv_caps[3](x)
 
-        x = self.encoder_conv_caps[4](conv_cap_3_1)
-        conv_cap_4_1 = self.encoder_conv_caps[5](x)
+            x = self.encoder_conv_caps[4](conv_cap_3_1)
+            conv_cap_3_1 = self.store_skip(conv_cap_3_1)
+            conv_cap_4_1 = self.encoder_conv_caps[5](x)
 
         # Downsampled predictions
         norm = torch.linalg.norm(conv_cap_4_1, dim=2)
@@ -245,13 +359,13 @@ class UCaps3D(pl.LightningModule):
         # Expanding
         if self.connection == "skip":
             x = self.decoder_conv[0](conv_cap_4_1)
-            x = torch.cat((x, conv_cap_3_1), dim=1)
+            x = torch.cat((x, conv_cap_3_1.to(x.dtype)), dim=1)
             x = self.decoder_conv[1](x)
             x = self.decoder_conv[2](x)
-            x = torch.cat((x, conv_cap_2_1), dim=1)
+            x = torch.cat((x, conv_cap_2_1.to(x.dtype)), dim=1)
             x = self.decoder_conv[3](x)
             x = self.decoder_conv[4](x)
-            x = torch.cat((x, conv_cap_1_1), dim=1)
+            x = torch.cat((x, conv_cap_1_1.to(x.dtype)), dim=1)
 
         logits = self.decoder_conv[5](x)
 
@@ -269,6 +383,10 @@ class UCaps3D(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         images, labels = batch["image"], batch["label"]
+        if self.val_metrics is None:
+            from inference.metrics import ConfusionMatrixMetrics
+
+            self.val_metrics = ConfusionMatrixMetrics(self.out_channels)
 
         val_outputs = sliding_window_inference(
             images,
@@ -295,17 +413,15 @@ class UCaps3D(pl.LightningModule):
                 tag="Prediction",
             )
 
-        val_outputs = [self.post_pred(val_output) for val_output in decollate_batch(val_outputs)]
-        labels = [self.post_label(label) for label in decollate_batch(labels)]
-        self.dice_metric(y_pred=val_outputs, y=labels)
+        self.val_metrics(torch.argmax(val_outputs, dim=1, keepdim=True), labels)
 
     def validation_epoch_end(self, outputs):
-        dice_scores = self.dice_metric.aggregate()
+        dice_scores = self.val_metrics.aggregate("dice", reduction="mean_batch")
         mean_val_dice = torch.mean(dice_scores)
         self.log("val_dice", mean_val_dice, sync_dist=True)
         for i, dice_score in enumerate(dice_scores):
             self.log(f"val_dice_class {i + 1}", dice_score, sync_dist=True)
-        self.dice_metric.reset()
+        self.val_metrics.reset()
 
     def predict_step(self, batch, batch_idx, dataloader_idx=None):
         images = batch["image"]
@@ -313,7 +429,7 @@ class UCaps3D(pl.LightningModule):
             images,
             roi_size=self.val_patch_size,
             sw_batch_size=self.sw_batch_size,
-            predictor=self.forward,
+            predictor=self.forward if self.tile_cache is None else self.tile_cache.predictor(self, self.forward),
             overlap=self.overlap,
         )
         return outputs
@@ -328,6 +444,8 @@ class UCaps3D(pl.LightningModule):
         return [optimizer], [scheduler]
 
     def losses(self, volumes, labels, norm, pred, reconstructions):
+        # Losses in float32 under a reduced precision mode
+        pred, reconstructions = pred.float(), reconstructions.float()
         mask = torch.gt(labels, 0)
         rec_loss = torch.sum(self.reconstruction_loss(volumes * mask, reconstructions * mask), dim=(1, 2, 3, 4)) / (
             torch.sum(mask, dim=(1, 2, 3, 4)) + 1e-8
@@ -346,11 +464,108 @@ class UCaps3D(pl.LightningModule):
             rec_loss,
         )
 
+    def _scaled(self, channels):
+        return max(int(channels * self.variant_config["width"]), 1)
+
+    def _build_feature_extractor(self):
+        self.feature_channels = self._scaled(64)
+        if self.variant_config["separable_features"]:
+            # The first convolution sees the input channels only and stays dense, the next two are
+            # split into a depthwise 5x5x5 and a pointwise convolution
+            channels = [self.in_channels, self._scaled(16), self._scaled(32), self.feature_channels]
+            layers = [
+                (
+                    "conv1",
+                    Convolution(
+                        dimensions=3,
+                        in_channels=channels[0],
+                        out_channels=channels[1],
+                        kernel_size=5,
+                        strides=1,
+                        padding=2,
+                        bias=False,
+                    ),
+                )
+            ]
+            for i in (1, 2):
+                layers.append(
+                    (
+                        f"depthwise{i + 1}",
+                        Conv["conv", 3](
+                            channels[i], channels[i], kernel_size=5, padding=2, groups=channels[i], bias=False
+                        ),
+                    )
+                )
+                layers.append(
+                    (
+                        f"conv{i + 1}",
+                        Convolution(
+                            dimensions=3,
+                            in_channels=channels[i],
+                            out_channels=channels[i + 1],
+                            kernel_size=1,
+                            strides=1,
+                            padding=0,
+                            bias=False,
+                            act="tanh" if i == 2 else "PRELU",
+                        ),
+                    )
+                )
+            self.feature_extractor = nn.Sequential(OrderedDict(layers))
+            return
+
+        # to remove dilations you just deactivate them then change the padding to 2
+        self.feature_extractor = nn.Sequential(
+            OrderedDict(
+                [
+                    (
+                        "conv1",
+                        Convolution(
+                            dimensions=3,
+                            in_channels=self.in_channels,
+                            out_channels=self._scaled(16),
+                            kernel_size=5,
+                            strides=1,
+                            padding=2,
+                            bias=False,
+                        ),
+                    ),
+                    (
+                        "conv2",
+                        Convolution(
+                            dimensions=3,
+                            in_channels=self._scaled(16),
+                            out_channels=self._scaled(32),
+                            kernel_size=5,
+                            strides=1,
+                            # dilation=2,
+                            padding=2,  # 4
+                            bias=False,
+                        ),
+                    ),
+                    (
+                        "conv3",
+                        Convolution(
+                            dimensions=3,
+                            in_channels=self._scaled(32),
+                            out_channels=self.feature_channels,
+                            kernel_size=5,
+                            strides=1,
+                            padding=2,  # 2
+                            # dilation=2,
+                            bias=False,
+                            act="tanh",
+                        ),
+                    ),
+                ]
+            )
+        )
+
     def _build_encoder(self):
         self.encoder_conv_caps = nn.ModuleList()
         self.encoder_kernel_size = 3
-        self.encoder_output_dim = [16, 16, 8, 8, 8, self.out_channels]
-        self.encoder_output_atoms = [8, 8, 16, 16, 32, 64]
+        self.encoder_output_dim = [self._scaled(dim) for dim in [16, 16, 8, 8, 8]] + [self.out_channels]
+        self.encoder_output_atoms = [self._scaled(atoms) for atoms in [8, 8, 16, 16, 32, 64]]
 
         for i in range(len(self.encoder_output_dim)):
             if i == 0:
@@ -372,19 +587,62 @@ class UCaps3D(pl.LightningModule):
                     stride=stride,
                     padding=1,
                     dilation=1,
-                    num_routing=3,
+                    num_routing=self.variant_config["num_routing"],
                     share_weight=self.share_weight,
+                    vote_rank=self.variant_config["vote_rank"],
                 )
             )
 
     def _build_decoder(self):
         self.decoder_conv = nn.ModuleList()
         if self.connection == "skip":
-            self.decoder_in_channels = [self.out_channels * self.encoder_output_atoms[-1], 384, 128, 256, 64, 128]
-            self.decoder_out_channels = [256, 128, 128, 64, 64, self.out_channels]
+            self.decoder_out_channels = [self._scaled(channels) for channels in [256, 128, 128, 64, 64]]
+            self.decoder_out_channels.append(self.out_channels)
+            # Upsampled maps concatenated with the capsule maps of encoder layers 3, 1 and the primary capsules
+            skip_channels = [
+                self.encoder_output_dim[3] * self.encoder_output_atoms[3],
+                self.encoder_output_dim[1] * self.encoder_output_atoms[1],
+                self.primary_caps.output_dim * self.primary_caps.output_atoms,
+            ]
+            self.decoder_in_channels = [
+                self.out_channels * self.encoder_output_atoms[-1],
+                self.decoder_out_channels[0] + skip_channels[0],
+                self.decoder_out_channels[1],
+                self.decoder_out_channels[2] + skip_channels[1],
+                self.decoder_out_channels[3],
+                self.decoder_out_channels[4] + skip_channels[2],
+            ]
+        if self.class_head == "projection":
+            class_channels = self.decoder_in_channels[0]
+            self.decoder_in_channels[0] = self.class_head_channels
 
         for i in range(6):
-            if i == 5:
+            if i == 0 and self.class_head == "projection":
+                self.decoder_conv.append(
+                    nn.Sequential(
+                        OrderedDict(
+                            [
+                                (
+                                    "projection",
+                                    Conv["conv", 3](
+                                        class_channels, self.class_head_channels, kernel_size=1, bias=False
+                                    ),
+                                ),
+                                (
+                                    "upsample",
+                                    UpSample(
+                                        dimensions=3,
+                                        in_channels=self.decoder_in_channels[i],
+                                        out_channels=self.decoder_out_channels[i],
+                                        scale_factor=2,
+                                        mode=self.variant_config["upsample"],
+                                    ),
+                                ),
+                            ]
+                        )
+                    )
+                )
+            elif i == 5:
                 self.decoder_conv.append(
                     Conv["conv", 3](self.decoder_in_channels[i], self.decoder_out_channels[i], kernel_size=1)
                 )
@@ -395,6 +653,7 @@ class UCaps3D(pl.LightningModule):
                         in_channels=self.decoder_in_channels[i],
                         out_channels=self.decoder_out_channels[i],
                         scale_factor=2,
+                        mode=self.variant_config["upsample"],
                     )
                 )
             else:
@@ -2,12 +2,9 @@ from __future__ import absolute_import, division, print_function
 
 import pytorch_lightning as pl
 import torch
-from monai.data import decollate_batch
 from monai.inferers import sliding_window_inference
 from monai.losses import DiceCELoss
-from monai.metrics import DiceMetric
 from monai.networks.nets import BasicUNet
-from monai.transforms import AsDiscrete, Compose, EnsureType
 from monai.visualize.img2tensorboard import plot_2d_or_3d_image
 
 
@@ -56,10 +53,10 @@ class UNetModule(pl.LightningModule):
         self.model = BasicUNet(in_channels=self.in_channels, out_channels=self.out_channels)
 
         # For validation
-        self.post_pred = Compose([EnsureType(), AsDiscrete(argmax=True, to_onehot=True, n_classes=self.out_channels)])
-        self.post_label = Compose([EnsureType(), AsDiscrete(to_onehot=True, n_classes=self.out_channels)])
-
-        self.dice_metric = DiceMetric(include_background=False, reduction="mean_batch", get_not_nans=False)
+        # ConfusionMatrixMetrics created by the first validation_step, prediction does not import the metrics
+        self.val_metrics = None
+        # Optional inference.tile_cache.TileCache of predict_step
+        self.tile_cache = None
 
         self.example_input_array = torch.rand(1, self.in_channels, 32, 32, 32)
 
@@ -92,7 +89,8 @@ class UNetModule(pl.LightningModule):
 
         logits = self.model(images)
 
-        loss = self.classification_loss(logits, labels)
+        # Loss in float32 under a reduced precision mode
+        loss = self.classification_loss(logits.float(), labels)
 
         self.log(f"{self.cls_loss}_loss", loss, on_step=False, on_epoch=True, sync_dist=True)
 
@@ -100,6 +98,10 @@ class UNetModule(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         images, labels = batch["image"], batch["label"]
+        if self.val_metrics is None:
+            from inference.metrics import ConfusionMatrixMetrics
+
+            self.val_metrics = ConfusionMatrixMetrics(self.out_channels)
 
         val_outputs = sliding_window_inference(
             images,
@@ -126,17 +128,15 @@ class UNetModule(pl.LightningModule):
                 tag="Prediction",
             )
 
-        val_outputs = [self.post_pred(val_output) for val_output in decollate_batch(val_outputs)]
-        labels = [self.post_label(label) for label in decollate_batch(labels)]
-        self.dice_metric(y_pred=val_outputs, y=labels)
+        self.val_metrics(torch.argmax(val_outputs, dim=1, keepdim=True), labels)
 
     def validation_epoch_end(self, outputs):
-        dice_scores = self.dice_metric.aggregate()
+        dice_scores = self.val_metrics.aggregate("dice", reduction="mean_batch")
         mean_val_dice = torch.mean(dice_scores)
         self.log("val_dice", mean_val_dice, sync_dist=True)
         for i, dice_score in enumerate(dice_scores):
             self.log(f"val_dice_class {i + 1}", dice_score, sync_dist=True)
-        self.dice_metric.reset()
+        self.val_metrics.reset()
 
     def predict_step(self, batch, batch_idx, dataloader_idx=None):
         images = batch["image"]
@@ -144,7 +144,7 @@ class UNetModule(pl.LightningModule):
             images,
             roi_size=self.val_patch_size,
             sw_batch_size=self.sw_batch_size,
-            predictor=self.forward,
+            predictor=self.forward if self.tile_cache is None else self.tile_cache.predictor(self, self.forward),
             overlap=self.overlap,
         )
         return outputs
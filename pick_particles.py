@@ -0,0 +1,62 @@
+import argparse
+import os
+import time
+
+import nibabel as nib
+from postprocess.particles import open_volume, pick_particles, write_particles
+
+# Call examples
+# centroids of the components of a predicted label map:
+# python pick_particles.py --input output/tomo/tomo_ucaps_prediction.nii.gz --classes 1 2 --radius 6 10 \
+#     --reference data/tomo.nii.gz
+# probability peaks of a store written with --prob_dir:
+# python pick_particles.py --input probs/tomo.zarr --method peaks --threshold 0.6 --radius 6 --format star
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", nargs="+", type=str, required=True,
+                        help="Prediction store directories (--prob_dir) or NIfTI label maps")
+    parser.add_argument("--reference", nargs="+", type=str, default=None,
+                        help="Original tomogram of every NIfTI label map, to give coordinates in its voxel indices")
+    parser.add_argument("--output_dir", type=str, default="./particles/")
+    parser.add_argument("--classes", nargs="+", type=int, default=None,
+                        help="Labels to pick, defaults to every foreground class of a store")
+    parser.add_argument("--radius", nargs="+", type=float, default=[5.0], help="Particle radius in voxels, per class")
+    parser.add_argument("--method", type=str, default="components", help="components / peaks")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Minimum probability of a peak")
+    parser.add_argument("--min_size", type=int, default=1, help="Minimum number of voxels of a component")
+    parser.add_argument("--max_size", type=int, default=None, help="Maximum number of voxels of a component")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Number of planes read at a time")
+    parser.add_argument("--num_processes", type=int, default=1, help="Number of classes picked in parallel")
+    parser.add_argument("--format", type=str, default="csv", help="csv / star")
+    args = parser.parse_args()
+
+    if args.reference is not None and len(args.reference) != len(args.input):
+        raise ValueError("--reference needs one original tomogram per input.")
+    os.makedirs(args.output_dir, exist_ok=True)
+    for i, path in enumerate(args.input):
+        classes = args.classes
+        if classes is None:
+            n_classes = open_volume(path).n_classes
+            if n_classes is None:
+                raise ValueError("--classes is required for label maps.")
+            classes = list(range(1, n_classes))
+
+        start = time.time()
+        particles = pick_particles(
+            path,
+            classes,
+            args.radius,
+            num_processes=args.num_processes,
+            method=args.method,
+            threshold=args.threshold,
+            min_size=args.min_size,
+            max_size=args.max_size,
+            chunk_size=args.chunk_size,
+            original_affine=nib.load(args.reference[i]).affine if args.reference else None,
+        )
+        name = os.path.basename(os.path.normpath(path)).split(".")[0]
+        output_path = os.path.join(args.output_dir, f"{name}_particles.{args.format}")
+        write_particles(particles, output_path)
+        print(f"{path}: {len(particles)} particles in {time.time() - start:.1f}s -> {output_path}")
@@ -0,0 +1,198 @@
+from __future__ import absolute_import, division, print_function
+
+import glob
+import os
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from postprocess.particles import pick_particles
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+def read_star(path):
+    """
+    Reads the first loop of a STAR file into a DataFrame with the `_rln` column names.
+    """
+    columns, rows = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("_"):
+                columns.append(line.split()[0].lstrip("_"))
+            elif columns and line and not line.startswith(("data_", "loop_", "#")):
+                rows.append(line.split())
+    return pd.DataFrame(rows, columns=columns[: len(rows[0])] if rows else columns)
+
+
+def load_coordinates(path, class_names=None):
+    """
+    Loads a particle list into a DataFrame with the columns "class", "x", "y", "z".
+    Supported formats are the CSV and STAR files of `write_particles`, and whitespace separated
+    text files with the class in the first column followed by x, y, z, such as the SHREC
+    `particle_locations.txt`.
+    Args:
+        path: path of the particle list.
+        class_names: sequence of class names, a name is mapped to its index in this sequence
+            (background first), e.g. ["background", "3gl1", "1bxn"]. Defaults to integer classes.
+    """
+    if path.endswith(".csv"):
+        particles = pd.read_csv(path)
+    elif path.endswith(".star"):
+        star = read_star(path)
+        particles = pd.DataFrame(
+            {
+                "class": star["rlnClassNumber"] if "rlnClassNumber" in star else 1,
+                "x": star["rlnCoordinateX"],
+                "y": star["rlnCoordinateY"],
+                "z": star["rlnCoordinateZ"],
+            }
+        )
+    else:
+        table = pd.read_csv(path, sep=r"\s+", header=None, comment="#")
+        particles = table.iloc[:, :4].copy()
+        particles.columns = ["class", "x", "y", "z"]
+
+    if class_names is not None and particles["class"].dtype == object:
+        index = {str(name).lower(): i for i, name in enumerate(class_names)}
+        particles["class"] = [index.get(str(name).lower(), -1) for name in particles["class"]]
+    particles = particles[["class", "x", "y", "z"]].astype({"class": np.int64, "x": float, "y": float, "z": float})
+    return particles.reset_index(drop=True)
+
+
+def find_coordinates(directory, name):
+    """
+    Finds the particle list `<name>.csv`, `<name>.star` or `<name>.txt` in `directory`.
+    """
+    for ext in (".csv", ".star", ".txt"):
+        paths = glob.glob(os.path.join(directory, name + ext))
+        if paths:
+            return paths[0]
+    raise FileNotFoundError(f"No particle list {name}.csv/.star/.txt in {directory}.")
+
+
+def match_particles(pred, gt, radius):
+    """
+    Optimal one-to-one matching of predicted and ground-truth coordinates within `radius`.
+    Candidate pairs come from `cKDTree.sparse_distance_matrix`. The bipartite candidate graph is
+    split into connected components: isolated pairs are matched directly, and every remaining
+    component is solved with `linear_sum_assignment`, which maximises the number of matches
+    and then minimises the total distance.
+    Args:
+        pred: array [n, 3] of predicted coordinates.
+        gt: array [m, 3] of ground-truth coordinates.
+        radius: scalar, maximum matching distance.
+    Returns:
+        Tuple of the matched indices into `pred` and into `gt`.
+    """
+    pred, gt = np.asarray(pred, dtype=np.float64), np.asarray(gt, dtype=np.float64)
+    if len(pred) == 0 or len(gt) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = cKDTree(pred).sparse_distance_matrix(cKDTree(gt), radius, output_type="ndarray")
+    rows, cols, dists = pairs["i"].astype(np.int64), pairs["j"].astype(np.int64), pairs["v"]
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    n = len(pred)
+    graph = coo_matrix((np.ones(len(rows)), (rows, cols + n)), shape=(n + len(gt), n + len(gt)))
+    _, component = connected_components(graph, directed=False)
+    pair_component = component[rows]
+    pair_count = np.bincount(pair_component, minlength=component.max() + 1)
+
+    simple = pair_count[pair_component] == 1
+    matched_pred, matched_gt = [rows[simple]], [cols[simple]]
+    # components with several candidate pairs
+    order = np.argsort(pair_component[~simple], kind="stable")
+    rest_rows, rest_cols, rest_dists = rows[~simple][order], cols[~simple][order], dists[~simple][order]
+    bounds = np.flatnonzero(np.diff(pair_component[~simple][order])) + 1
+    for r, c, d in zip(np.split(rest_rows, bounds), np.split(rest_cols, bounds), np.split(rest_dists, bounds)):
+        if len(r) == 0:
+            continue
+        ur, ri = np.unique(r, return_inverse=True)
+        uc, ci = np.unique(c, return_inverse=True)
+        invalid = radius * (len(r) + 1) + 1.0
+        cost = np.full((len(ur), len(uc)), invalid)
+        cost[ri, ci] = d
+        i, j = linear_sum_assignment(cost)
+        valid = cost[i, j] < invalid
+        matched_pred.append(ur[i[valid]])
+        matched_gt.append(uc[j[valid]])
+    return np.concatenate(matched_pred), np.concatenate(matched_gt)
+
+
+def particle_scores(pred, gt, radii, classes=None):
+    """
+    Particle-level precision, recall and F1 per class.
+    Args:
+        pred: DataFrame of predicted particles with "class", "x", "y", "z".
+        gt: DataFrame of ground-truth particles with the same columns.
+        radii: matching radius, scalar or dict / sequence per class of `classes`.
+        classes: sequence of classes to score, defaults to the foreground classes of `gt`.
+    Returns:
+        DataFrame indexed by class with "tp", "fp", "fn", "precision", "recall" and "f1".
+    """
+    if classes is None:
+        classes = sorted(c for c in gt["class"].unique() if c > 0)
+    if np.isscalar(radii):
+        radii = {c: radii for c in classes}
+    elif not isinstance(radii, dict):
+        radii = dict(zip(classes, radii)) if len(radii) == len(classes) else {c: radii[0] for c in classes}
+
+    rows = []
+    for c in classes:
+        p = pred.loc[pred["class"] == c, ["x", "y", "z"]].to_numpy()
+        g = gt.loc[gt["class"] == c, ["x", "y", "z"]].to_numpy()
+        tp = len(match_particles(p, g, radii[c])[0])
+        rows.append({"class": c, "tp": tp, "fp": len(p) - tp, "fn": len(g) - tp})
+    return add_rates(pd.DataFrame(rows, columns=["class", "tp", "fp", "fn"]).set_index("class"))
+
+
+def add_rates(counts):
+    """
+    Adds precision, recall and F1 to a DataFrame of "tp", "fp" and "fn" counts, nan when undefined.
+    """
+    counts = counts.copy()
+    tp, fp, fn = (counts[k].astype(np.float64) for k in ("tp", "fp", "fn"))
+    counts["precision"] = tp / (tp + fp).replace(0, np.nan)
+    counts["recall"] = tp / (tp + fn).replace(0, np.nan)
+    counts["f1"] = 2 * tp / (2 * tp + fp + fn).replace(0, np.nan)
+    return counts
+
+
+def score_predictions(prediction_paths, gt_paths, classes, radii, class_names=None, reference_paths=None, **kwargs):
+    """
+    Picks the particles of every predicted volume and scores them against its ground truth.
+    The counts of all volumes are summed before computing the rates.
+    Args:
+        prediction_paths: sequence of label maps or `PredictionStore` directories.
+        gt_paths: sequence of ground-truth particle lists, one per prediction.
+        classes: sequence of classes to pick and score.
+        radii: particle radius, one for all classes or one per class, used for picking and matching.
+        class_names: class names of the ground-truth lists, see `load_coordinates`.
+        reference_paths: sequence of the original volumes whose voxel indices the ground-truth lists
+            use, one per prediction. Label maps are picked in these indices, see `LabelVolume`.
+        kwargs: keyword arguments of `pick_particles`.
+    Returns:
+        DataFrame indexed by class with "tp", "fp", "fn", "precision", "recall" and "f1".
+    """
+    counts = 0
+    for i, (prediction_path, gt_path) in enumerate(zip(prediction_paths, gt_paths)):
+        original_affine = nib.load(reference_paths[i]).affine if reference_paths is not None else None
+        pred = pick_particles(prediction_path, classes, radii, original_affine=original_affine, **kwargs)
+        gt = load_coordinates(gt_path, class_names=class_names)
+        counts = counts + particle_scores(pred, gt, radii, classes=classes)[["tp", "fp", "fn"]]
+    return add_rates(counts)
+
+
+def print_particle_scores(scores):
+    """
+    Prints particle-level scores in the layout of the voxel metrics of the evaluate scripts.
+    """
+    for metric_name in ("precision", "recall", "f1"):
+        print("-------------------------------")
+        print("Particle {} score average: {:4f}".format(metric_name, np.nanmean(scores[metric_name])))
+        for c, score in scores[metric_name].items():
+            print("Particle {} score class {}: {:4f}".format(metric_name, c, score))
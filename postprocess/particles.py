@@ -0,0 +1,267 @@
+from __future__ import absolute_import, division, print_function
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from inference.store import PredictionStore
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+PARTICLE_COLUMNS = ["class", "x", "y", "z", "score", "size"]
+
+
+class LabelVolume:
+    """
+    Label map saved by the evaluate scripts, read slab by slab through the nibabel array proxy.
+    Like for `StoreVolume`, coordinates are mapped to voxel indices of the original volume with
+    the affine of the file and `original_affine`, the affine of the original volume. Without
+    `original_affine` they are voxel indices of the file.
+    """
+
+    def __init__(self, path, original_affine=None):
+        self.image = nib.load(path)
+        self.shape = tuple(self.image.shape[:3])
+        self.n_classes = None
+        if original_affine is None:
+            original_affine = self.image.affine
+        self.transform = np.linalg.inv(np.asarray(original_affine, dtype=np.float64)) @ self.image.affine
+        self.has_probabilities = False
+
+    def labels(self, region):
+        return np.asarray(self.image.dataobj[tuple(region)]).astype(np.uint8)
+
+
+class StoreVolume:
+    """
+    `PredictionStore` of a volume. The arrays are in the space of the transformed image, so
+    coordinates are mapped back to voxel indices of the original file with the stored affines.
+    """
+
+    def __init__(self, path):
+        self.reader = PredictionStore.open(path)
+        self.shape = tuple(self.reader.group["labels/0"].shape)
+        self.n_classes = self.reader.attrs["n_classes"]
+        affine = np.asarray(self.reader.attrs["affine"])
+        original_affine = np.asarray(self.reader.attrs["original_affine"])
+        self.transform = np.linalg.inv(original_affine) @ affine
+        self.has_probabilities = True
+
+    def labels(self, region):
+        return self.reader.labels(region)
+
+    def probability(self, class_index, region):
+        return self.reader.probability(class_index, region)
+
+
+def open_volume(path, original_affine=None):
+    """
+    Opens a `PredictionStore` directory or a NIfTI label map, see `LabelVolume` for `original_affine`.
+    """
+    if os.path.isdir(path):
+        return StoreVolume(path)
+    return LabelVolume(path, original_affine=original_affine)
+
+
+def ball(radius):
+    """
+    Boolean spherical footprint of `radius` voxels.
+    """
+    r = int(np.ceil(radius))
+    grid = np.mgrid[-r : r + 1, -r : r + 1, -r : r + 1]
+    return (grid ** 2).sum(axis=0) <= radius ** 2
+
+
+def iter_slabs(size, chunk_size, halo):
+    """
+    Yields `(core_start, core_stop, extent_start, extent_stop)` of the slabs of the first axis.
+    """
+    for start in range(0, size, chunk_size):
+        stop = min(start + chunk_size, size)
+        yield start, stop, max(start - halo, 0), min(stop + halo, size)
+
+
+def find_components(mask, probs=None, min_size=1, max_size=None):
+    """
+    Connected components of a boolean slab.
+    Returns:
+        Tuple of the centroids [n, 3], scores [n] (mean probability, or size without `probs`),
+        sizes [n] and two boolean arrays [n] flagging components touching the first and the
+        last plane of the first axis.
+    """
+    components, n = ndimage.label(mask)
+    if n == 0:
+        empty = np.zeros(0, dtype=bool)
+        return np.zeros((0, 3)), np.zeros(0), np.zeros(0, dtype=np.int64), empty, empty
+    index = np.arange(1, n + 1)
+    sizes = np.bincount(components.ravel(), minlength=n + 1)[1:]
+    centroids = np.asarray(ndimage.center_of_mass(mask, components, index), dtype=np.float64).reshape(-1, 3)
+    if probs is not None:
+        scores = np.asarray(ndimage.mean(probs, components, index), dtype=np.float64)
+    else:
+        scores = sizes.astype(np.float64)
+    first = np.zeros(n + 1, dtype=bool)
+    first[np.unique(components[0])] = True
+    last = np.zeros(n + 1, dtype=bool)
+    last[np.unique(components[-1])] = True
+
+    keep = sizes >= min_size
+    if max_size is not None:
+        keep &= sizes <= max_size
+    return centroids[keep], scores[keep], sizes[keep], first[1:][keep], last[1:][keep]
+
+
+def find_peaks(probs, radius, threshold):
+    """
+    Local maxima of a probability slab within a ball of `radius` and above `threshold`.
+    Returns:
+        Tuple of the peak coordinates [n, 3] and their probabilities [n].
+    """
+    peaks = (probs == ndimage.maximum_filter(probs, footprint=ball(radius), mode="constant")) & (probs >= threshold)
+    coords = np.argwhere(peaks)
+    return coords.astype(np.float64), probs[peaks].astype(np.float64)
+
+
+def non_maximum_suppression(coords, scores, radius):
+    """
+    Greedy 3D non-maximum suppression: keeps the best scored particles and drops every particle
+    closer than `radius` to a kept one.
+    Returns:
+        Indices of the kept particles in decreasing score order.
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(-scores, kind="stable")
+    neighbours = cKDTree(coords).query_ball_point(coords, r=radius)
+    suppressed = np.zeros(len(coords), dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed[neighbours[i]] = True
+    return np.asarray(keep, dtype=np.int64)
+
+
+def pick_class(
+    path,
+    class_index,
+    radius,
+    method="components",
+    threshold=0.5,
+    min_size=1,
+    max_size=None,
+    chunk_size=64,
+    original_affine=None,
+):
+    """
+    Picks the particles of one class of a volume, one slab of `chunk_size` planes at a time.
+    Every slab is extended by a halo of a particle diameter and keeps the detections whose
+    coordinate lies in its core, so that no particle is cut or counted twice. Components still cut
+    by the extended slab are larger than two particle diameters and are dropped. The candidates
+    of all slabs then go through a global non-maximum suppression.
+    Args:
+        path: `PredictionStore` directory or NIfTI label map.
+        class_index: scalar, label of the class.
+        radius: scalar, particle radius in voxels, used as peak footprint and suppression radius.
+        method: "components" for centroids of connected components of the label map, or "peaks"
+            for local maxima of the class probability, which needs a `PredictionStore`.
+        threshold: scalar, minimum probability of a peak.
+        min_size: scalar, minimum number of voxels of a component.
+        max_size: scalar, maximum number of voxels of a component, None for no limit.
+        chunk_size: scalar, number of planes of the first axis per slab.
+        original_affine: affine of the original volume of a NIfTI label map, see `LabelVolume`.
+    Returns:
+        Array of shape [n, 6] with the `PARTICLE_COLUMNS` of the particles, coordinates in
+        voxel indices of the original volume.
+    """
+    volume = open_volume(path, original_affine=original_affine)
+    if method == "peaks" and not volume.has_probabilities:
+        raise ValueError("Peak picking needs the probabilities of a PredictionStore.")
+    halo = int(np.ceil(2 * radius))
+
+    coords, scores, sizes = [], [], []
+    for core_start, core_stop, extent_start, extent_stop in iter_slabs(volume.shape[0], chunk_size, halo):
+        region = (slice(extent_start, extent_stop),)
+        if method == "components":
+            probs = volume.probability(class_index, region) if volume.has_probabilities else None
+            slab_coords, slab_scores, slab_sizes, first, last = find_components(
+                volume.labels(region) == class_index, probs, min_size=min_size, max_size=max_size
+            )
+            # a component cut by the slab extent is larger than the halo, its size is unknown
+            cut = first & (extent_start > 0) | last & (extent_stop < volume.shape[0])
+            slab_coords, slab_scores, slab_sizes = slab_coords[~cut], slab_scores[~cut], slab_sizes[~cut]
+        elif method == "peaks":
+            slab_coords, slab_scores = find_peaks(volume.probability(class_index, region), radius, threshold)
+            slab_sizes = np.zeros(len(slab_coords), dtype=np.int64)
+        else:
+            raise ValueError(f"Unknown method {method}, expected components or peaks.")
+
+        slab_coords[:, 0] += extent_start
+        core = (slab_coords[:, 0] >= core_start) & (slab_coords[:, 0] < core_stop)
+        coords.append(slab_coords[core])
+        scores.append(slab_scores[core])
+        sizes.append(slab_sizes[core])
+
+    coords, scores, sizes = np.concatenate(coords), np.concatenate(scores), np.concatenate(sizes)
+    keep = non_maximum_suppression(coords, scores, radius)
+    coords = coords[keep] @ volume.transform[:3, :3].T + volume.transform[:3, 3]
+    classes = np.full(len(keep), class_index, dtype=np.float64)
+    return np.column_stack([classes, coords, scores[keep], sizes[keep]])
+
+
+def pick_particles(path, classes, radii, num_processes=1, **kwargs):
+    """
+    Picks the particles of every class of `classes` with its radius of `radii`, in
+    `num_processes` processes reading the volume independently.
+    Keyword arguments are passed to `pick_class`.
+    Returns:
+        DataFrame with the `PARTICLE_COLUMNS`.
+    """
+    if len(radii) == 1:
+        radii = list(radii) * len(classes)
+    if len(radii) != len(classes):
+        raise ValueError("radii must give one radius, or one radius per class.")
+
+    if num_processes > 1:
+        with ProcessPoolExecutor(max_workers=num_processes, mp_context=get_context("spawn")) as executor:
+            futures = [executor.submit(pick_class, path, c, r, **kwargs) for c, r in zip(classes, radii)]
+            results = [future.result() for future in futures]
+    else:
+        results = [pick_class(path, c, r, **kwargs) for c, r in zip(classes, radii)]
+
+    particles = pd.DataFrame(np.concatenate(results), columns=PARTICLE_COLUMNS)
+    return particles.astype({"class": np.int64, "size": np.int64})
+
+
+def write_particles(particles, path):
+    """
+    Writes particles to CSV, or to a RELION STAR file when `path` ends with ".star".
+    """
+    if path.endswith(".star"):
+        header = "\n".join(
+            [
+                "",
+                "data_",
+                "",
+                "loop_",
+                "_rlnCoordinateX #1",
+                "_rlnCoordinateY #2",
+                "_rlnCoordinateZ #3",
+                "_rlnClassNumber #4",
+                "_rlnAutopickFigureOfMerit #5",
+            ]
+        )
+        np.savetxt(
+            path,
+            particles[["x", "y", "z", "class", "score"]].to_numpy(),
+            fmt=["%.2f", "%.2f", "%.2f", "%d", "%.6f"],
+            delimiter="\t",
+            header=header,
+            comments="",
+        )
+    else:
+        particles.to_csv(path, index=False, float_format="%.3f")
@@ -0,0 +1,154 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+
+from inference.data import image_meta, image_transforms
+from inference.ensemble import load_ensemble
+from inference.models import MODELS, load_model
+from inference.pipeline import StagePipeline
+from inference.saver import AsyncNiftiSaver
+from inference.store import StoreSink, open_stores, predict_probabilities
+from inference.tile_cache import TileCache
+from monai.data import DataLoader, Dataset, list_data_collate
+
+# Call examples
+# python predict.py --input /data/tomograms/ --checkpoint_path model.ckpt --output_dir ./output/
+# python predict.py --input tomo_1.nii.gz tomo_2.nii.gz --checkpoint_path model.ckpt --prob_dir ./probs/ --backend pipeline
+# python predict.py --input /data/tomograms/ --checkpoint_path fold_0.ckpt fold_1.ckpt fold_2.ckpt
+
+BACKENDS = ("sliding_window", "pipeline")
+
+
+def list_inputs(inputs):
+    """
+    Expands directories of `inputs` to the NIfTI files they contain.
+    """
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(path, "**", "*.nii*"), recursive=True)))
+        else:
+            paths.append(path)
+    return paths
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", nargs="+", type=str, required=True, help="Tomograms or directories of tomograms")
+    parser.add_argument("--output_dir", type=str, default="./output/")
+    parser.add_argument("--model_name", type=str, default="ucaps", help=" / ".join(MODELS))
+    parser.add_argument("--checkpoint_path", nargs="+", type=str, required=True,
+                        help="/path/to/trained_model, several checkpoints of the same model average their logits")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[64, 64, 64])
+    parser.add_argument("--sw_batch_size", type=int, default=1)
+    parser.add_argument("--overlap", type=float, default=0.75)
+    parser.add_argument("--backend", type=str, default="sliding_window", help=" / ".join(BACKENDS))
+    parser.add_argument("--stage_threads", nargs="+", type=int, default=None,
+                        help="Torch threads per stage of the pipeline backend")
+    parser.add_argument("--device", type=str, default=None, help="cuda / cpu, defaults to cuda when available")
+    parser.add_argument("--num_workers", type=int, default=2, help="Processes loading the next tomograms")
+    parser.add_argument("--save_workers", type=int, default=2,
+                        help="Number of background threads writing labels, 0 to write synchronously")
+    parser.add_argument("--save_compression", type=int, default=-1,
+                        help="gzip level of the labels, 0 for uncompressed .nii, -1 for the nibabel default")
+    parser.add_argument("--prob_dir", type=str, default="",
+                        help="Directory of chunked zarr stores of the class probabilities. Set to \"\" for none.")
+    parser.add_argument("--prob_dtype", type=str, default="float16", help="float16 / uint8")
+    parser.add_argument("--tile_cache_dir", type=str, default="",
+                        help="Directory of the on-disk tile cache of the sliding_window backend. Set to \"\" for none.")
+    parser.add_argument("--tile_cache_size", type=float, default=10, help="Maximum size of the tile cache in GiB")
+    args = parser.parse_args()
+
+    if args.backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {args.backend}, expected one of {', '.join(BACKENDS)}.")
+    if args.backend != "sliding_window" and args.model_name != "ucaps":
+        raise ValueError(f"The {args.backend} backend needs the ucaps model.")
+    if args.tile_cache_dir and args.backend != "sliding_window":
+        raise ValueError("The tile cache needs the sliding_window backend.")
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+
+    paths = list_inputs(args.input)
+    if not paths:
+        raise ValueError("No tomogram found.")
+    root_dir = args.input[0] if len(args.input) == 1 and os.path.isdir(args.input[0]) else ""
+
+    model_kwargs = dict(val_patch_size=args.val_patch_size, sw_batch_size=args.sw_batch_size, overlap=args.overlap)
+    if len(args.checkpoint_path) > 1:
+        if args.backend != "sliding_window":
+            raise ValueError("An ensemble of checkpoints needs the sliding_window backend.")
+        net = load_ensemble(args.model_name, args.checkpoint_path, **model_kwargs).to(device)
+    else:
+        net = load_model(args.model_name, args.checkpoint_path[0], **model_kwargs).to(device)
+    if args.tile_cache_dir:
+        net.tile_cache = TileCache(args.tile_cache_dir, max_bytes=int(args.tile_cache_size * 2 ** 30))
+
+    loader = DataLoader(
+        Dataset(data=[{"image": path} for path in paths], transform=image_transforms()),
+        batch_size=1,
+        num_workers=args.num_workers,
+        collate_fn=list_data_collate,
+    )
+    pred_saver = AsyncNiftiSaver(
+        num_workers=args.save_workers,
+        compresslevel=args.save_compression if args.save_compression >= 0 else None,
+        output_dir=args.output_dir,
+        output_postfix=f"{args.model_name}_prediction",
+        resample=False,
+        data_root_dir=root_dir,
+        output_dtype=np.uint8,
+    )
+    pipeline = StagePipeline(net, stage_threads=args.stage_threads) if args.backend == "pipeline" else None
+
+    start = time.time()
+    total_voxels = 0
+    try:
+        for i, data in enumerate(loader):
+            volume_start = time.time()
+            images = data["image"].to(device)
+            with torch.no_grad():
+                if args.prob_dir and pipeline is not None:
+                    # The probability stores are written as the pipeline blends the windows
+                    stores = open_stores(
+                        args.prob_dir, net.out_channels, images.shape[2:], image_meta(data), dtype=args.prob_dtype
+                    )
+                    sink = StoreSink(stores, images.shape[2:])
+                    pipeline(images, net.val_patch_size, net.sw_batch_size, net.overlap, sink=sink)
+                    labels = sink.close()
+                elif args.prob_dir:
+                    labels = predict_probabilities(net, images, args.prob_dir, image_meta(data), dtype=args.prob_dtype)
+                elif pipeline is not None:
+                    logits = pipeline(images, net.val_patch_size, net.sw_batch_size, net.overlap)
+                    labels = torch.argmax(logits, dim=1, keepdim=True)
+                    del logits
+                else:
+                    labels = torch.argmax(net.predict_step({"image": images}, i), dim=1, keepdim=True)
+
+            pred_saver.save_batch(labels.cpu(), meta_data=image_meta(data))
+
+            voxels = int(np.prod(images.shape[2:]))
+            total_voxels += voxels
+            elapsed = time.time() - start
+            eta = elapsed / (i + 1) * (len(paths) - i - 1)
+            print(
+                f"[{i + 1}/{len(paths)}] {os.path.basename(paths[i])}: {time.time() - volume_start:.1f}s, "
+                f"{voxels / (time.time() - volume_start) / 1e6:.3g} Mvox/s, "
+                f"total {total_voxels / elapsed / 1e6:.3g} Mvox/s, ETA {format_seconds(eta)}"
+            )
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+        pred_saver.close()
+
+    if args.tile_cache_dir:
+        print(net.tile_cache.report())
+    print(f"Predicted {len(paths)} tomograms in {format_seconds(time.time() - start)}")
@@ -0,0 +1,72 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from inference.data import image_meta, image_transforms
+from inference.models import MODELS, load_model
+from inference.slabs import distributed_slab_inference, launch_local
+from monai.data import NiftiSaver
+
+# Call examples
+# one machine, 4 processes:
+# python predict_slabs.py --image tomo.nii.gz --checkpoint_path model.ckpt --num_processes 4
+# several hosts, one process per host:
+# torchrun --nnodes 2 --nproc_per_node 1 --rdzv_endpoint host0:29500 predict_slabs.py --image ... --checkpoint_path ...
+
+
+def run(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    net = load_model(
+        args.model_name,
+        args.checkpoint_path,
+        val_patch_size=args.val_patch_size,
+        sw_batch_size=args.sw_batch_size,
+        overlap=args.overlap,
+    )
+
+    image, data = None, None
+    if dist.get_rank() == 0:
+        data = image_transforms()({"image": args.image})
+        image = data["image"][None]
+
+    labels = distributed_slab_inference(net, image, axis=args.axis)
+
+    if dist.get_rank() == 0:
+        pred_saver = NiftiSaver(
+            output_dir=args.output_dir,
+            output_postfix=f"{args.model_name}_prediction",
+            resample=False,
+            output_dtype=np.uint8,
+        )
+        pred_saver.save(labels[0], meta_data=image_meta(data))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", type=str, required=True, help="/path/to/tomogram.nii.gz")
+    parser.add_argument("--output_dir", type=str, default="./output/")
+    parser.add_argument("--model_name", type=str, default="ucaps", help=" / ".join(MODELS))
+    parser.add_argument("--checkpoint_path", type=str, required=True, help="/path/to/trained_model")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[64, 64, 64])
+    parser.add_argument("--sw_batch_size", type=int, default=1)
+    parser.add_argument("--overlap", type=float, default=0.75)
+    parser.add_argument("--axis", type=int, default=None, help="Spatial axis to split, defaults to the longest")
+    parser.add_argument("--num_processes", type=int, default=2, help="Local processes when not run by torchrun")
+    parser.add_argument("--num_threads", type=int, default=0, help="Torch threads per process, 0 for an equal share")
+    args = parser.parse_args()
+
+    if "RANK" in os.environ and "WORLD_SIZE" in os.environ:
+        dist.init_process_group("gloo")
+        try:
+            run(args)
+        finally:
+            dist.destroy_process_group()
+    else:
+        if args.num_threads == 0:
+            args.num_threads = max(len(os.sched_getaffinity(0)) // args.num_processes, 1)
+        launch_local(run, args.num_processes, args)
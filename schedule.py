@@ -0,0 +1,112 @@
+import argparse
+import time
+from multiprocessing import get_context
+
+from inference.jobs import JobQueue, format_stats, run_worker
+from inference.models import MODELS
+from inference.pool import worker_cpus
+
+# Call examples
+# overnight batch of a directory, 4 workers of 8 threads:
+# python schedule.py --db jobs.sqlite --input_dir /data/tomograms/ --checkpoint_path model.ckpt --workers 4 --threads 8
+# keep watching the directory for new tomograms:
+# python schedule.py --db jobs.sqlite --input_dir /data/incoming/ --checkpoint_path model.ckpt --watch 30
+# urgent tomograms first:
+# python schedule.py --db jobs.sqlite --manifest urgent.txt --priority 10 --checkpoint_path model.ckpt
+# queue statistics only:
+# python schedule.py --db jobs.sqlite --stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="jobs.sqlite", help="SQLite job queue, kept across runs")
+    parser.add_argument("--input_dir", type=str, default="",
+                        help='Directory of tomograms to queue. Set to "" for none.')
+    parser.add_argument("--manifest", type=str, default="",
+                        help='Tomograms to queue, one per line optionally followed by a priority. Set to "" for none.')
+    parser.add_argument("--priority", type=int, default=0, help="Priority of the queued tomograms, higher runs first")
+    parser.add_argument("--watch", type=float, default=0,
+                        help="Seconds between scans of --input_dir, 0 to stop once the queue is empty")
+    parser.add_argument("--settle", type=float, default=10,
+                        help="Seconds a new file must stay unmodified before it is queued")
+    parser.add_argument("--stats", action="store_true", help="Print the queue statistics and exit")
+    parser.add_argument("--output_dir", type=str, default="./output/")
+    parser.add_argument("--prob_dir", type=str, default="",
+                        help="Directory of chunked zarr stores of the class probabilities. Set to \"\" for none.")
+    parser.add_argument("--model_name", type=str, default="ucaps", help=" / ".join(MODELS))
+    parser.add_argument("--checkpoint_path", type=str, default="", help="/path/to/trained_model")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[64, 64, 64])
+    parser.add_argument("--sw_batch_size", type=int, default=4)
+    parser.add_argument("--overlap", type=float, default=0.75)
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="Torch threads per worker, 0 for an equal share of the cpus")
+    parser.add_argument("--numa", type=int, default=0, help="Pin workers to NUMA nodes or not")
+    parser.add_argument("--pack_voxels", type=float, default=256 ** 3,
+                        help="Tomograms are packed into one claim up to this total number of voxels")
+    parser.add_argument("--split_voxels", type=float, default=1024 ** 3,
+                        help="Tomograms over this number of voxels are predicted slab by slab, 0 to never split")
+    parser.add_argument("--max_attempts", type=int, default=2, help="Runs of a failing job before it is marked failed")
+    parser.add_argument("--lease", type=float, default=0,
+                        help="Seconds after which the running jobs of other hosts are requeued at start, 0 to never")
+    parser.add_argument("--stats_interval", type=float, default=60, help="Seconds between statistics reports")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.db)
+    if args.stats:
+        print(format_stats(queue.stats()))
+        raise SystemExit
+
+    requeued = queue.requeue_running(lease=args.lease)
+    if requeued:
+        print(f"Resuming {requeued} unfinished jobs")
+    if args.manifest:
+        print(f"Queued {queue.add_manifest(args.manifest, priority=args.priority)} jobs from {args.manifest}")
+    if args.input_dir:
+        added = queue.scan(args.input_dir, priority=args.priority, settle=args.settle)
+        print(f"Queued {added} jobs from {args.input_dir}")
+
+    model_kwargs = dict(val_patch_size=args.val_patch_size, sw_batch_size=args.sw_batch_size, overlap=args.overlap)
+    cpus = worker_cpus(args.workers, numa=args.numa)
+    context = get_context("spawn")
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(
+                rank,
+                args.db,
+                args.model_name,
+                args.checkpoint_path,
+                model_kwargs,
+                args.threads if args.threads else len(cpus[rank]),
+                cpus[rank],
+                args.output_dir,
+                args.input_dir,
+                args.prob_dir,
+                int(args.pack_voxels),
+                int(args.split_voxels),
+                args.max_attempts,
+                min(args.watch, 5) if args.watch else 0,
+            ),
+        )
+        for rank in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    start = last_scan = last_report = time.time()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(1)
+            now = time.time()
+            if args.watch and args.input_dir and now - last_scan >= args.watch:
+                queue.scan(args.input_dir, priority=args.priority, settle=args.settle)
+                last_scan = now
+            if now - last_report >= args.stats_interval:
+                print(format_stats(queue.stats()))
+                last_report = now
+    finally:
+        for worker in workers:
+            worker.join()
+    print(format_stats(queue.stats()))
+    print(f"Finished in {time.time() - start:.1f}s")
@@ -0,0 +1,52 @@
+import argparse
+
+import torch
+
+from inference.models import MODELS, load_model
+from inference.server import InferenceServer, WindowBatcher
+
+# Call examples
+# python serve.py --model ucaps=ucaps.ckpt unet=unet.ckpt --port 8600 --sw_batch_size 8
+# curl -X POST localhost:8600/predict -d '{"path": "/data/tomo.nii.gz", "model": "ucaps", "output_dir": "./output/"}'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", nargs="+", type=str, required=True,
+                        help="Models to keep loaded, as model_name=/path/to/trained_model, model_name one of "
+                        + " / ".join(MODELS))
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--output_dir", type=str, default="./output/")
+    parser.add_argument("--val_patch_size", nargs="+", type=int, default=[64, 64, 64])
+    parser.add_argument("--sw_batch_size", type=int, default=8, help="Windows per forward pass, across requests")
+    parser.add_argument("--overlap", type=float, default=0.75)
+    parser.add_argument("--max_wait", type=float, default=0.005,
+                        help="Seconds to wait for other requests to fill a batch")
+    parser.add_argument("--device", type=str, default=None, help="cuda / cpu, defaults to cuda when available")
+    args = parser.parse_args()
+
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    models = {}
+    for spec in args.model:
+        name, _, checkpoint_path = spec.partition("=")
+        net = load_model(
+            name,
+            checkpoint_path,
+            val_patch_size=args.val_patch_size,
+            sw_batch_size=args.sw_batch_size,
+            overlap=args.overlap,
+        ).to(device)
+        models[name] = WindowBatcher(
+            net, args.val_patch_size, args.sw_batch_size, args.overlap, max_wait=args.max_wait, device=device
+        )
+        print(f"Loaded {name} from {checkpoint_path}")
+
+    server = InferenceServer((args.host, args.port), models, output_dir=args.output_dir)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
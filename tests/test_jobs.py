@@ -0,0 +1,101 @@
+import os
+import socket
+import time
+
+import nibabel as nib
+import numpy as np
+import pytest
+import torch
+from inference.jobs import JobQueue, predict_split, worker_name
+from inference.server import WindowBatcher
+from monai.inferers import sliding_window_inference
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    yield queue
+    queue.close()
+
+
+def add_volume(queue, tmp_path, name, shape, priority=0):
+    path = str(tmp_path / f"{name}.nii.gz")
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.uint8), np.eye(4)), path)
+    return queue.add([path], priority=priority)
+
+
+def claimed(jobs):
+    return [os.path.basename(job["path"]) for job in jobs]
+
+
+def test_claim_by_priority_then_submission(queue, tmp_path):
+    add_volume(queue, tmp_path, "a", (4, 4, 4))
+    add_volume(queue, tmp_path, "b", (4, 4, 4), priority=5)
+    add_volume(queue, tmp_path, "c", (4, 4, 4))
+    assert add_volume(queue, tmp_path, "a", (4, 4, 4)) == 0
+
+    assert claimed(queue.claim("w")) == ["b.nii.gz"]
+    assert claimed(queue.claim("w")) == ["a.nii.gz"]
+    assert claimed(queue.claim("w")) == ["c.nii.gz"]
+    assert queue.claim("w") == []
+
+
+def test_claim_packs_within_pack_voxels(queue, tmp_path):
+    add_volume(queue, tmp_path, "a", (4, 4, 4))
+    add_volume(queue, tmp_path, "big", (8, 8, 8))
+    add_volume(queue, tmp_path, "b", (4, 4, 4))
+    add_volume(queue, tmp_path, "c", (4, 4, 4))
+
+    # "big" does not fit next to "a" and is skipped, the next claim starts with it even over the limit
+    assert claimed(queue.claim("w", pack_voxels=3 * 64)) == ["a.nii.gz", "b.nii.gz", "c.nii.gz"]
+    assert claimed(queue.claim("w", pack_voxels=3 * 64)) == ["big.nii.gz"]
+    stats = queue.stats()
+    assert stats["running"] == 4 and stats["queued"] == 0
+
+
+def test_fail_requeues_until_max_attempts(queue, tmp_path):
+    add_volume(queue, tmp_path, "a", (4, 4, 4))
+    job = queue.claim("w")[0]
+    queue.fail(job["id"], "error", max_attempts=2)
+    job = queue.claim("w")[0]
+    queue.fail(job["id"], "error", max_attempts=2)
+    assert queue.claim("w") == []
+    stats = queue.stats()
+    assert stats["failed"] == 1 and stats["queued"] == 0
+
+
+def test_requeue_running_leaves_live_workers(queue, tmp_path):
+    for name in ("live", "dead", "remote"):
+        add_volume(queue, tmp_path, name, (4, 4, 4))
+    queue.claim(worker_name(0))
+    queue.claim(f"{socket.gethostname()}-{2 ** 22 + 1}-0")
+    queue.claim("other-host-123-0")
+
+    assert queue.requeue_running() == 1
+    assert claimed(queue.claim(worker_name(1))) == ["dead.nii.gz"]
+
+    queue.connection.execute("UPDATE jobs SET started = ? WHERE worker = 'other-host-123-0'", (time.time() - 100,))
+    assert queue.requeue_running(lease=1000) == 0
+    assert queue.requeue_running(lease=10) == 1
+    assert claimed(queue.claim(worker_name(1))) == ["remote.nii.gz"]
+
+
+class WindowPositionNet(torch.nn.Module):
+    # Logits depend on the position inside the window, so a shifted window grid changes them
+    def forward(self, x):
+        ramp = torch.linspace(0.5, 1.5, x.shape[2])[:, None, None]
+        return torch.cat((x * ramp, x.flip(2) - ramp), dim=1)
+
+
+def test_predict_split_equals_whole_volume():
+    torch.manual_seed(0)
+    image = torch.randn(1, 1, 10, 30, 6)
+    net = WindowPositionNet()
+    expected = torch.argmax(sliding_window_inference(image, (8, 8, 8), 2, net, 0.25), dim=1, keepdim=True)
+    batcher = WindowBatcher(net, (8, 8, 8), sw_batch_size=2, overlap=0.25, max_wait=0, device="cpu")
+    try:
+        labels = predict_split(batcher, image, num_slabs=3)
+    finally:
+        batcher.close()
+    assert labels.shape == expected.shape
+    assert torch.equal(labels.long(), expected.long())
@@ -0,0 +1,66 @@
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from inference.data import image_meta, image_transforms
+from inference.store import save_probabilities
+from monai.data import list_data_collate
+from postprocess.matching import match_particles, particle_scores, score_predictions
+from postprocess.particles import pick_particles
+
+
+def test_match_particles_is_one_to_one_within_radius():
+    pred = np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [10.0, 0.0, 0.0], [30.0, 0.0, 0.0]])
+    gt = np.array([[0.5, 0.0, 0.0], [11.5, 0.0, 0.0], [50.0, 0.0, 0.0]])
+    rows, cols = match_particles(pred, gt, radius=2.0)
+    assert sorted(zip(rows.tolist(), cols.tolist())) in ([(0, 0), (2, 1)], [(1, 0), (2, 1)])
+
+
+def test_match_particles_maximises_the_matches():
+    # Greedy nearest matching pairs 1 with 0 and leaves 0 unmatched, the optimum matches both
+    pred = np.array([[0.0, 0.0, 0.0], [2.0, 0.0, 0.0]])
+    gt = np.array([[1.8, 0.0, 0.0], [-1.5, 0.0, 0.0]])
+    rows, cols = match_particles(pred, gt, radius=2.0)
+    assert sorted(zip(rows.tolist(), cols.tolist())) == [(0, 1), (1, 0)]
+
+
+def test_match_particles_empty():
+    rows, cols = match_particles(np.zeros((0, 3)), np.ones((2, 3)), radius=1.0)
+    assert len(rows) == len(cols) == 0
+
+
+def test_particle_scores():
+    pred = pd.DataFrame({"class": [1, 1, 2], "x": [0.0, 5.0, 0.0], "y": [0.0] * 3, "z": [0.0] * 3})
+    gt = pd.DataFrame({"class": [1, 2, 2], "x": [0.5, 0.0, 9.0], "y": [0.0] * 3, "z": [0.0] * 3})
+    scores = particle_scores(pred, gt, radii=1.0)
+    assert scores.loc[1, ["tp", "fp", "fn"]].tolist() == [1, 1, 0]
+    assert scores.loc[2, ["tp", "fp", "fn"]].tolist() == [1, 0, 1]
+    assert scores.loc[2, "f1"] == pytest.approx(2 / 3)
+
+
+@pytest.mark.parametrize(
+    "affine",
+    [np.diag([-1.0, -1.0, 1.0, 1.0]), np.array([[0, 1.0, 0, 0], [1.0, 0, 0, 0], [0, 0, 1.0, 0], [0, 0, 0, 1.0]])],
+    ids=["flipped", "permuted"],
+)
+def test_particles_are_picked_in_original_voxel_indices(tmp_path, affine):
+    volume = np.zeros((20, 16, 12), dtype=np.float32)
+    volume[2:5, 3:6, 1:4] = 1
+    path = str(tmp_path / "tomo.nii.gz")
+    nib.save(nib.Nifti1Image(volume, affine), path)
+    pd.DataFrame({"class": [1], "x": [3.0], "y": [4.0], "z": [2.0]}).to_csv(tmp_path / "tomo.csv", index=False)
+
+    # A prediction in the LPI array frame of the transformed image, as a label map and as a store
+    data = list_data_collate([image_transforms()({"image": path})])
+    labels = (data["image"] > 0.5).long()
+    label_map = str(tmp_path / "labels.nii.gz")
+    array_affine = np.asarray(data["image_meta_dict"]["affine"][0])
+    nib.save(nib.Nifti1Image(labels[0, 0].numpy().astype(np.uint8), array_affine), label_map)
+    save_probabilities(str(tmp_path), torch.cat([1 - labels, labels], dim=1).float() * 10, image_meta(data))
+
+    for prediction in (label_map, str(tmp_path / "tomo.zarr")):
+        particles = pick_particles(prediction, [1], [3.0], original_affine=affine)
+        np.testing.assert_allclose(particles[["x", "y", "z"]].to_numpy(), [[3.0, 4.0, 2.0]])
+        scores = score_predictions([prediction], [str(tmp_path / "tomo.csv")], [1], [2.0], reference_paths=[path])
+        assert scores.loc[1, "f1"] == 1.0
@@ -0,0 +1,44 @@
+import pytest
+import torch
+from inference.metrics import ConfusionMatrixMetrics, confusion_matrix
+from monai.metrics import ConfusionMatrixMetric, DiceMetric
+from monai.networks import one_hot
+
+
+def random_volumes(n_classes, absent_class=None):
+    torch.manual_seed(0)
+    labels = torch.randint(0, n_classes, (3, 1, 12, 10, 8))
+    preds = torch.where(torch.rand(labels.shape) < 0.6, labels, torch.randint(0, n_classes, labels.shape))
+    if absent_class is not None:
+        # Absent from the label of the first volume and from every prediction
+        labels[0][labels[0] == absent_class] = 0
+        preds[preds == absent_class] = 0
+    return preds, labels
+
+
+def test_confusion_matrix_counts():
+    preds = torch.tensor([[0, 1, 1, 2, 2, 2]])
+    labels = torch.tensor([[0, 1, 2, 2, 2, 0]])
+    expected = torch.tensor([[[1, 0, 1], [0, 1, 0], [0, 1, 2]]])
+    assert torch.equal(confusion_matrix(preds, labels, 3), expected)
+    assert torch.equal(confusion_matrix(preds, labels, 3, chunk_size=4), expected)
+
+
+@pytest.mark.parametrize("absent_class", [None, 2])
+def test_metrics_match_monai(absent_class):
+    n_classes = 4
+    preds, labels = random_volumes(n_classes, absent_class)
+    metrics = ConfusionMatrixMetrics(n_classes, chunk_size=100)
+    for b in range(preds.shape[0]):
+        metrics(preds[b : b + 1], labels[b : b + 1])
+
+    y_pred, y = one_hot(preds, n_classes, dim=1), one_hot(labels, n_classes, dim=1)
+    dice = DiceMetric(include_background=False, reduction="none", get_not_nans=False)
+    dice(y_pred, y)
+    assert torch.allclose(metrics.aggregate("dice"), dice.aggregate().float(), equal_nan=True)
+    for name in ("precision", "sensitivity"):
+        monai_metric = ConfusionMatrixMetric(
+            include_background=False, metric_name=name, compute_sample=True, reduction="none", get_not_nans=False
+        )
+        monai_metric(y_pred, y)
+        assert torch.allclose(metrics.aggregate(name), monai_metric.aggregate()[0].float(), equal_nan=True)
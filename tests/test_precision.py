@@ -0,0 +1,31 @@
+import pytest
+import torch
+from inference.models import autocast
+from layers import _squash, _update_routing
+
+pytestmark = pytest.mark.skipif(not hasattr(torch, "autocast"), reason="torch.autocast needs torch >= 1.10")
+
+
+def test_routing_stays_in_float32_under_bf16_autocast():
+    torch.manual_seed(0)
+    votes = torch.randn(1, 4, 3, 8, 4, 4, 4)
+    biases = torch.full((3, 8, 1, 1, 1), 0.1)
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        assert _update_routing(votes.bfloat16(), biases, 3).dtype == torch.float32
+        assert _squash(votes.bfloat16()).dtype == torch.float32
+
+
+def test_bf16_predictions_match_float32():
+    from module.ucaps import UCaps3D
+
+    torch.manual_seed(0)
+    net = UCaps3D(in_channels=1, out_channels=3).eval()
+    images = torch.rand(2, 1, 16, 16, 16)
+    with torch.no_grad():
+        reference = net(images)
+        with autocast("bf16"):
+            logits = net(images).float()
+
+    difference = (torch.softmax(reference, 1) - torch.softmax(logits, 1)).abs().max()
+    assert difference < 1e-2
+    assert (reference.argmax(1) == logits.argmax(1)).float().mean() > 0.98
@@ -0,0 +1,88 @@
+import pytest
+import torch
+import torch.nn.functional as F
+from layers import _squash, _update_routing
+
+
+def reference_routing(votes, biases, num_routing, routing_topk=0):
+    # Dynamic routing of every voxel to every output capsule, as before the routing approximations.
+    # With routing_topk, the logits outside the top k of every input capsule are masked after the first iteration.
+    logits_shape = list(votes.size())
+    logits_shape[3] = 1
+    logits = torch.zeros(logits_shape, device=votes.device)
+    for i in range(num_routing):
+        if i == 1 and routing_topk:
+            index = torch.topk(logits, routing_topk, dim=2).indices
+            logits = torch.full_like(logits, float("-inf")).scatter(2, index, logits.gather(2, index))
+        route = F.softmax(logits, dim=2)
+        preactivate = torch.sum(votes * route, dim=1) + biases[None, ...]
+        if i + 1 < num_routing:
+            distances = F.cosine_similarity(preactivate[:, None, ...], votes, dim=3)
+            logits = logits + distances[:, :, :, None, ...]
+    return _squash(preactivate)
+
+
+def random_votes(spatial_shape=(6, 5, 4), input_dim=3, output_dim=4, output_atoms=5):
+    torch.manual_seed(0)
+    votes = torch.randn((2, input_dim, output_dim, output_atoms) + spatial_shape)
+    biases = torch.randn((output_dim, output_atoms) + (1,) * len(spatial_shape))
+    return votes, biases
+
+
+@pytest.mark.parametrize("spatial_shape", [(6, 5), (6, 5, 4)])
+@pytest.mark.parametrize("num_routing", [1, 3])
+def test_routing_stride_1_is_full_routing(spatial_shape, num_routing):
+    votes, biases = random_votes(spatial_shape)
+    expected = reference_routing(votes, biases, num_routing)
+    assert torch.allclose(_update_routing(votes, biases, num_routing), expected, atol=1e-6)
+    assert torch.allclose(_update_routing(votes, biases, num_routing, routing_stride=1), expected, atol=1e-6)
+
+
+def test_routing_stride_without_agreement_iterations_is_full_routing():
+    votes, biases = random_votes()
+    expected = reference_routing(votes, biases, 1)
+    assert torch.allclose(_update_routing(votes, biases, 1, routing_stride=2), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("routing_stride", [2, 3])
+def test_routing_stride_on_spatially_constant_votes_is_full_routing(routing_stride):
+    # The routing coefficients are the same at every voxel, so repeating the strided ones is exact
+    votes, biases = random_votes()
+    votes = votes[..., :1, :1, :1].expand_as(votes).contiguous()
+    expected = reference_routing(votes, biases, 3)
+    assert torch.allclose(_update_routing(votes, biases, 3, routing_stride=routing_stride), expected, atol=1e-6)
+
+
+def test_routing_stride_keeps_the_output_shape():
+    votes, biases = random_votes((7, 5, 4))
+    output = _update_routing(votes, biases, 3, routing_stride=2)
+    assert output.shape == reference_routing(votes, biases, 3).shape
+    assert torch.isfinite(output).all()
+
+
+@pytest.mark.parametrize("routing_topk", [0, 4, 6])
+def test_routing_topk_of_every_output_is_full_routing(routing_topk):
+    votes, biases = random_votes(output_dim=4)
+    expected = reference_routing(votes, biases, 3)
+    assert torch.allclose(_update_routing(votes, biases, 3, routing_topk=routing_topk), expected, atol=1e-6)
+
+
+def test_routing_topk_without_agreement_iterations_is_full_routing():
+    votes, biases = random_votes()
+    expected = reference_routing(votes, biases, 1)
+    assert torch.allclose(_update_routing(votes, biases, 1, routing_topk=1), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("spatial_shape", [(6, 5), (6, 5, 4)])
+@pytest.mark.parametrize("routing_topk", [1, 2, 3])
+def test_routing_topk_masks_the_other_outputs(spatial_shape, routing_topk):
+    votes, biases = random_votes(spatial_shape, output_dim=4)
+    expected = reference_routing(votes, biases, 3, routing_topk=routing_topk)
+    assert torch.allclose(_update_routing(votes, biases, 3, routing_topk=routing_topk), expected, atol=1e-5)
+
+
+def test_routing_topk_with_stride_keeps_the_output_shape():
+    votes, biases = random_votes((7, 5, 4), output_dim=4)
+    output = _update_routing(votes, biases, 3, routing_stride=2, routing_topk=2)
+    assert output.shape == reference_routing(votes, biases, 3).shape
+    assert torch.isfinite(output).all()
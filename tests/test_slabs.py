@@ -0,0 +1,33 @@
+import pytest
+import torch
+from inference.slabs import _axis_slice, plan_slabs
+from monai.inferers import sliding_window_inference
+from torch import nn
+
+
+class WindowPositionNet(nn.Module):
+    """
+    Logits that depend on the voxel position inside the window, so that any shift of the window
+    grid changes the blended output.
+    """
+
+    def forward(self, x):
+        ramp = torch.linspace(0.5, 1.5, x.shape[2])[:, None, None]
+        return torch.cat((x * ramp, x.flip(2) - ramp), dim=1)
+
+
+@pytest.mark.parametrize("num_slabs", [1, 2, 3, 5])
+def test_plan_slabs_cores_equal_whole_volume(num_slabs):
+    torch.manual_seed(0)
+    image = torch.randn(1, 1, 37, 12, 10)
+    roi_size, overlap, axis = (8, 8, 8), 0.5, 0
+    predictor = WindowPositionNet()
+    expected = sliding_window_inference(image, roi_size, 3, predictor, overlap)
+
+    slabs = plan_slabs(image.shape[2:], roi_size, overlap, num_slabs, axis)
+    assert slabs[0][0][0] == 0 and slabs[-1][0][1] == image.shape[2]
+    outputs = torch.zeros_like(expected)
+    for core, extent in slabs:
+        logits = sliding_window_inference(image[_axis_slice(5, 2, *extent)], roi_size, 3, predictor, overlap)
+        outputs[_axis_slice(5, 2, *core)] = logits[_axis_slice(5, 2, core[0] - extent[0], core[1] - extent[0])]
+    assert torch.allclose(outputs, expected, atol=1e-5)
@@ -0,0 +1,9 @@
+import pytest
+import torch
+from inference.sweep import sweep_checkpoints
+
+
+def test_failed_sweep_worker_raises_in_the_parent(tmp_path):
+    loader = [{"image": torch.zeros(1, 1, 8, 8, 8), "label": torch.zeros(1, 1, 8, 8, 8)}]
+    with pytest.raises(RuntimeError, match="sweep worker 0 failed"):
+        sweep_checkpoints("unet", [str(tmp_path / "missing.ckpt")], loader, {}, num_processes=1, num_threads=1)
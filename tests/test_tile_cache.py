@@ -0,0 +1,72 @@
+import os
+
+import pytest
+import torch
+from inference import tile_cache
+from inference.tile_cache import TileCache, model_digest
+
+
+def test_corrupt_entry_is_a_miss_and_evicted(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.put("ab01", torch.ones(2, 3))
+    path = cache._path("ab01")
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) // 2)
+
+    assert cache.get("ab01") is None
+    assert cache.misses == 1
+    assert not os.path.exists(path)
+    assert path not in cache.entries and cache.size == 0
+
+
+def test_model_digest_is_computed_again_only_after_load_state_dict(monkeypatch):
+    net = torch.nn.Linear(3, 2)
+    other = torch.nn.Linear(3, 2)
+    calls = []
+    tensor_digest = tile_cache.tensor_digest
+    monkeypatch.setattr(tile_cache, "tensor_digest", lambda *args: calls.append(1) or tensor_digest(*args))
+
+    key = model_digest(net)
+    assert model_digest(net) == key
+    assert len(calls) == 2
+
+    net.load_state_dict(other.state_dict())
+    assert model_digest(net) == model_digest(other) != key
+    assert len(calls) == 6
+
+
+def test_settings_that_change_the_logits_miss(tmp_path):
+    from module.ucaps import UCaps3D
+
+    torch.manual_seed(0)
+    net = UCaps3D(in_channels=1, out_channels=2).eval()
+    same = UCaps3D(in_channels=1, out_channels=2, sw_batch_size=4, overlap=0.5).eval()
+    skip_float16 = UCaps3D(in_channels=1, out_channels=2, skip_precision="float16").eval()
+    strided = UCaps3D(in_channels=1, out_channels=2).eval()
+    for other in (same, skip_float16, strided):
+        other.load_state_dict(net.state_dict())
+    strided.set_routing_stride(2)
+
+    cache = TileCache(str(tmp_path))
+    windows = torch.rand(2, 1, 16, 16, 16)
+    with torch.no_grad():
+        cache.predictor(net)(windows)
+        assert (cache.hits, cache.misses) == (0, 2)
+        cache.predictor(same)(windows)
+        assert (cache.hits, cache.misses) == (2, 2)
+        cache.predictor(skip_float16)(windows)
+        assert (cache.hits, cache.misses) == (2, 4)
+        cache.predictor(strided)(windows)
+        assert (cache.hits, cache.misses) == (2, 6)
+
+
+@pytest.mark.skipif(not hasattr(torch, "autocast"), reason="torch.autocast needs torch >= 1.10")
+def test_autocast_dtype_is_part_of_the_key(tmp_path):
+    net = torch.nn.Conv3d(1, 2, 3, padding=1)
+    cache = TileCache(str(tmp_path))
+    windows = torch.rand(1, 1, 8, 8, 8)
+    with torch.no_grad():
+        for dtype in (torch.bfloat16, torch.float16, torch.bfloat16):
+            with torch.autocast("cpu", dtype=dtype):
+                cache.predictor(net)(windows)
+    assert (cache.hits, cache.misses) == (1, 2)
@@ -13,6 +13,8 @@ from pytorch_lightning.loggers import TensorBoardLogger
 # Call example
 # python train3D.py --gpus 1 --model_name UCaps --num_workers 4 --max_epochs 20000
 # --check_val_every_n_epoch 100 --log_dir=../logs --root_dir=/home/ubuntu/
+# On a CPU host with bfloat16 support, convolutions in bfloat16 and capsule routing in float32:
+# python train_artificial.py --gpus 0 --precision bf16 --model_name ucaps --root_dir=/home/ubuntu/
 
 if __name__ == "__main__":
     DSName = "artificial"
@@ -105,7 +107,7 @@ if __name__ == "__main__":
         callbacks=[checkpoint_callback, earlystopping_callback],
         num_sanity_val_steps=1,
         terminate_on_nan=True,
-        gpus=1, max_epochs=300,
+        gpus=1 if args.gpus is None else args.gpus, max_epochs=300,
     )
 
     trainer.fit(net, datamodule=data_module)
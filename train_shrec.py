@@ -7,6 +7,7 @@ import re
 from glob import glob
 
 from datamodule.shrec import SHRECDataModule
+from module.multi_ucaps import MultiUCaps3D
 from module.segcaps import SegCaps2D, SegCaps3D
 from module.ucaps import UCaps3D
 from module.unet import UNetModule
@@ -29,7 +30,8 @@ if __name__ == "__main__":
     # Training options
     train_parser = parser.add_argument_group("Training config")
     train_parser.add_argument("--log_dir", type=str, default="/mnt/Data/Cryo-ET/3D-UCaps/logs")
-    train_parser.add_argument("--model_name", type=str, default="ucaps", help="ucaps / segcaps-2d / segcaps-3d / unet")
+    train_parser.add_argument("--model_name", type=str, default="ucaps",
+                              help="ucaps / ucaps-multi / segcaps-2d / segcaps-3d / unet")
     train_parser.add_argument("--dataset", type=str, default=str(DSName), help=" shrec/ invitro")
     train_parser.add_argument("--train_patch_size", nargs="+", type=int, default=[16, 16, 16])
     # train_parser.add_argument("--train_patch_size", nargs="+", type=int, default=[32, 32, 32])
@@ -40,6 +42,9 @@ if __name__ == "__main__":
                               help="Effective batch size: batch_size x num_samples")
     train_parser.add_argument("--balance_sampling", type=int, default=1)
     train_parser.add_argument("--use_class_weight", type=int, default=0)
+    train_parser.add_argument("--init_checkpoint", type=str, default="",
+                              help="ucaps-multi checkpoint of merge_checkpoints.py to fine-tune, keeping its "
+                              "architecture, targets and frozen shared layers. Set to \"\" for none.")
 
     parser = Trainer.add_argparse_args(parser)
 
@@ -49,6 +54,8 @@ if __name__ == "__main__":
     # let the model add what it wants
     if temp_args.model_name == "ucaps":
         parser, model_parser = UCaps3D.add_model_specific_args(parser)
+    elif temp_args.model_name == "ucaps-multi":
+        parser, model_parser = MultiUCaps3D.add_model_specific_args(parser)
     elif temp_args.model_name == "segcaps-2d":
         parser, model_parser = SegCaps2D.add_model_specific_args(parser)
     elif temp_args.model_name == "segcaps-3d":
@@ -85,8 +92,24 @@ if __name__ == "__main__":
     else:
         class_weight = None
 
+    if args.init_checkpoint and args.model_name != "ucaps-multi":
+        raise ValueError("--init_checkpoint needs the ucaps-multi model.")
     if args.model_name == "ucaps":
         net = UCaps3D(**dict_args, class_weight=class_weight)
+    elif args.model_name == "ucaps-multi" and args.init_checkpoint:
+        # Weights, architecture, targets and frozen shared layers of the merged checkpoint, training settings of
+        # the command line, the optimizer and the training loop start afresh
+        net = MultiUCaps3D.load_from_checkpoint(
+            args.init_checkpoint,
+            lr_rate=args.lr_rate,
+            weight_decay=args.weight_decay,
+            val_frequency=args.val_frequency,
+            val_patch_size=args.val_patch_size,
+            sw_batch_size=args.sw_batch_size,
+            overlap=args.overlap,
+        )
+    elif args.model_name == "ucaps-multi":
+        net = MultiUCaps3D(**dict_args)
     elif args.model_name == "segcaps-3d":
         net = SegCaps3D(**dict_args, class_weight=class_weight)
     elif args.model_name == "segcaps-2d":
@@ -125,7 +148,7 @@ if __name__ == "__main__":
         callbacks=[checkpoint_callback , earlystopping_callback],
         num_sanity_val_steps=1,
         terminate_on_nan=True,
-        gpus=1, max_epochs=300,
+        gpus=1 if args.gpus is None else args.gpus, max_epochs=300,
         # resume_from_checkpoint = "/mnt/Data/Cryo-ET/3D-UCaps/logs/ucaps_invitro_0/
         # version_0/checkpoints/epoch=128-val_dice=0.8708.ckpt"
     )